@@ -1,11 +1,29 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
+import pyarrow as pa
 from supabase import create_client
+from postgrest.exceptions import APIError
 from datetime import datetime, timedelta, date
 import time
 import extra_streamlit_components as stx
 import json
 import io
+import os
+import hashlib
+import tempfile
+import zipfile
+import operator
+import sqlite3
+import threading
+import logging
+import uuid
+import unicodedata
+import heapq
+import bisect
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 
 # ==========================================
 # CONFIGURACIÓN VISUAL Y ESTILOS
@@ -41,6 +59,143 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ==========================================
+# MEDICIÓN DE LLAMADAS (DEPURACIÓN)
+# ==========================================
+# Cada llamada a Supabase y a cargar_tabla queda registrada en la ejecución (rerun) en curso.
+# Al terminar el rerun se resume por tabla y por menú y se emite una línea JSON en el log.
+# Apagada por defecto: se activa con MEDICION = true en los secrets.
+MEDICION_ACTIVA = str(st.secrets.get("MEDICION", "false")).strip().lower() in ("1", "true")
+MAX_RERUNS_MEDIDOS = 20
+OPERACIONES_SUPABASE = {"select", "insert", "upsert", "update", "delete"}
+
+log_medicion = logging.getLogger("koriel.medicion")
+if not log_medicion.handlers:
+    _manejador = logging.StreamHandler()
+    _manejador.setFormatter(logging.Formatter("%(message)s"))
+    log_medicion.addHandler(_manejador)
+    log_medicion.setLevel(logging.INFO)
+    log_medicion.propagate = False
+
+def _medicion_actual():
+    # None fuera de una sesión de Streamlit (hilos sin contexto, scripts externos)
+    if get_script_run_ctx() is None: return None
+    return st.session_state.get("_medicion")
+
+def registrar_llamada(capa, tabla, operacion, filas, bytes_, segundos, error=None):
+    medicion = _medicion_actual()
+    if medicion is not None:
+        medicion["llamadas"].append({
+            "capa": capa, "tabla": tabla, "operacion": operacion, "filas": filas,
+            "bytes": bytes_, "segundos": round(segundos, 6), "error": error
+        })
+
+class _ConsultaMedida:
+    # Envuelve un builder de postgrest: mide execute() y recuerda la operación de la cadena
+    def __init__(self, builder, tabla, operacion):
+        self._builder, self._tabla, self._operacion = builder, tabla, operacion
+
+    def __getattr__(self, nombre):
+        atributo = getattr(self._builder, nombre)
+        if not callable(atributo): return atributo
+        def llamada(*args, **kwargs):
+            res = atributo(*args, **kwargs)
+            operacion = nombre if nombre in OPERACIONES_SUPABASE else self._operacion
+            return _ConsultaMedida(res, self._tabla, operacion) if hasattr(res, "execute") else res
+        return llamada
+
+    def execute(self):
+        inicio = time.perf_counter()
+        filas, bytes_, error = 0, 0, None
+        try:
+            res = self._builder.execute()
+            filas = len(res.data) if isinstance(res.data, list) else 1
+            bytes_ = len(json.dumps(res.data, default=str).encode("utf-8"))
+            return res
+        except Exception as e:
+            error = str(e)[:200]
+            raise
+        finally:
+            registrar_llamada("supabase", self._tabla, self._operacion, filas, bytes_, time.perf_counter() - inicio, error)
+
+class ClienteMedido:
+    # Mismo uso que el cliente de Supabase: supabase.table(...)... / supabase.rpc(...)
+    def __init__(self, cliente):
+        self._cliente = cliente
+
+    def table(self, tabla):
+        return _ConsultaMedida(self._cliente.table(tabla), tabla, None)
+
+    def rpc(self, nombre, *args, **kwargs):
+        return _ConsultaMedida(self._cliente.rpc(nombre, *args, **kwargs), nombre, "rpc")
+
+    def __getattr__(self, nombre):
+        return getattr(self._cliente, nombre)
+
+def iniciar_medicion():
+    # Sin medición no hay registro: registrar_llamada y cerrar_medicion no hacen nada
+    if not MEDICION_ACTIVA: return
+    st.session_state["_medicion"] = {
+        "inicio": time.perf_counter(), "fecha": datetime.now().isoformat(timespec="seconds"),
+        "usuario": st.session_state.get("usuario_logueado"), "menu": None, "llamadas": []
+    }
+
+def resumen_medicion(medicion):
+    red = [l for l in medicion["llamadas"] if l["capa"] == "supabase"]
+    por_tabla = {}
+    for l in red:
+        t = por_tabla.setdefault(l["tabla"], {"llamadas": 0, "filas": 0, "bytes": 0, "segundos": 0.0})
+        t["llamadas"] += 1; t["filas"] += l["filas"]; t["bytes"] += l["bytes"]; t["segundos"] = round(t["segundos"] + l["segundos"], 6)
+    return {
+        "fecha": medicion["fecha"], "usuario": medicion["usuario"], "menu": medicion["menu"],
+        "segundos_rerun": round(time.perf_counter() - medicion["inicio"], 4),
+        "llamadas_supabase": len(red),
+        "errores": sum(1 for l in red if l["error"]),
+        "filas": sum(l["filas"] for l in red),
+        "bytes": sum(l["bytes"] for l in red),
+        "segundos_supabase": round(sum(l["segundos"] for l in red), 4),
+        "cargas_tabla": sum(1 for l in medicion["llamadas"] if l["capa"] == "cargar_tabla"),
+        "por_tabla": por_tabla,
+    }
+
+def cerrar_medicion():
+    # Guarda el resumen en el historial de la sesión, lo acumula por menú y lo escribe en el log
+    medicion = st.session_state.pop("_medicion", None)
+    if medicion is None: return
+    resumen = resumen_medicion(medicion)
+    st.session_state.setdefault("_medicion_reruns", deque(maxlen=MAX_RERUNS_MEDIDOS)).append(resumen)
+    if resumen["menu"]:
+        menu = st.session_state.setdefault("_medicion_menus", {}).setdefault(
+            resumen["menu"], {"reruns": 0, "llamadas_supabase": 0, "bytes": 0, "segundos_rerun": 0.0, "segundos_supabase": 0.0}
+        )
+        menu["reruns"] += 1
+        for k in ("llamadas_supabase", "bytes", "segundos_rerun", "segundos_supabase"):
+            menu[k] += resumen[k]
+    log_medicion.info(json.dumps({"evento": "rerun", **resumen}, ensure_ascii=False))
+
+def mostrar_medicion(contenedor):
+    # Panel de depuración (solo admin): rerun actual, últimos reruns y acumulado por menú
+    medicion = st.session_state.get("_medicion")
+    with contenedor.expander("🔧 Depuración: llamadas a Supabase"):
+        if medicion is not None:
+            actual = resumen_medicion(medicion)
+            c1, c2, c3 = st.columns(3)
+            c1.metric("Llamadas", actual["llamadas_supabase"])
+            c2.metric("KB", f"{actual['bytes'] / 1024:,.1f}")
+            c3.metric("Red (s)", f"{actual['segundos_supabase']:.2f}")
+            if medicion["llamadas"]:
+                st.dataframe(pd.DataFrame(medicion["llamadas"]), hide_index=True)
+        anteriores = st.session_state.get("_medicion_reruns")
+        if anteriores:
+            st.caption("Reruns anteriores")
+            st.dataframe(
+                pd.DataFrame(list(anteriores)).drop(columns=["por_tabla"]).iloc[::-1], hide_index=True
+            )
+        menus = st.session_state.get("_medicion_menus")
+        if menus:
+            st.caption("Acumulado por menú")
+            st.dataframe(pd.DataFrame.from_dict(menus, orient="index"))
+
 # ==========================================
 # CONEXIÓN A BASE DE DATOS
 # ==========================================
@@ -48,7 +203,8 @@ st.markdown("""
 def init_connection():
     url = st.secrets["SUPABASE_URL"]
     key = st.secrets["SUPABASE_KEY"]
-    return create_client(url, key)
+    cliente = create_client(url, key)
+    return ClienteMedido(cliente) if MEDICION_ACTIVA else cliente
 
 supabase = init_connection()
 
@@ -65,57 +221,1222 @@ USUARIOS = {
 # 4. FUNCIONES DEL MOTOR (CRUD)
 # ==========================================
 
+# --- CACHÉ DE TABLAS ---
+# Segundos que una tabla se sirve desde caché aunque nadie la haya modificado
+TTL_TABLAS = {
+    "clientes": 600,
+    "productos": 600,
+    "almacenes": 600,
+    "prestamos": 300,
+    "historial": 300,
+    "stock_real": 300,
+    "resumen_diario": 300,
+}
+TTL_DEFECTO = 120
+
+@st.cache_resource
+def versiones_tablas():
+    # Compartido por todas las sesiones del proceso; refrescar_versiones() trae las de los demás procesos
+    return {}
+
+# Tablas que Supabase recalcula (triggers) cuando cambia otra
+TABLAS_DERIVADAS = {"historial": ("resumen_diario",)}
+
+def invalidar_tablas(*tablas):
+    versiones = versiones_tablas()
+    for tabla in tablas + tuple(d for t in tablas for d in TABLAS_DERIVADAS.get(t, ())):
+        anterior = versiones.get(tabla, 0)
+        versiones[tabla] = subir_version(tabla)
+        if versiones[tabla] == anterior + 1:
+            # Nadie más escribió en el medio: los índices en memoria reciben esta escritura
+            # con actualizar_* y no hace falta reconstruirlos
+            for idx in _indices_de(tabla):
+                with idx["candado"]:
+                    if idx["versiones"].get(tabla) == anterior:
+                        idx["versiones"][tabla] = versiones[tabla]
+
+def _versiones_de(tablas):
+    versiones = versiones_tablas()
+    return {tabla: versiones.get(tabla, 0) for tabla in tablas}
+
+# Filtros que se envían a PostgREST: (columna, operador, valor)
+OPERADORES_FILTRO = {"eq": "eq", "in": "in_", "gte": "gte", "lte": "lte", "gt": "gt", "lt": "lt"}
+
+# Filas por página. No debe superar el "Max Rows" configurado en Supabase (1000 por defecto)
+TAMANO_PAGINA = int(st.secrets.get("TAMANO_PAGINA", 1000))
+
+def _consulta_tabla(tabla, columnas, filtros, orden):
+    query = supabase.table(tabla).select(",".join(columnas) if columnas else "*")
+    for col, op, valor in filtros:
+        query = getattr(query, OPERADORES_FILTRO[op])(col, valor)
+    if orden:
+        query = query.order(orden[0], desc=orden[1])
+    # Orden estable para que las páginas no se solapen
+    if not orden or orden[0] != "id":
+        query = query.order("id", desc=bool(orden and orden[1]))
+    return query
+
+def paginas_tabla(tabla, columnas=None, filtros=(), orden=None, tamano_pagina=None):
+    # Recorre la tabla por rangos; cada página es una lista de filas
+    tamano_pagina = tamano_pagina or TAMANO_PAGINA
+    inicio = 0
+    while True:
+        response = _consulta_tabla(tabla, columnas, filtros, orden).range(inicio, inicio + tamano_pagina - 1).execute()
+        if response.data:
+            yield response.data
+        if len(response.data) < tamano_pagina:
+            break
+        inicio += tamano_pagina
+
+# --- ESQUEMA DE TIPOS POR TABLA ---
+# Tipos compactos para cada DataFrame: textos repetidos como category, cantidades int32,
+# montos float64 y fechas datetime64. Las columnas no declaradas quedan como llegan.
+CATEGORIA, CANTIDAD, DINERO, FECHA, ID = "category", "int32", "float64", "datetime64", "int64"
+
+ESQUEMAS_TABLAS = {
+    "clientes": {"id": ID},
+    "productos": {"id": ID, "categoria": CATEGORIA, "precio_base": DINERO},
+    "almacenes": {"id": ID},
+    "prestamos": {
+        "id": ID, "fecha_registro": FECHA, "usuario": CATEGORIA, "cliente_id": ID, "producto_id": ID,
+        "cantidad_pendiente": CANTIDAD, "precio_unitario": DINERO, "total_pendiente": DINERO
+    },
+    "historial": {
+        "id": ID, "fecha_evento": FECHA, "usuario_responsable": CATEGORIA, "tipo": CATEGORIA,
+        "cliente_id": ID, "producto_id": ID, "cantidad": CANTIDAD, "monto_operacion": DINERO
+    },
+    "stock_real": {"id": ID, "almacen": CATEGORIA, "producto_id": ID, "cantidad": CANTIDAD},
+    "movimientos_stock": {
+        "id": ID, "fecha": FECHA, "usuario": CATEGORIA, "tipo": CATEGORIA, "almacen": CATEGORIA,
+        "producto_id": ID, "cantidad": CANTIDAD
+    },
+    "anulaciones": {
+        "id": ID, "usuario_responsable": CATEGORIA, "accion_original": CATEGORIA, "cliente": CATEGORIA,
+        "producto": CATEGORIA, "cantidad_restaurada": CANTIDAD, "monto_anulado": DINERO
+    },
+    "bitacora_ediciones": {"id": ID, "usuario_responsable": CATEGORIA},
+    "importaciones": {"id": ID, "fecha_pedido": FECHA, "fecha_llegada_estimada": FECHA},
+    "resumen_diario": {
+        "cliente_id": ID, "dia": FECHA, "tipo": CATEGORIA, "movimientos": CANTIDAD, "cantidad": ID, "monto": DINERO
+    },
+}
+# Tablas sin esquema: solo se convierten las fechas conocidas
+COLUMNAS_FECHA = ["fecha_registro", "fecha_evento", "fecha", "fecha_pedido", "fecha_llegada_estimada"]
+
+def _aplicar_esquema(df, tabla):
+    esquema = ESQUEMAS_TABLAS.get(tabla) or {col: FECHA for col in COLUMNAS_FECHA}
+    for col, tipo in esquema.items():
+        if col not in df.columns: continue
+        if tipo == FECHA:
+            df[col] = pd.to_datetime(df[col], errors='coerce', format='ISO8601')
+        elif tipo == CATEGORIA:
+            df[col] = df[col].astype(CATEGORIA)
+        else:
+            serie = pd.to_numeric(df[col], errors='coerce')
+            # Un entero con nulos queda en float64 (NaN) en vez de fallar
+            df[col] = serie.astype(tipo if tipo == DINERO or serie.notna().all() else DINERO)
+    return df
+
+def _preparar_tabla(df, tabla=None):
+    df = _aplicar_esquema(df, tabla)
+    
+    if "created_at" in df.columns:
+        df = df.drop(columns=["created_at"])
+        
+    return df
+
+def _descargar_tabla(tabla, columnas=None, filtros=(), orden=None):
+    trozos = [pd.DataFrame(pagina) for pagina in paginas_tabla(tabla, columnas, filtros, orden)]
+    if trozos:
+        df = pd.concat(trozos, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=list(columnas) if columnas else None)
+    return _preparar_tabla(df, tabla)
+
+# --- ALMACÉN COMPARTIDO ENTRE PROCESOS ---
+# Con varios procesos de Streamlit detrás de un balanceador, cada uno descargaba su propia copia
+# y solo se enteraba de sus propias escrituras. En RUTA_SNAPSHOTS quedan para todos:
+# - las versiones de las tablas (SQLite): una escritura en cualquier proceso invalida a los demás
+# - una foto Arrow por tabla compartida, sellada con (versión, ventana): el primer proceso que la
+#   necesita la trae de Supabase y la publica; los demás la abren con memory-map
+RUTA_SNAPSHOTS = st.secrets.get("RUTA_SNAPSHOTS", "snapshots_koriel")
+TABLAS_COMPARTIDAS = ("clientes", "productos", "prestamos", "historial")
+ESPERA_CANDADO_SNAPSHOT = 120
+
+logger_snapshots = logging.getLogger("koriel.snapshots")
+
+@st.cache_resource
+def almacen_compartido():
+    os.makedirs(RUTA_SNAPSHOTS, exist_ok=True)
+    con = sqlite3.connect(os.path.join(RUTA_SNAPSHOTS, "almacen.db"), check_same_thread=False, timeout=30)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("CREATE TABLE IF NOT EXISTS versiones (tabla TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS snapshots "
+        "(tabla TEXT PRIMARY KEY, sello TEXT NOT NULL, archivo TEXT NOT NULL, marca TEXT, marca_baja INTEGER)"
+    )
+    con.commit()
+    return {"con": con, "candado": threading.Lock()}
+
+def refrescar_versiones():
+    # Una consulta por rerun: lo que otros procesos escribieron invalida también aquí
+    try:
+        alm = almacen_compartido()
+        with alm["candado"]:
+            filas = alm["con"].execute("SELECT tabla, version FROM versiones").fetchall()
+        # Nunca hacia atrás: una versión local subida sin almacén puede ir por delante de la compartida
+        versiones = versiones_tablas()
+        for tabla, version in filas:
+            versiones[tabla] = max(versiones.get(tabla, 0), version)
+    except Exception as e:
+        logger_snapshots.warning("No se pudieron leer las versiones compartidas: %s", e)
+
+def subir_version(tabla):
+    # La compartida nunca queda por detrás de la local: una llave de caché no se reutiliza con otros datos
+    siguiente = versiones_tablas().get(tabla, 0) + 1
+    try:
+        alm = almacen_compartido()
+        with alm["candado"], alm["con"] as con:
+            con.execute(
+                "INSERT INTO versiones (tabla, version) VALUES (?, ?) "
+                "ON CONFLICT (tabla) DO UPDATE SET version = max(version + 1, excluded.version)", (tabla, siguiente)
+            )
+            return con.execute("SELECT version FROM versiones WHERE tabla = ?", (tabla,)).fetchone()[0]
+    except Exception as e:
+        # Sin almacén la invalidación sigue valiendo para este proceso
+        logger_snapshots.warning("No se pudo subir la versión de %s: %s", tabla, e)
+        return siguiente
+
+@contextmanager
+def candado_snapshot(tabla):
+    # Un solo proceso trae la tabla a la vez; los demás esperan y usan lo que publicó
+    con = None
+    try:
+        almacen_compartido()
+        con = sqlite3.connect(
+            os.path.join(RUTA_SNAPSHOTS, f"{tabla}.candado"), timeout=ESPERA_CANDADO_SNAPSHOT, isolation_level=None
+        )
+        con.execute("BEGIN EXCLUSIVE")
+    except (sqlite3.Error, OSError) as e:
+        logger_snapshots.warning("Sin candado para %s, se sigue igual: %s", tabla, e)
+    try:
+        yield
+    finally:
+        if con is not None: con.close()
+
+def _sello_snapshot(clave):
+    return json.dumps(clave)
+
+def leer_snapshot(tabla):
+    # Última foto publicada: {"sello", "df", "marca", "marca_baja"} o None
+    alm = almacen_compartido()
+    with alm["candado"]:
+        fila = alm["con"].execute(
+            "SELECT sello, archivo, marca, marca_baja FROM snapshots WHERE tabla = ?", (tabla,)
+        ).fetchone()
+    if fila is None: return None
+    sello, archivo, marca, marca_baja = fila
+    # Solo lectura y sin copiar el archivo: las páginas las comparte el sistema operativo
+    with pa.memory_map(os.path.join(RUTA_SNAPSHOTS, archivo)) as fuente:
+        df = pa.ipc.open_file(fuente).read_all().to_pandas()
+    if marca is not None and MARCAS_SINCRONIZACION.get(tabla) == "id":
+        marca = int(marca)
+    return {"sello": sello, "df": df, "marca": marca, "marca_baja": marca_baja}
+
+def publicar_snapshot(tabla, sello, snap):
+    # Archivo nuevo por versión: quien esté leyendo el anterior no ve un archivo a medio escribir
+    archivo = f"{tabla}-{uuid.uuid4().hex}.arrow"
+    datos = pa.Table.from_pandas(snap["df"], preserve_index=False)
+    with pa.OSFile(os.path.join(RUTA_SNAPSHOTS, archivo), "wb") as destino:
+        with pa.ipc.new_file(destino, datos.schema) as escritor:
+            escritor.write_table(datos)
+    alm = almacen_compartido()
+    with alm["candado"], alm["con"] as con:
+        anterior = con.execute("SELECT archivo FROM snapshots WHERE tabla = ?", (tabla,)).fetchone()
+        con.execute(
+            "INSERT OR REPLACE INTO snapshots (tabla, sello, archivo, marca, marca_baja) VALUES (?, ?, ?, ?, ?)",
+            (tabla, sello, archivo, None if snap["marca"] is None else str(snap["marca"]), snap["marca_baja"])
+        )
+    if anterior:
+        try:
+            os.remove(os.path.join(RUTA_SNAPSHOTS, anterior[0]))
+        except OSError:
+            pass
+
+# --- SINCRONIZACIÓN INCREMENTAL ---
+# Marca de agua por tabla: "updated_at" si las filas se editan, "id" si solo se insertan
+# (columnas y triggers en sql/02_sincronizacion_incremental.sql)
+MARCAS_SINCRONIZACION = {
+    "prestamos": "updated_at",
+    "historial": "updated_at",
+    "movimientos_stock": "id",
+    "anulaciones": "id",
+    "bitacora_ediciones": "id",
+}
+# Se vuelve a pedir este margen antes de la marca por transacciones que confirman tarde
+MARGEN_SINCRONIZACION = pd.Timedelta(seconds=30)
+# Igual para las tablas por "id": un id menor puede confirmarse después de uno mayor
+MARGEN_IDS_SINCRONIZACION = 200
+
+COMPARADORES = {"eq": operator.eq, "gte": operator.ge, "lte": operator.le, "gt": operator.gt, "lt": operator.lt}
+
+@st.cache_resource
+def snapshots_tablas():
+    # Copia local por tabla, compartida por todas las sesiones (un candado por tabla)
+    return {"candados": {t: threading.Lock() for t in (*MARCAS_SINCRONIZACION, *TABLAS_COMPARTIDAS)}, "tablas": {}}
+
+def _ultima_baja(tabla):
+    res = supabase.table("eliminaciones").select("id").eq("tabla", tabla).order("id", desc=True).limit(1).execute()
+    return res.data[0]["id"] if res.data else 0
+
+def _bajas_desde(tabla, desde):
+    filtros = (("tabla", "eq", tabla), ("id", "gt", desde))
+    return [b for pagina in paginas_tabla("eliminaciones", ("id", "fila_id"), filtros) for b in pagina]
+
+def _sincronizar_delta(tabla, snap):
+    marca_col = MARCAS_SINCRONIZACION[tabla]
+    df = snap["df"]
+    marca_baja = snap["marca_baja"]
+    
+    # Bajas primero: lo que se borre durante la descarga se verá en la siguiente
+    if marca_col == "updated_at":
+        bajas = _bajas_desde(tabla, marca_baja)
+        if bajas:
+            marca_baja = bajas[-1]["id"]
+            df = df[~df["id"].isin([b["fila_id"] for b in bajas])]
+    
+    if marca_col == "updated_at":
+        desde = (pd.Timestamp(snap["marca"]) - MARGEN_SINCRONIZACION).isoformat()
+        delta = _descargar_tabla(tabla, filtros=((marca_col, "gte", desde),))
+    else:
+        desde = max(int(snap["marca"]) - MARGEN_IDS_SINCRONIZACION, 0)
+        delta = _descargar_tabla(tabla, filtros=((marca_col, "gt", desde),))
+    if not delta.empty:
+        # concat de categorías distintas vuelve a object: se reaplica el esquema
+        df = _aplicar_esquema(pd.concat([df[~df["id"].isin(delta["id"])], delta], ignore_index=True), tabla)
+    return df, marca_baja
+
+def _traer_tabla(tabla, snap):
+    # Solo lo nuevo/modificado desde "snap"; sin marca (o sin snap) se descarga completa
+    marca_col = MARCAS_SINCRONIZACION.get(tabla)
+    df = None
+    if snap is not None and snap["marca"] is not None:
+        try:
+            df, marca_baja = _sincronizar_delta(tabla, snap)
+        except Exception:
+            df = None
+    if df is None:
+        # Carga completa (primera vez, tabla vacía, sin migración aplicada o tabla sin marca)
+        try:
+            marca_baja = _ultima_baja(tabla) if marca_col == "updated_at" else 0
+        except Exception:
+            marca_baja = 0
+        df = _descargar_tabla(tabla)
+    
+    marca = df[marca_col].max() if marca_col in df.columns and not df.empty else None
+    return {"df": df, "marca": marca, "marca_baja": marca_baja}
+
+def _sincronizar_compartida(tabla, snap, clave):
+    # Si otro proceso ya publicó esta versión se usa su foto; si no, se trae desde la copia más
+    # reciente que haya (la propia o la publicada) y se publica para los demás
+    sello = _sello_snapshot(clave)
+    with candado_snapshot(tabla):
+        try:
+            foto = leer_snapshot(tabla)
+        except Exception as e:
+            logger_snapshots.warning("No se pudo leer la foto de %s: %s", tabla, e)
+            foto = None
+        if foto is not None and foto["sello"] == sello:
+            return foto
+        nuevo = _traer_tabla(tabla, snap if snap is not None else foto)
+        try:
+            publicar_snapshot(tabla, sello, nuevo)
+        except Exception as e:
+            logger_snapshots.warning("No se pudo publicar la foto de %s: %s", tabla, e)
+        return nuevo
+
+def sincronizar_tabla(tabla, version=None, ventana=None):
+    # Devuelve la copia local de la tabla trayendo solo lo nuevo/modificado desde la última vez.
+    # Con la misma versión y ventana de caché no se consulta a Supabase; las TABLAS_COMPARTIDAS
+    # pasan antes por el almacén común.
+    store = snapshots_tablas()
+    clave = (version, ventana)
+    with store["candados"][tabla]:
+        snap = store["tablas"].get(tabla)
+        if snap is not None and version is not None and snap["clave"] == clave:
+            return snap["df"]
+        if tabla in TABLAS_COMPARTIDAS and version is not None:
+            nuevo = _sincronizar_compartida(tabla, snap, clave)
+        else:
+            nuevo = _traer_tabla(tabla, snap)
+        store["tablas"][tabla] = {
+            "df": nuevo["df"], "marca": nuevo["marca"], "marca_baja": nuevo["marca_baja"], "clave": clave
+        }
+        return nuevo["df"]
+
+def _valor_comparable(valor, serie):
+    # Las fechas llegan como texto ISO; se comparan contra la columna ya convertida
+    if not pd.api.types.is_datetime64_any_dtype(serie): return valor
+    ts = pd.Timestamp(valor)
+    if serie.dt.tz is not None and ts.tzinfo is None: return ts.tz_localize("UTC")
+    if serie.dt.tz is None and ts.tzinfo is not None: return ts.tz_convert(None)
+    return ts
+
+def _filtrar_local(df, columnas, filtros, orden):
+    # Los mismos filtros/orden/columnas que cargar_tabla envía a PostgREST, sobre la copia local
+    if df.empty:
+        return pd.DataFrame(columns=list(columnas) if columnas else df.columns)
+    mascara = pd.Series(True, index=df.index)
+    for col, op, valor in filtros:
+        serie = df[col]
+        if op == "in":
+            mascara &= serie.isin([_valor_comparable(v, serie) for v in valor])
+        else:
+            mascara &= COMPARADORES[op](serie, _valor_comparable(valor, serie))
+    out = df[mascara]
+    if orden:
+        claves = [orden[0]] if orden[0] == "id" else [orden[0], "id"]
+        out = out.sort_values(claves, ascending=not orden[1])
+    else:
+        out = out.sort_values("id")
+    if columnas:
+        out = out[list(columnas)]
+    return out.reset_index(drop=True)
+
+# --- CLAVES MAESTRAS (cliente_id / producto_id) ---
+# Columna id -> (columna con el nombre, tabla maestra). El nombre se resuelve al leer.
+CLAVES_MAESTRAS = {
+    "cliente_id": ("cliente", "clientes"),
+    "producto_id": ("producto", "productos"),
+}
+# Tablas que referencian maestros por id (sql/03_claves_id.sql)
+REFERENCIAS_MAESTRAS = {
+    "prestamos": ("cliente_id", "producto_id"),
+    "historial": ("cliente_id", "producto_id"),
+    "stock_real": ("producto_id",),
+    "movimientos_stock": ("producto_id",),
+    "resumen_diario": ("cliente_id",),
+}
+
+@st.cache_resource(max_entries=8)
+def _mapas_maestro(tabla, version, ventana):
+    # Misma llave que cargar_tabla(tabla): se reusa la copia local (o la foto compartida)
+    df = sincronizar_tabla(tabla, (version,), ventana)
+    ids = {int(i): nombre for i, nombre in zip(df["id"], df["nombre"])} if not df.empty else {}
+    # Con nombres repetidos gana el id menor, igual que en la migración
+    nombres = {}
+    for id_m in sorted(ids, reverse=True):
+        nombres[ids[id_m]] = id_m
+    return ids, nombres
+
+def mapas_maestro(tabla):
+    # (id -> nombre, nombre -> id) de la versión vigente del maestro
+    ttl = TTL_TABLAS.get(tabla, TTL_DEFECTO)
+    return _mapas_maestro(tabla, versiones_tablas().get(tabla, 0), int(time.time() // ttl))
+
+def id_maestro(tabla, nombre):
+    return mapas_maestro(tabla)[1].get(nombre)
+
+def nombre_maestro(tabla, id_m):
+    return mapas_maestro(tabla)[0].get(int(id_m)) if pd.notnull(id_m) else None
+
+def resolver_nombres(df):
+    # Agrega "cliente" / "producto" a partir de cliente_id / producto_id
+    for col_id, (col_nombre, maestro) in CLAVES_MAESTRAS.items():
+        if col_id in df.columns:
+            df[col_nombre] = df[col_id].map(mapas_maestro(maestro)[0]).astype(CATEGORIA)
+    return df
+
+def _nombres_a_ids(tabla):
+    return {CLAVES_MAESTRAS[c][0]: c for c in REFERENCIAS_MAESTRAS.get(tabla, ())}
+
+def _columnas_base(tabla, columnas):
+    # Las columnas de nombre se piden a Supabase como su id
+    if not columnas: return columnas
+    nombres = _nombres_a_ids(tabla)
+    base = []
+    for col in columnas:
+        col = nombres.get(col, col)
+        if col not in base: base.append(col)
+    return tuple(base)
+
+def _filtros_base(tabla, filtros):
+    # Un filtro por nombre ("cliente", "eq", "Ana") se envía como filtro por id
+    nombres = _nombres_a_ids(tabla)
+    base = []
+    for col, op, valor in filtros:
+        if col in nombres:
+            a_id = mapas_maestro(CLAVES_MAESTRAS[nombres[col]][1])[1]
+            # Un nombre inexistente no debe coincidir con ninguna fila
+            valor = tuple(a_id.get(v, -1) for v in valor) if op == "in" else a_id.get(valor, -1)
+            col = nombres[col]
+        base.append((col, op, valor))
+    return tuple(base)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _leer_tabla(tabla, columnas, filtros, orden, version, ventana):
+    # "version" (de la tabla y sus maestros) y "ventana" solo forman parte de la llave del caché
+    cols_base, filtros_base = _columnas_base(tabla, columnas), _filtros_base(tabla, filtros)
+    if tabla in MARCAS_SINCRONIZACION or tabla in TABLAS_COMPARTIDAS:
+        df = _filtrar_local(sincronizar_tabla(tabla, version, ventana), cols_base, filtros_base, orden)
+    else:
+        df = _descargar_tabla(tabla, cols_base, filtros_base, orden)
+    df = resolver_nombres(df)
+    return df[list(columnas)] if columnas else df
+
 def insertar_registro(tabla, datos):
     try:
         response = supabase.table(tabla).insert(datos).execute()
+        invalidar_tablas(tabla)
+        if tabla in CAMPOS_BUSQUEDA:
+            for fila in response.data or []:
+                actualizar_busqueda(tabla, fila)
+        if tabla == "prestamos":
+            for fila in response.data or []:
+                actualizar_indice_deuda(
+                    fila["id"], fila.get("cantidad_pendiente", 0), fila.get("total_pendiente", 0),
+                    nombre_maestro("clientes", fila.get("cliente_id"))
+                )
         return response
     except Exception as e:
         st.error(f"Error guardando en {tabla}: {e}")
         return None
 
-def cargar_tabla(tabla):
+# --- LECTURAS COMPARTIDAS DEL RERUN ---
+# Dentro de una ejecución, pedidos idénticos (tabla, columnas, filtros, orden y versión) se
+# resuelven con una sola lectura, aunque lleguen a la vez desde varios hilos. Una escritura sube
+# la versión, así que lo leído después ya usa otra llave. El alcance se descarta al terminar el rerun.
+
+def iniciar_lecturas_rerun():
+    st.session_state["_lecturas_rerun"] = {"candado": threading.Lock(), "pedidos": {}}
+
+def cerrar_lecturas_rerun():
+    st.session_state.pop("_lecturas_rerun", None)
+
+def _lectura_compartida(llave, leer):
+    # Devuelve (df, compartida). Cada llamador recibe su propia vista: agregar columnas no afecta a los demás
+    alcance = st.session_state.get("_lecturas_rerun") if get_script_run_ctx() else None
+    if alcance is None: return leer(), False
+    with alcance["candado"]:
+        futuro = alcance["pedidos"].get(llave)
+        compartida = futuro is not None
+        if not compartida:
+            futuro = alcance["pedidos"][llave] = Future()
+    if not compartida:
+        try:
+            futuro.set_result(leer())
+        except Exception as e:
+            # Un fallo no se comparte: el próximo pedido vuelve a intentar
+            with alcance["candado"]:
+                alcance["pedidos"].pop(llave, None)
+            futuro.set_exception(e)
+    return futuro.result().copy(deep=False), compartida
+
+def _version_tabla(tabla):
+    # Versión de la tabla y de los maestros cuyos nombres resuelve (parte de las llaves de caché)
+    versiones = versiones_tablas()
+    return (versiones.get(tabla, 0),) + tuple(
+        versiones.get(CLAVES_MAESTRAS[c][1], 0) for c in REFERENCIAS_MAESTRAS.get(tabla, ())
+    )
+
+def _normalizar_filtros(filtros):
+    return tuple((col, op, tuple(v) if isinstance(v, list) else v) for col, op, v in (filtros or []))
+
+def leer_tabla(tabla, columnas=None, filtros=None, orden=None):
+    # Igual que cargar_tabla, pero un fallo se propaga: para quien no debe tomar una tabla vacía por buena
+    inicio = time.perf_counter()
+    df, compartida = pd.DataFrame(), False
     try:
-        response = supabase.table(tabla).select("*").execute()
-        df = pd.DataFrame(response.data)
-        
-        cols_fecha = ["fecha_registro", "fecha_evento", "fecha", "fecha_pedido", "fecha_llegada_estimada"]
-        for col in cols_fecha:
-            if col in df.columns:
-                df[col] = pd.to_datetime(df[col], errors='coerce')
-        
-        if "created_at" in df.columns:
-            df = df.drop(columns=["created_at"])
-            
-        return df
+        ttl = TTL_TABLAS.get(tabla, TTL_DEFECTO)
+        llave = (
+            tabla, tuple(columnas) if columnas else None, _normalizar_filtros(filtros), tuple(orden) if orden else None,
+            _version_tabla(tabla), int(time.time() // ttl)
+        )
+        df, compartida = _lectura_compartida(llave, lambda: _leer_tabla(*llave))
+    finally:
+        registrar_llamada("cargar_tabla", tabla, "compartida" if compartida else "select", len(df), 0, time.perf_counter() - inicio)
+    return df
+
+def cargar_tabla(tabla, columnas=None, filtros=None, orden=None):
+    # columnas: lista de columnas | filtros: [(col, "gt", 0), ...] | orden: (col, descendente)
+    try:
+        return leer_tabla(tabla, columnas, filtros, orden)
     except:
         return pd.DataFrame()
 
+# --- LISTAS PAGINADAS POR CURSOR (KEYSET) ---
+# "Lo último primero" sin descargar la tabla: order by <col> desc, id desc limit N, y la página
+# siguiente empieza justo después de la última fila vista. Cada página cuesta lo mismo
+# con diez mil o diez millones de filas (requiere un índice sobre (<col>, id)).
+TAMANO_PAGINA_LISTA = int(st.secrets.get("TAMANO_PAGINA_LISTA", 20))
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def _pagina_cursor(tabla, columnas, filtros, col_orden, cursor, limite, version, ventana):
+    cols_base = _columnas_base(tabla, columnas)
+    if cols_base:
+        cols_base = tuple(dict.fromkeys(cols_base + (col_orden, "id")))
+    query = _consulta_tabla(tabla, cols_base, _filtros_base(tabla, filtros), (col_orden, True))
+    if cursor:
+        valor, id_cursor = cursor
+        if valor is None:
+            # En orden descendente los nulos van primero: sigue el resto de nulos y después todo lo demás
+            query = query.or_(f"and({col_orden}.is.null,id.lt.{id_cursor}),{col_orden}.not.is.null")
+        else:
+            query = query.or_(f'{col_orden}.lt."{valor}",and({col_orden}.eq."{valor}",id.lt.{id_cursor})')
+    filas = query.limit(limite + 1).execute().data
+    # Se pide una fila de más solo para saber si hay otra página
+    siguiente = (filas[limite - 1][col_orden], filas[limite - 1]["id"]) if len(filas) > limite else None
+    df = resolver_nombres(_preparar_tabla(pd.DataFrame(filas[:limite], columns=list(cols_base) if cols_base else None), tabla))
+    return (df[list(columnas)] if columnas else df), siguiente
+
+def lista_paginada(clave, tabla, columnas, filtros=None, col_orden="fecha_evento", limite=None):
+    # Devuelve (filas de las páginas abiertas, hay_mas). Cambiar los filtros vuelve a la primera página
+    limite = limite or TAMANO_PAGINA_LISTA
+    filtros = _normalizar_filtros(filtros)
+    estado = st.session_state.get(clave)
+    if not estado or estado["filtros"] != filtros:
+        estado = st.session_state[clave] = {"filtros": filtros, "paginas": 1}
+    ttl = TTL_TABLAS.get(tabla, TTL_DEFECTO)
+    version, ventana = _version_tabla(tabla), int(time.time() // ttl)
+    partes, cursor = [], None
+    for _ in range(estado["paginas"]):
+        try:
+            df, cursor = _pagina_cursor(tabla, tuple(columnas), filtros, col_orden, cursor, limite, version, ventana)
+        except Exception as e:
+            # Se muestra lo que ya se cargó; la página que falló se vuelve a pedir en el próximo rerun
+            st.error(f"Error cargando {tabla}: {e}")
+            if not partes: return pd.DataFrame(columns=list(columnas)), False
+            return pd.concat(partes, ignore_index=True), False
+        partes.append(df)
+        if cursor is None: break
+    return pd.concat(partes, ignore_index=True), cursor is not None
+
+def boton_cargar_mas(clave):
+    if st.button("⬇️ Cargar más", key=f"mas_{clave}"):
+        st.session_state[clave]["paginas"] += 1
+        st.rerun()
+
+# Descargas simultáneas como máximo al cargar varias tablas a la vez
+HILOS_CARGA = int(st.secrets.get("HILOS_CARGA", 4))
+
+def cargar_tablas(tablas, max_hilos=None):
+    # Descarga varias tablas en paralelo: se espera solo a la más lenta
+    ctx = get_script_run_ctx()
+    def _cargar(tabla):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return cargar_tabla(tabla)
+    with ThreadPoolExecutor(max_workers=max_hilos or HILOS_CARGA) as pool:
+        return dict(zip(tablas, pool.map(_cargar, tablas)))
+
 def actualizar_prestamo(id_p, cant, total):
     try:
         supabase.table("prestamos").update({
             "cantidad_pendiente": cant, 
             "total_pendiente": total
         }).eq("id", id_p).execute()
+        invalidar_tablas("prestamos")
+        actualizar_indice_deuda(id_p, cant, total)
     except Exception as e:
         st.error(f"Error actualizando préstamo: {e}")
 
+# --- ÍNDICE DE DEUDAS POR CLIENTE ---
+# cliente -> deuda pendiente y cliente -> préstamos abiertos, mantenido por las escrituras.
+# Se reconstruye cuando otro proceso cambia la versión de sus tablas (refrescar_versiones),
+# y cada TTL de "prestamos" como respaldo.
+TABLAS_INDICE_DEUDAS = ("prestamos", "clientes")
+
+logger_deudas = logging.getLogger("koriel.deudas")
+
+@st.cache_resource
+def _indice_deudas():
+    # "cambios" cuenta las escrituras aplicadas, para no pisarlas con una lectura anterior a ellas
+    # "versiones": las de TABLAS_INDICE_DEUDAS con que se armó
+    return {
+        "candado": threading.RLock(), "vence": 0, "cambios": 0, "versiones": {},
+        "saldos": {}, "deuda": {}, "abiertos": {},
+    }
+
+def _aplicar_saldo(idx, id_p, cant, total, cliente=None):
+    id_p = int(id_p)
+    if id_p in idx["saldos"]:
+        cli_ant, total_ant = idx["saldos"].pop(id_p)
+        idx["deuda"][cli_ant] = round(idx["deuda"].get(cli_ant, 0) - total_ant, 2)
+        idx["abiertos"].get(cli_ant, set()).discard(id_p)
+        if not idx["abiertos"].get(cli_ant):
+            idx["abiertos"].pop(cli_ant, None)
+            idx["deuda"].pop(cli_ant, None)
+        cliente = cliente or cli_ant
+    if cliente is None:
+        # Préstamo desconocido para el índice: mejor reconstruir que adivinar
+        idx["vence"] = 0
+        return
+    if cant > 0:
+        idx["saldos"][id_p] = (cliente, float(total))
+        idx["deuda"][cliente] = round(idx["deuda"].get(cliente, 0) + float(total), 2)
+        idx["abiertos"].setdefault(cliente, set()).add(id_p)
+
+def indice_deudas():
+    idx = _indice_deudas()
+    versiones = _versiones_de(TABLAS_INDICE_DEUDAS)
+    if time.time() < idx["vence"] and idx["versiones"] == versiones: return idx
+    cambios = idx["cambios"]
+    # La lectura va fuera del candado: las escrituras no esperan a la red
+    try:
+        df = leer_tabla("prestamos", ["id", "cliente", "cantidad_pendiente", "total_pendiente"], [("cantidad_pendiente", "gt", 0)])
+        # Lo que sigue en la cola local todavía no está en Supabase
+        df = superponer_cola(df)
+    except Exception as e:
+        # Se sigue con el índice que había (o ninguno) y se reintenta en el próximo pedido
+        logger_deudas.warning("No se pudo reconstruir el índice de deudas: %s", e)
+        return idx
+    nuevo = {"saldos": {}, "deuda": {}, "abiertos": {}}
+    for id_p, cliente, cant, total in df.itertuples(index=False):
+        _aplicar_saldo(nuevo, id_p, cant, total, cliente)
+    with idx["candado"]:
+        # Si hubo escrituras durante la lectura, esta ya puede estar vieja: se vuelve a leer la próxima vez
+        if idx["cambios"] == cambios:
+            idx["saldos"], idx["deuda"], idx["abiertos"] = nuevo["saldos"], nuevo["deuda"], nuevo["abiertos"]
+            idx["versiones"] = versiones
+            idx["vence"] = time.time() + TTL_TABLAS["prestamos"]
+    return idx
+
+def actualizar_indice_deuda(id_p, cant, total, cliente=None):
+    # Llamar después de cada escritura sobre un préstamo
+    idx = _indice_deudas()
+    with idx["candado"]:
+        idx["cambios"] += 1
+        if idx["vence"]:
+            _aplicar_saldo(idx, id_p, cant, total, cliente)
+
+def invalidar_indice_deudas(vencer=True):
+    # Una reconstrucción ya en curso no se guarda; con "vencer" se rehace en el próximo pedido
+    idx = _indice_deudas()
+    with idx["candado"]:
+        idx["cambios"] += 1
+        if vencer:
+            idx["vence"] = 0
+
+def renombrar_cliente_indice(nombre_anterior, nuevo_nombre):
+    idx = _indice_deudas()
+    with idx["candado"]:
+        idx["cambios"] += 1
+        for id_p, (cliente, total) in list(idx["saldos"].items()):
+            if cliente == nombre_anterior:
+                _aplicar_saldo(idx, id_p, 1, total, nuevo_nombre)
+
+def deuda_cliente(cliente):
+    return indice_deudas()["deuda"].get(cliente, 0.0)
+
+def clientes_con_deuda():
+    return sorted(indice_deudas()["deuda"])
+
+def prestamos_abiertos(cliente):
+    return sorted(indice_deudas()["abiertos"].get(cliente, ()))
+
+# --- BÚSQUEDA DE CLIENTES Y PRODUCTOS ---
+# Índice por prefijos y trigramas de palabras: clientes por nombre, tienda y RUC; productos por
+# nombre y categoría. Los selectores muestran solo los primeros resultados de lo escrito, no el
+# catálogo entero. Lo mantienen insertar_registro/editar_*_global; se reconstruye cuando otro
+# proceso cambia la versión de la tabla, y cada TTL como respaldo.
+CAMPOS_BUSQUEDA = {"clientes": ("nombre", "tienda", "ruc1", "ruc2"), "productos": ("nombre", "categoria")}
+PISTAS_BUSQUEDA = {"clientes": "Nombre, tienda o RUC", "productos": "Nombre o categoría"}
+RESULTADOS_BUSQUEDA = int(st.secrets.get("RESULTADOS_BUSQUEDA", 50))
+
+logger_busqueda = logging.getLogger("koriel.busqueda")
+
+def _normalizar_busqueda(texto):
+    # Minúsculas y sin tildes: "Eléctrica Ñaña" -> "electrica nana"
+    if texto is None or (not isinstance(texto, str) and pd.isna(texto)): return ""
+    return unicodedata.normalize("NFKD", str(texto)).encode("ascii", "ignore").decode().lower()
+
+def _trigramas(palabra):
+    return {palabra[i:i + 3] for i in range(len(palabra) - 2)}
+
+def _claves_busqueda(campos):
+    # Prefijos de 1 y 2 letras (búsquedas cortas) y trigramas (el resto) de cada palabra
+    claves = set()
+    for palabra in " ".join(campos).split():
+        claves.update((palabra[:1], palabra[:2]))
+        claves.update(_trigramas(palabra))
+    return claves
+
+@st.cache_resource
+def _indice_busqueda(tabla):
+    # registros: id -> (nombre, campos normalizados, texto, fila) | claves: prefijo/trigrama -> ids
+    # nombres: (nombre normalizado, id) ordenados, para buscar por inicio del nombre con bisect
+    # "cambios" y "versiones" como en _indice_deudas
+    return {
+        "candado": threading.RLock(), "vence": 0, "cambios": 0, "versiones": {},
+        "registros": {}, "claves": defaultdict(set), "nombres": [],
+    }
+
+def _indexar(idx, tabla, fila, ordenar=True):
+    id_r = int(fila["id"])
+    _desindexar(idx, id_r)
+    campos = [_normalizar_busqueda(fila.get(c)) for c in CAMPOS_BUSQUEDA[tabla]]
+    nombre = fila.get("nombre")
+    if not isinstance(nombre, str) or not nombre: return
+    idx["registros"][id_r] = (nombre, campos, " ".join(campos), fila)
+    for clave in _claves_busqueda(campos):
+        idx["claves"][clave].add(id_r)
+    if ordenar: bisect.insort(idx["nombres"], (campos[0], id_r))
+    else: idx["nombres"].append((campos[0], id_r))
+
+def _desindexar(idx, id_r):
+    anterior = idx["registros"].pop(id_r, None)
+    if anterior:
+        for clave in _claves_busqueda(anterior[1]):
+            idx["claves"][clave].discard(id_r)
+        i = bisect.bisect_left(idx["nombres"], (anterior[1][0], id_r))
+        if i < len(idx["nombres"]) and idx["nombres"][i] == (anterior[1][0], id_r):
+            del idx["nombres"][i]
+
+def indice_busqueda(tabla):
+    idx = _indice_busqueda(tabla)
+    versiones = _versiones_de((tabla,))
+    if time.time() < idx["vence"] and idx["versiones"] == versiones: return idx
+    cambios = idx["cambios"]
+    # Lectura y armado fuera del candado: las búsquedas de las demás sesiones no esperan a la red
+    try:
+        df = leer_tabla(tabla)
+    except Exception as e:
+        # Se sigue con el índice que había (o ninguno) y se reintenta en el próximo pedido
+        logger_busqueda.warning("No se pudo reconstruir el índice de %s: %s", tabla, e)
+        return idx
+    # reindex: una tabla vacía puede llegar sin columnas
+    df = df.reindex(columns=["id"] + [c for c in CAMPOS_BUSQUEDA[tabla] if c in df.columns])
+    nuevo = {"registros": {}, "claves": defaultdict(set), "nombres": []}
+    for fila in df.to_dict("records"):
+        _indexar(nuevo, tabla, fila, ordenar=False)
+    nuevo["nombres"].sort()
+    with idx["candado"]:
+        # Si hubo escrituras durante la lectura, esta ya puede estar vieja: se vuelve a leer la próxima vez
+        if idx["cambios"] == cambios:
+            idx["registros"], idx["claves"], idx["nombres"] = nuevo["registros"], nuevo["claves"], nuevo["nombres"]
+            idx["versiones"] = versiones
+            idx["vence"] = time.time() + TTL_TABLAS[tabla]
+    return idx
+
+def _indices_de(tabla):
+    # Índices en memoria que dependen de "tabla" (ver invalidar_tablas)
+    if tabla in TABLAS_INDICE_DEUDAS: yield _indice_deudas()
+    if tabla in CAMPOS_BUSQUEDA: yield _indice_busqueda(tabla)
+
+def actualizar_busqueda(tabla, fila):
+    # Llamar después de crear o editar un cliente/producto (fila: id + columnas nuevas)
+    idx = _indice_busqueda(tabla)
+    with idx["candado"]:
+        idx["cambios"] += 1
+        if idx["vence"]:
+            anterior = idx["registros"].get(int(fila["id"]))
+            _indexar(idx, tabla, {**(anterior[3] if anterior else {}), **fila})
+
+def _rango_busqueda(campos, palabras):
+    # Después de los nombres que empiezan con lo escrito: palabras del nombre, nombre, resto de campos
+    nombre = campos[0]
+    if all(any(p.startswith(t) for p in nombre.split()) for t in palabras): return 2
+    if all(t in nombre for t in palabras): return 3
+    return 4
+
+def buscar_maestro(tabla, consulta, limite=None, por_id=False):
+    # Nombres (o ids) que contienen todas las palabras escritas, los mejores primero
+    limite = limite or RESULTADOS_BUSQUEDA
+    idx = indice_busqueda(tabla)
+    palabras = _normalizar_busqueda(consulta).split()
+    consulta = " ".join(palabras)
+    with idx["candado"]:
+        # 1. Nombres que empiezan con lo escrito (sin consulta: los primeros en orden alfabético)
+        nombres, registros = idx["nombres"], idx["registros"]
+        ids = []
+        i = bisect.bisect_left(nombres, (consulta,))
+        while i < len(nombres) and len(ids) < limite and nombres[i][0].startswith(consulta):
+            ids.append(nombres[i][1])
+            i += 1
+        if len(ids) < limite and palabras:
+            # 2. El resto, por prefijos/trigramas de cada palabra (primero el conjunto más chico)
+            conjuntos = [
+                idx["claves"].get(c, set())
+                for palabra in palabras
+                for c in ([palabra] if len(palabra) <= 2 else _trigramas(palabra))
+            ]
+            candidatos = set.intersection(*sorted(conjuntos, key=len)) - set(ids)
+            puntuados = []
+            for id_r in candidatos:
+                _, campos, texto, _ = registros[id_r]
+                # Los trigramas solo descartan: se confirma que cada palabra esté en el texto
+                if all(p in texto for p in palabras):
+                    puntuados.append((_rango_busqueda(campos, palabras), campos[0], id_r))
+            ids += [id_r for _, _, id_r in heapq.nsmallest(limite - len(ids), puntuados)]
+        if por_id: return ids
+        return list(dict.fromkeys(registros[id_r][0] for id_r in ids))
+
+def nombre_busqueda(tabla, id_r):
+    # Nombre con que el índice de búsqueda conoce al registro
+    idx = _indice_busqueda(tabla)
+    with idx["candado"]:
+        registro = idx["registros"].get(id_r)
+    return registro[0] if registro else f"#{id_r}"
+
+def fila_por_id(df, id_r):
+    # Fila del id elegido en un selector (vacía si la tabla cargada no la tiene); None si no se eligió nada
+    if id_r is None: return None
+    if "id" not in df.columns: return df.iloc[0:0]
+    return df[df["id"] == id_r]
+
+def selector_maestro(etiqueta, tabla, key, extra=(), multiple=False, por_id=False):
+    # Caja de búsqueda + lista con los primeros resultados: el navegador no recibe el catálogo entero.
+    # Con "por_id" devuelve el id elegido (el nombre puede cambiar desde otro proceso)
+    consulta = st.text_input(etiqueta, key=f"{key}_buscar", placeholder=PISTAS_BUSQUEDA[tabla])
+    encontrados = buscar_maestro(tabla, consulta, por_id=por_id)
+    if por_id:
+        # Nombres tomados ahora: la etiqueta no depende de cómo esté el índice al volver a dibujar
+        nombres = {id_r: nombre_busqueda(tabla, id_r) for id_r in encontrados}
+        return st.selectbox(
+            etiqueta, list(extra) + encontrados, key=key, label_visibility="collapsed",
+            format_func=lambda v: nombres.get(v, v if v in extra else f"#{v}")
+        )
+    if multiple:
+        # Lo ya elegido sigue entre las opciones aunque cambie la búsqueda
+        elegidos = st.session_state.get(key, [])
+        return st.multiselect(etiqueta, list(dict.fromkeys(elegidos + encontrados)), key=key, label_visibility="collapsed")
+    return st.selectbox(etiqueta, list(extra) + encontrados, key=key, label_visibility="collapsed")
+
+# --- LIQUIDACIÓN EN LOTE (COBROS / DEVOLUCIONES) ---
+
+COLUMNAS_PRESTAMO = ["id", "fecha_registro", "usuario", "cliente_id", "producto_id", "cantidad_pendiente", "precio_unitario", "total_pendiente", "observaciones"]
+
+def _valor_json(valor):
+    # Convierte tipos de pandas/numpy a tipos que acepta la API
+    if isinstance(valor, pd.Timestamp): return valor.isoformat()
+    if pd.isna(valor): return None
+    if hasattr(valor, "item"): return valor.item()
+    return valor
+
+def fila_prestamo(r, cant):
+    # Supabase solo usa id y "liquidado" (lo que se descuenta): una corrección hecha mientras tanto
+    # no se pisa. El nuevo saldo es para el índice y la superposición local hasta que se sincronice
+    return {
+        "id": int(r["id"]),
+        "cliente_id": _valor_json(r.get("cliente_id")),
+        "liquidado": int(r["cantidad_pendiente"]) - int(cant),
+        "cantidad_pendiente": int(cant),
+        "total_pendiente": float(cant * r["precio_unitario"]),
+    }
+
+def liquidar_prestamos(eventos, saldos):
+    # eventos: filas nuevas de historial | saldos: préstamos con su nuevo saldo
+    # No espera a Supabase: la liquidación queda en la cola local y el índice de deudas se actualiza ya
+    if not eventos and not saldos: return True
+    try:
+        encolar_liquidacion(eventos, saldos)
+    except Exception as e:
+        st.error(f"Error guardando la liquidación, no se registró ningún movimiento: {e}")
+        return False
+    for fila in saldos:
+        actualizar_indice_deuda(
+            fila["id"], fila["cantidad_pendiente"], fila["total_pendiente"],
+            nombre_maestro("clientes", fila.get("cliente_id"))
+        )
+    return True
+
+# --- COLA LOCAL DE LIQUIDACIONES ---
+# Los cobros/devoluciones se escriben primero en un SQLite local y un hilo los envía a Supabase
+# por lotes. Cada liquidación lleva un uuid: reenviarla no la duplica (sql/06_cola_liquidaciones.sql).
+# Estados: pendiente -> sincronizado | error (rechazada por Supabase, se reintenta a mano)
+RUTA_COLA = st.secrets.get("RUTA_COLA", "cola_koriel.db")
+LOTE_COLA = int(st.secrets.get("LOTE_COLA", 20))
+ESPERA_COLA = float(st.secrets.get("ESPERA_COLA", 2))
+ESPERA_MAX_COLA = 300
+INTENTOS_COLA = 5
+DIAS_HISTORIAL_COLA = 7
+
+logger_cola = logging.getLogger("koriel.cola")
+
+@st.cache_resource
+def cola_liquidaciones():
+    con = sqlite3.connect(RUTA_COLA, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS cola (id INTEGER PRIMARY KEY AUTOINCREMENT, lote TEXT UNIQUE, usuario TEXT, "
+        "creado TEXT, eventos TEXT, saldos TEXT, estado TEXT, intentos INTEGER DEFAULT 0, error TEXT, sincronizado TEXT)"
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS cola_estado ON cola (estado, id)")
+    # Lo ya sincronizado solo se guarda unos días, para el resumen
+    limite = (datetime.now() - timedelta(days=DIAS_HISTORIAL_COLA)).isoformat()
+    con.execute("DELETE FROM cola WHERE estado = 'sincronizado' AND sincronizado < ?", (limite,))
+    con.execute("DELETE FROM cola WHERE estado = 'descartado' AND creado < ?", (limite,))
+    con.commit()
+    cola = {"con": con, "candado": threading.Lock(), "despertar": threading.Event()}
+    threading.Thread(target=_vaciar_cola_continuo, args=(cola,), name="cola_liquidaciones", daemon=True).start()
+    return cola
+
+def encolar_liquidacion(eventos, saldos):
+    cola = cola_liquidaciones()
+    usuario = eventos[0].get("usuario_responsable") if eventos else None
+    with cola["candado"]:
+        cola["con"].execute(
+            "INSERT INTO cola (lote, usuario, creado, eventos, saldos, estado) VALUES (?, ?, ?, ?, ?, 'pendiente')",
+            (str(uuid.uuid4()), usuario, datetime.now().isoformat(), json.dumps(eventos), json.dumps(saldos))
+        )
+        cola["con"].commit()
+    cola["despertar"].set()
+
+def vaciar_cola(cola, limite=None):
+    # Envía las liquidaciones pendientes más antiguas en una sola llamada. Devuelve cuántas se enviaron
+    with cola["candado"]:
+        filas = cola["con"].execute(
+            "SELECT id, lote, usuario, eventos, saldos FROM cola WHERE estado = 'pendiente' ORDER BY id LIMIT ?",
+            (limite or LOTE_COLA,)
+        ).fetchall()
+    if not filas: return 0
+    lotes = [
+        {"lote": lote, "usuario": usuario, "eventos": json.loads(eventos), "saldos": json.loads(saldos)}
+        for _, lote, usuario, eventos, saldos in filas
+    ]
+    try:
+        supabase.rpc("registrar_liquidaciones", {"p_lotes": lotes}).execute()
+    except Exception as e:
+        # Solo cuenta como intento si Supabase respondió y la rechazó; un corte de red se reintenta sin límite
+        rechazo = isinstance(e, APIError) and len(filas) == 1
+        with cola["candado"]:
+            cola["con"].executemany(
+                "UPDATE cola SET intentos = intentos + ?, error = ?, "
+                "estado = CASE WHEN intentos + ? >= ? THEN 'error' ELSE estado END WHERE id = ?",
+                [(int(rechazo), getattr(e, "message", None) or str(e), int(rechazo), INTENTOS_COLA, id_c) for id_c, *_ in filas]
+            )
+            cola["con"].commit()
+            rechazadas = cola["con"].execute(
+                f"SELECT COUNT(*) FROM cola WHERE estado = 'error' AND id IN ({', '.join('?' for _ in filas)})",
+                [id_c for id_c, *_ in filas]
+            ).fetchone()[0]
+        if rechazadas:
+            # El índice ya tenía los saldos de la liquidación rechazada: vuelve a lo que dice Supabase
+            invalidar_indice_deudas()
+        raise
+    # Primero las versiones y luego la cola: una reconstrucción del índice que leyó la tabla vieja
+    # y ya no encuentra estas filas en la cola quedaría sin ellas, así que se descarta
+    invalidar_tablas("prestamos", "historial")
+    invalidar_indice_deudas(vencer=False)
+    ahora = datetime.now().isoformat()
+    with cola["candado"]:
+        cola["con"].executemany(
+            "UPDATE cola SET estado = 'sincronizado', sincronizado = ?, error = NULL WHERE id = ?",
+            [(ahora, id_c) for id_c, *_ in filas]
+        )
+        cola["con"].commit()
+    return len(filas)
+
+def _vaciar_cola_continuo(cola):
+    espera, limite = ESPERA_COLA, LOTE_COLA
+    while True:
+        cola["despertar"].wait(espera)
+        cola["despertar"].clear()
+        try:
+            enviadas = vaciar_cola(cola, limite)
+            # Si el lote salió lleno puede quedar más: seguir sin esperar
+            espera, limite = (0 if enviadas == limite else ESPERA_COLA), LOTE_COLA
+        except Exception as e:
+            # Reintento exponencial, de a una para que una liquidación rechazada no frene a las demás
+            espera, limite = min(max(espera, 1) * 2, ESPERA_MAX_COLA), 1
+            logger_cola.warning("No se pudo sincronizar la cola (reintento en %ss): %s", espera, e)
+
+def estado_cola():
+    # Cantidad por estado; las sincronizadas solo cuentan las de hoy
+    cola = cola_liquidaciones()
+    hoy = date.today().isoformat()
+    with cola["candado"]:
+        filas = cola["con"].execute(
+            "SELECT estado, COUNT(*) FROM cola WHERE estado != 'sincronizado' OR sincronizado >= ? GROUP BY estado", (hoy,)
+        ).fetchall()
+    return {"pendiente": 0, "sincronizado": 0, "error": 0, **dict(filas)}
+
+def liquidaciones_rechazadas():
+    # Las que Supabase rechazó ('error'): quién, a qué cliente, cuánto y por qué
+    cola = cola_liquidaciones()
+    with cola["candado"]:
+        filas = cola["con"].execute(
+            "SELECT id, usuario, creado, eventos, error FROM cola WHERE estado = 'error' ORDER BY id"
+        ).fetchall()
+    rechazadas = []
+    for id_c, usuario, creado, eventos, error in filas:
+        eventos = json.loads(eventos)
+        clientes = {nombre_maestro("clientes", ev.get("cliente_id")) or f"#{ev.get('cliente_id')}" for ev in eventos}
+        rechazadas.append({
+            "id": id_c, "usuario": usuario, "creado": creado, "error": error,
+            "cliente": ", ".join(sorted(clientes)),
+            "cobrado": sum(float(ev.get("monto_operacion") or 0) for ev in eventos if ev.get("tipo") == "COBRO"),
+            "unidades": sum(int(ev.get("cantidad") or 0) for ev in eventos),
+        })
+    return rechazadas
+
+def reintentar_liquidacion(id_c):
+    cola = cola_liquidaciones()
+    with cola["candado"]:
+        cola["con"].execute("UPDATE cola SET estado = 'pendiente', intentos = 0 WHERE id = ? AND estado = 'error'", (id_c,))
+        cola["con"].commit()
+    invalidar_indice_deudas()
+    cola["despertar"].set()
+
+def descartar_liquidacion(id_c):
+    # No se envía más: el cobro hay que volver a registrarlo a mano. Queda unos días en la cola local
+    cola = cola_liquidaciones()
+    with cola["candado"]:
+        cola["con"].execute("UPDATE cola SET estado = 'descartado' WHERE id = ? AND estado = 'error'", (id_c,))
+        cola["con"].commit()
+
+def saldos_en_cola():
+    # id de préstamo -> (cantidad, total) de las liquidaciones que Supabase aún no tiene; la última gana.
+    # Las rechazadas ('error') no: Supabase conserva la deuda y la app tiene que mostrarla
+    cola = cola_liquidaciones()
+    with cola["candado"]:
+        filas = cola["con"].execute("SELECT saldos FROM cola WHERE estado = 'pendiente' ORDER BY id").fetchall()
+    saldos = {}
+    for (texto,) in filas:
+        for fila in json.loads(texto):
+            saldos[int(fila["id"])] = (fila["cantidad_pendiente"], fila["total_pendiente"])
+    return saldos
+
+def superponer_cola(df):
+    # Una lectura de prestamos con los saldos que todavía están en la cola
+    saldos = saldos_en_cola()
+    if not saldos or df.empty: return df
+    df = df.copy()
+    en_cola = df["id"].isin(saldos)
+    for i, col in enumerate(["cantidad_pendiente", "total_pendiente"]):
+        if col in df.columns:
+            df.loc[en_cola, col] = df.loc[en_cola, "id"].map(lambda id_p: saldos[id_p][i]).astype(df[col].dtype)
+    return df
+
+@st.fragment(run_every=5)
+def panel_cola():
+    estado = estado_cola()
+    st.caption(f"🕓 {estado['pendiente']} por sincronizar · ✅ {estado['sincronizado']} sincronizadas hoy")
+    if not estado["error"]: return
+    st.error(f"⚠️ {estado['error']} liquidación(es) rechazada(s) por Supabase: esos cobros NO quedaron registrados.")
+    for r in liquidaciones_rechazadas():
+        c_info, c_reintentar, c_descartar = st.columns([4, 1, 1])
+        c_info.markdown(
+            f"👤 **{r['cliente']}** · 💵 ${r['cobrado']:,.2f} · {r['unidades']} u. · {r['usuario']} {str(r['creado'])[:16].replace('T', ' ')}  \n"
+            f"❌ {r['error']}"
+        )
+        if c_reintentar.button("Reintentar", key=f"reintentar_liq_{r['id']}"):
+            reintentar_liquidacion(r["id"]); st.rerun()
+        if c_descartar.button("Descartar", key=f"descartar_liq_{r['id']}"):
+            descartar_liquidacion(r["id"]); st.rerun()
+
 def actualizar_estado_importacion(id_imp, nuevo_estado):
     try:
         supabase.table("importaciones").update({"estado": nuevo_estado}).eq("id", id_imp).execute()
+        invalidar_tablas("importaciones")
         return True
     except Exception as e:
         st.error(f"Error actualizando estado: {e}")
         return False
 
+# --- RESPALDO COMPLETO (ZIP) ---
+# Tabla -> columnas renombradas en el CSV (formato "Excel limpio")
+TABLAS_RESPALDO = {
+    "clientes": {"nombre": "Cliente", "ruc1": "RUC"},
+    "productos": {"nombre": "Producto"},
+    "prestamos": {"cliente": "Cliente", "total_pendiente": "Deuda"},
+    "historial": {"fecha_evento": "Fecha", "monto_operacion": "Monto"},
+    "stock_real": {"cantidad": "Stock"},
+    "movimientos_stock": {"tipo": "Tipo"},
+    "importaciones": {"codigo_pedido": "PO"},
+}
+
+def generar_respaldo(formato="csv"):
+    # Arma el ZIP página a página en un archivo temporal: ninguna tabla se carga entera en memoria.
+    # CSV: un archivo por tabla | Parquet: un archivo por página (tabla/parte-00000.parquet)
+    # Devuelve los bytes del ZIP (st.download_button no acepta objetos de archivo)
+    with tempfile.TemporaryFile() as archivo:
+        _escribir_respaldo(archivo, formato)
+        archivo.seek(0)
+        return archivo.read()
+
+def _escribir_respaldo(archivo, formato):
+    manifiesto = {"generado": datetime.now().isoformat(), "formato": formato, "tablas": {}}
+    with zipfile.ZipFile(archivo, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for tabla, renombres in TABLAS_RESPALDO.items():
+            info = {"filas": 0, "archivos": []}
+            if formato == "csv":
+                nombre = f"{tabla}.csv"
+                sha = hashlib.sha256()
+                with zf.open(nombre, "w", force_zip64=True) as destino:
+                    for i, pagina in enumerate(paginas_tabla(tabla)):
+                        # El CSV es para leer en Excel: lleva los nombres además de los ids
+                        df = resolver_nombres(_preparar_tabla(pd.DataFrame(pagina), tabla)).rename(columns=renombres)
+                        bloque = df.to_csv(index=False, header=(i == 0)).encode("utf-8")
+                        destino.write(bloque)
+                        sha.update(bloque)
+                        info["filas"] += len(df)
+                info["archivos"].append({"nombre": nombre, "filas": info["filas"], "sha256": sha.hexdigest()})
+            else:
+                for i, pagina in enumerate(paginas_tabla(tabla)):
+                    nombre = f"{tabla}/parte-{i:05d}.parquet"
+                    buffer = io.BytesIO()
+                    _preparar_tabla(pd.DataFrame(pagina), tabla).to_parquet(buffer, index=False)
+                    bloque = buffer.getvalue()
+                    zf.writestr(nombre, bloque)
+                    info["filas"] += len(pagina)
+                    info["archivos"].append({"nombre": nombre, "filas": len(pagina), "sha256": hashlib.sha256(bloque).hexdigest()})
+            manifiesto["tablas"][tabla] = info
+        zf.writestr("manifiesto.json", json.dumps(manifiesto, indent=2, ensure_ascii=False))
+
+# --- ESTADOS DE CUENTA (WHATSAPP) ---
+SEPARADOR_ESTADO = "----------------"
+
+def _lineas_estado(df):
+    # Una línea por préstamo, formateadas columna a columna (sin iterrows)
+    fecha = df["fecha_registro"].dt.strftime("%d/%m").fillna("")
+    total = df["total_pendiente"].map("${:,.2f}".format)
+    return " - " + fecha + " | " + df["producto"].astype(str) + " (x" + df["cantidad_pendiente"].astype(str) + "): " + total
+
+def _bloques_estado(df):
+    # Un solo groupby: cliente -> (líneas unidas, total), en el orden en que aparecen.
+    # observed: "cliente" es categoría y con pandas 2 saldrían también los clientes sin filas en df
+    grupos = df.assign(_linea=_lineas_estado(df)).groupby("cliente", sort=False, observed=True)
+    return grupos["_linea"].agg("\n".join), grupos["total_pendiente"].sum()
+
+def _encabezado_estado(fecha=None):
+    return f"*ESTADO DE CUENTA*\n📅 {(fecha or datetime.now()).strftime('%d/%m/%Y')}\n{SEPARADOR_ESTADO}\n"
+
+def estado_de_cuenta(df, fecha=None):
+    # Recibo único con todos los clientes de df
+    lineas, _ = _bloques_estado(df)
+    cuerpo = "".join(f"👤 {c}:\n{texto}\n" for c, texto in lineas.items())
+    return f"{_encabezado_estado(fecha)}{cuerpo}{SEPARADOR_ESTADO}\n*TOTAL: ${df['total_pendiente'].sum():,.2f}*"
+
+def estados_por_cliente(df, fecha=None):
+    # {cliente: texto}, un recibo independiente por cliente
+    if df.empty: return {}
+    encabezado = _encabezado_estado(fecha)
+    lineas, totales = _bloques_estado(df)
+    return {
+        c: f"{encabezado}👤 {c}:\n{texto}\n{SEPARADOR_ESTADO}\n*TOTAL: ${totales[c]:,.2f}*"
+        for c, texto in lineas.items()
+    }
+
+def zip_estados(estados):
+    # Un .txt por cliente; el prefijo numérico evita choques entre nombres parecidos
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for i, (cliente, texto) in enumerate(sorted(estados.items()), 1):
+            nombre = "".join(ch if ch.isalnum() or ch in " -_" else "_" for ch in str(cliente)).strip()
+            zf.writestr(f"{i:04d}_{nombre or 'cliente'}.txt", texto)
+    return buffer.getvalue()
+
 # --- FUNCIONES DE INTEGRIDAD ---
 
 def editar_cliente_global(id_row, datos_nuevos, nombre_anterior):
     try:
+        # Préstamos e historial apuntan a cliente_id: renombrar es una sola fila
         supabase.table("clientes").update(datos_nuevos).eq("id", id_row).execute()
+        invalidar_tablas("clientes")
+        actualizar_busqueda("clientes", {"id": id_row, **datos_nuevos})
         nuevo_nombre = datos_nuevos.get("nombre")
         if nuevo_nombre and nuevo_nombre != nombre_anterior:
-            supabase.table("prestamos").update({"cliente": nuevo_nombre}).eq("cliente", nombre_anterior).execute()
-            supabase.table("historial").update({"cliente": nuevo_nombre}).eq("cliente", nombre_anterior).execute()
+            renombrar_cliente_indice(nombre_anterior, nuevo_nombre)
         return True
     except Exception as e:
         st.error(f"Error editando cliente: {e}")
@@ -123,12 +1444,10 @@ def editar_cliente_global(id_row, datos_nuevos, nombre_anterior):
 
 def editar_producto_global(id_row, datos_nuevos, nombre_anterior):
     try:
+        # Préstamos, historial y stock apuntan a producto_id: renombrar es una sola fila
         supabase.table("productos").update(datos_nuevos).eq("id", id_row).execute()
-        nuevo_nombre = datos_nuevos.get("nombre")
-        if nuevo_nombre and nuevo_nombre != nombre_anterior:
-            supabase.table("prestamos").update({"producto": nuevo_nombre}).eq("producto", nombre_anterior).execute()
-            supabase.table("historial").update({"producto": nuevo_nombre}).eq("producto", nombre_anterior).execute()
-            supabase.table("stock_real").update({"producto": nuevo_nombre}).eq("producto", nombre_anterior).execute()
+        invalidar_tablas("productos")
+        actualizar_busqueda("productos", {"id": id_row, **datos_nuevos})
         return True
     except Exception as e:
         st.error(f"Error editando producto: {e}")
@@ -137,81 +1456,80 @@ def editar_producto_global(id_row, datos_nuevos, nombre_anterior):
 # --- FUNCIONES DE INVENTARIO ---
 
 def mover_inventario(almacen, producto, cantidad, tipo, usuario, motivo):
+    # Validación, ajuste de stock y registro en movimientos_stock en una sola transacción
+    # (función definida en sql/01_mover_inventario.sql)
     try:
-        res = supabase.table("stock_real").select("*").eq("almacen", almacen).eq("producto", producto).execute()
-        stock_actual = 0
-        id_row = None
-        
-        if res.data:
-            stock_actual = res.data[0]["cantidad"]
-            id_row = res.data[0]["id"]
-        
-        nuevo_stock = stock_actual
-        if tipo == "ENTRADA":
-            nuevo_stock += cantidad
-        elif tipo == "SALIDA":
-            if stock_actual < cantidad:
-                return False, "⛔ Stock insuficiente en este almacén."
-            nuevo_stock -= cantidad
-            
-        if id_row:
-            supabase.table("stock_real").update({"cantidad": nuevo_stock}).eq("id", id_row).execute()
-        else:
-            if tipo == "SALIDA": return False, "⛔ El producto no existe en este almacén."
-            supabase.table("stock_real").insert({"almacen": almacen, "producto": producto, "cantidad": nuevo_stock}).execute()
-            
-        insertar_registro("movimientos_stock", {
-            "fecha": datetime.now().isoformat(),
-            "usuario": usuario,
-            "tipo": tipo,
-            "almacen": almacen,
-            "producto": producto,
-            "cantidad": cantidad,
-            "motivo": motivo
-        })
-        return True, "Movimiento registrado correctamente."
+        res = supabase.rpc("mover_inventario", {
+            "p_almacen": almacen,
+            "p_producto": producto,
+            "p_cantidad": int(cantidad),
+            "p_tipo": tipo,
+            "p_usuario": usuario,
+            "p_motivo": motivo,
+            "p_fecha": datetime.now().isoformat()
+        }).execute()
+        resultado = res.data
+        if resultado["ok"]:
+            invalidar_tablas("stock_real", "movimientos_stock")
+        return resultado["ok"], resultado["mensaje"]
+    except Exception as e:
+        return False, str(e)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def stock_almacenes(almacenes, fecha, version_s, version_m, version_c, version_p, ventana):
+    # Stock por almacén/producto y total consolidado, hoy (stock_real) o al cierre de "fecha".
+    # A una fecha: corte mensual más cercano + movimientos posteriores (sql/08_cortes_stock.sql)
+    if fecha:
+        filas = supabase.rpc("stock_a_fecha", {"p_fecha": fecha}).execute().data or []
+        df = resolver_nombres(_preparar_tabla(
+            pd.DataFrame(filas, columns=["almacen", "producto_id", "cantidad"]), "stock_real"
+        ))
+    else:
+        df = cargar_tabla("stock_real", ["almacen", "producto", "cantidad"])
+    if almacenes: df = df[df["almacen"].isin(almacenes)]
+    detalle = df[["almacen", "producto", "cantidad"]].sort_values("almacen")
+    consolidado = df.groupby("producto", observed=True)["cantidad"].sum().sort_values(ascending=False)
+    return detalle, consolidado
+
+def reconstruir_cortes_stock():
+    # Recalcula los cortes mensuales desde todo movimientos_stock (función definida en sql/08_cortes_stock.sql)
+    try:
+        resultado = supabase.rpc("reconstruir_cortes_stock").execute().data
+        invalidar_tablas("cortes_stock")
+        return resultado["ok"], resultado["mensaje"]
     except Exception as e:
         return False, str(e)
 
 # --- FUNCIONES DE AUDITORÍA ---
 
-def anular_movimiento(id_historial, usuario_actual):
+def reconstruir_resumen_diario():
+    # Recalcula resumen_diario desde todo el historial (función definida en sql/07_resumen_diario.sql)
     try:
-        resp = supabase.table("historial").select("*").eq("id", id_historial).execute()
-        if not resp.data: return False
-        dato = resp.data[0]
-        
-        prestamo = supabase.table("prestamos").select("*").eq("cliente", dato["cliente"]).eq("producto", dato["producto"]).execute()
-        
-        if prestamo.data:
-            p = prestamo.data[0]
-            nueva_cantidad = p["cantidad_pendiente"] + dato["cantidad"]
-            nuevo_total = nueva_cantidad * p["precio_unitario"]
-            
-            supabase.table("prestamos").update({
-                "cantidad_pendiente": nueva_cantidad,
-                "total_pendiente": nuevo_total
-            }).eq("id", p["id"]).execute()
-            
-            insertar_registro("anulaciones", {
-                "fecha_error": datetime.now().strftime("%Y-%m-%d"),
-                "usuario_responsable": usuario_actual,
-                "accion_original": dato["tipo"],
-                "cliente": dato["cliente"],
-                "producto": dato["producto"],
-                "cantidad_restaurada": dato["cantidad"],
-                "monto_anulado": dato["monto_operacion"]
-            })
-            
-            supabase.table("historial").delete().eq("id", id_historial).execute()
-            return True
-        else:
-            st.error("No se encontró el préstamo original. No se puede restaurar.")
-            return False
+        resultado = supabase.rpc("reconstruir_resumen_diario").execute().data
+        invalidar_tablas("resumen_diario")
+        return resultado["ok"], resultado["mensaje"]
     except Exception as e:
-        st.error(f"Error al anular: {e}")
-        return False
-        
+        return False, str(e)
+
+def anular_movimientos(ids_historial, usuario_actual):
+    # Restaura préstamos, registra anulaciones y borra el historial en una sola transacción
+    # (función definida en sql/04_anulacion_en_lote.sql). Todo o nada.
+    ids = sorted({int(i) for i in ids_historial})
+    if not ids: return False, "No hay movimientos seleccionados."
+    try:
+        res = supabase.rpc("anular_movimientos", {"p_ids": ids, "p_usuario": usuario_actual}).execute()
+        resultado = res.data
+        if resultado["ok"]:
+            invalidar_tablas("prestamos", "historial", "anulaciones")
+            for p in resultado.get("prestamos") or []:
+                actualizar_indice_deuda(
+                    p["id"], p["cantidad_pendiente"], p["total_pendiente"],
+                    nombre_maestro("clientes", p["cliente_id"])
+                )
+        return resultado["ok"], resultado["mensaje"]
+    except Exception as e:
+        return False, f"Error al anular: {e}"
+
 def corregir_dato_prestamo(id_prestamo, n_prod, n_cant, n_prec, usuario, motivo):
     try:
         # 1. Obtener datos viejos
@@ -219,9 +1537,13 @@ def corregir_dato_prestamo(id_prestamo, n_prod, n_cant, n_prec, usuario, motivo)
         if not res.data: return False
         viejo = res.data[0]
         
-        # 2. Detectar cambios
+        # 2. Detectar cambios (el producto se guarda por id; tiene que existir)
+        n_prod_id = id_maestro("productos", n_prod)
+        if n_prod_id is None:
+            st.error(f"Producto inexistente: {n_prod}. Créalo primero en Administración.")
+            return False
         cambios = []
-        if viejo["producto"] != n_prod: cambios.append(f"Prod: {viejo['producto']}->{n_prod}")
+        if viejo["producto_id"] != n_prod_id: cambios.append(f"Prod: {nombre_maestro('productos', viejo['producto_id'])}->{n_prod}")
         if viejo["cantidad_pendiente"] != n_cant: cambios.append(f"Cant: {viejo['cantidad_pendiente']}->{n_cant}")
         if float(viejo["precio_unitario"]) != float(n_prec): cambios.append(f"Pre: {viejo['precio_unitario']}->{n_prec}")
         
@@ -230,21 +1552,143 @@ def corregir_dato_prestamo(id_prestamo, n_prod, n_cant, n_prec, usuario, motivo)
         # 3. Actualizar
         n_total = n_cant * n_prec
         supabase.table("prestamos").update({
-            "producto": n_prod, "cantidad_pendiente": n_cant, 
+            "producto_id": n_prod_id, "cantidad_pendiente": n_cant, 
             "precio_unitario": n_prec, "total_pendiente": n_total
         }).eq("id", id_prestamo).execute()
+        invalidar_tablas("prestamos")
+        cliente = nombre_maestro("clientes", viejo["cliente_id"])
+        actualizar_indice_deuda(id_prestamo, n_cant, n_total, cliente)
         
         # 4. Log
         insertar_registro("bitacora_ediciones", {
             "fecha_cambio": datetime.now().isoformat(),
             "usuario_responsable": usuario,
-            "cliente_afectado": viejo["cliente"],
+            "cliente_afectado": cliente,
             "detalle_cambio": " | ".join(cambios),
             "motivo": motivo
         })
         return True
     except: return False
 
+# --- RÉPLICA ANALÍTICA LOCAL (REPORTES) ---
+# Copia SQLite de prestamos con índices, sincronizada por deltas desde Supabase.
+# Los cobros ya no se suman desde historial: salen de resumen_diario (sql/07_resumen_diario.sql)
+RUTA_REPLICA = st.secrets.get("RUTA_REPLICA", "replica_koriel.db")
+# Subir al cambiar ESQUEMA_REPLICA: una réplica con otra versión se reconstruye desde cero
+VERSION_REPLICA = 3
+
+ESQUEMA_REPLICA = {
+    "prestamos": {
+        "id": "INTEGER PRIMARY KEY", "cliente_id": "INTEGER", "producto_id": "INTEGER",
+        "cantidad_pendiente": "INTEGER", "total_pendiente": "REAL", "updated_at": "TEXT"
+    },
+}
+INDICES_REPLICA = [
+    "CREATE INDEX IF NOT EXISTS prestamos_pendiente ON prestamos (cantidad_pendiente, cliente_id)",
+]
+
+@st.cache_resource
+def replica_analitica():
+    con = sqlite3.connect(RUTA_REPLICA, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    if con.execute("PRAGMA user_version").fetchone()[0] != VERSION_REPLICA:
+        for tabla in ["prestamos", "historial", "marcas_replica"]:
+            con.execute(f"DROP TABLE IF EXISTS {tabla}")
+        con.execute(f"PRAGMA user_version = {VERSION_REPLICA}")
+    for tabla, cols in ESQUEMA_REPLICA.items():
+        con.execute(f"CREATE TABLE IF NOT EXISTS {tabla} ({', '.join(f'{c} {t}' for c, t in cols.items())})")
+    for sql in INDICES_REPLICA:
+        con.execute(sql)
+    con.execute("CREATE TABLE IF NOT EXISTS marcas_replica (tabla TEXT PRIMARY KEY, marca TEXT, marca_baja INTEGER)")
+    con.commit()
+    return {"con": con, "candado": threading.Lock()}
+
+def _filas_replica(tabla, df):
+    cols = list(ESQUEMA_REPLICA[tabla])
+    df = df.copy()
+    for col in cols:
+        if col not in df.columns: df[col] = None
+    return [tuple(_valor_json(v) for v in fila) for fila in df[cols].itertuples(index=False)]
+
+def sincronizar_replica(tabla):
+    # Igual que sincronizar_tabla, pero los cambios se aplican sobre la réplica SQLite
+    marca_col = MARCAS_SINCRONIZACION[tabla]
+    cols_sql = list(ESQUEMA_REPLICA[tabla])
+    rep = replica_analitica()
+    with rep["candado"]:
+        con = rep["con"]
+        fila = con.execute("SELECT marca, marca_baja FROM marcas_replica WHERE tabla = ?", (tabla,)).fetchone()
+        marca, marca_baja = fila if fila else (None, 0)
+        
+        if marca is None:
+            # Carga completa (primera vez o sin migración de updated_at)
+            try:
+                marca_baja = _ultima_baja(tabla)
+            except Exception:
+                marca_baja = 0
+            df = _descargar_tabla(tabla)
+            borrar_todo = True
+        else:
+            bajas = _bajas_desde(tabla, marca_baja)
+            if bajas:
+                marca_baja = bajas[-1]["id"]
+                con.executemany(f"DELETE FROM {tabla} WHERE id = ?", [(b["fila_id"],) for b in bajas])
+            desde = (pd.Timestamp(marca) - MARGEN_SINCRONIZACION).isoformat()
+            df = _descargar_tabla(tabla, cols_sql, ((marca_col, "gte", desde),))
+            borrar_todo = False
+        
+        if borrar_todo:
+            con.execute(f"DELETE FROM {tabla}")
+        if not df.empty:
+            con.executemany(
+                f"INSERT OR REPLACE INTO {tabla} ({', '.join(cols_sql)}) VALUES ({', '.join('?' for _ in cols_sql)})",
+                _filas_replica(tabla, df)
+            )
+        nueva_marca = df[marca_col].max() if marca_col in df.columns and not df.empty else marca
+        con.execute(
+            "INSERT OR REPLACE INTO marcas_replica (tabla, marca, marca_baja) VALUES (?, ?, ?)",
+            (tabla, None if nueva_marca is None else str(nueva_marca), marca_baja)
+        )
+        con.commit()
+
+def consultar_replica(sql, params=()):
+    rep = replica_analitica()
+    with rep["candado"]:
+        return pd.read_sql_query(sql, rep["con"], params=params)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def reporte_financiero(clientes, desde, hasta, version_p, version_h, version_c, ventana):
+    # Deuda activa desde la réplica local; cobros desde el resumen diario de Supabase
+    sincronizar_replica("prestamos")
+    ids_cli, nombres_cli = mapas_maestro("clientes")
+    
+    filtro_cli, params_cli = "", []
+    if clientes:
+        params_cli = [nombres_cli.get(c, -1) for c in clientes]
+        filtro_cli = f" AND cliente_id IN ({', '.join('?' for _ in params_cli)})"
+    
+    deuda = consultar_replica(
+        "SELECT cliente_id, SUM(total_pendiente) AS total_pendiente FROM prestamos "
+        "WHERE cantidad_pendiente > 0" + filtro_cli + " GROUP BY cliente_id ORDER BY total_pendiente DESC",
+        params_cli
+    )
+    filtros = [("tipo", "eq", "COBRO")]
+    if desde and hasta:
+        filtros += [("dia", "gte", desde), ("dia", "lte", hasta)]
+    if clientes:
+        filtros.append(("cliente", "in", list(clientes)))
+    # Una fila por cliente y día, no por cobro
+    resumen = cargar_tabla("resumen_diario", ["cliente_id", "monto"], filtros)
+    ingresos = (
+        resumen.groupby("cliente_id", as_index=False)["monto"].sum()
+        .rename(columns={"monto": "monto_operacion"}).sort_values("monto_operacion", ascending=False)
+    )
+    # Se agrupa por id; el nombre vigente se pone al final
+    return (
+        deuda.assign(cliente=deuda["cliente_id"].map(ids_cli)).set_index("cliente")[["total_pendiente"]],
+        ingresos.assign(cliente=ingresos["cliente_id"].map(ids_cli)).set_index("cliente")[["monto_operacion"]],
+    )
+
 # ==========================================
 # 5. SISTEMA DE ACCESO (COOKIES)
 # ==========================================
@@ -261,7 +1705,6 @@ def check_login():
         return True
     
     # Verificar si hay Cookie guardada 
-    time.sleep(0.1)
     cookie_user = cookie_manager.get(cookie="koriel_user_secure")
     
     if cookie_user:
@@ -274,28 +1717,33 @@ def check_login():
     # Si no hay nada, mostrar pantalla de Login
     st.session_state["usuario_logueado"] = None
     
-    st.markdown("<br><br>", unsafe_allow_html=True)
-    st.markdown("<h1 style='text-align: center;'>GRUPO KORIEL CLOUD</h1>", unsafe_allow_html=True)
-    
-    c1, c2, c3 = st.columns([1, 2, 1])
-    with c2:
-        user = st.text_input("Usuario")
-        password = st.text_input("Contraseña", type="password")
+    formulario = st.empty()
+    with formulario.container():
+        st.markdown("<br><br>", unsafe_allow_html=True)
+        st.markdown("<h1 style='text-align: center;'>GRUPO KORIEL CLOUD</h1>", unsafe_allow_html=True)
         
-        if st.button("Ingresar", use_container_width=True, type="primary"):
-            if user in USUARIOS and USUARIOS[user]["pass"] == password:
-                # Guarda la sesion
-                st.session_state["usuario_logueado"] = user
-                st.session_state["rol_usuario"] = USUARIOS[user]["rol"]
-                fecha_exp = datetime.now() + timedelta(days=30)
-                cookie_manager.set("koriel_user_secure", user, expires_at=fecha_exp)
-                
-                st.toast(f"¡Bienvenido {user}!")
-                time.sleep(0.5)
-                st.rerun()
-            else:
+        c1, c2, c3 = st.columns([1, 2, 1])
+        with c2:
+            user = st.text_input("Usuario")
+            password = st.text_input("Contraseña", type="password")
+            
+            ingresar = st.button("Ingresar", use_container_width=True, type="primary")
+            valido = ingresar and user in USUARIOS and USUARIOS[user]["pass"] == password
+            if ingresar and not valido:
                 st.error("Datos incorrectos")
-    return False
+    if not valido:
+        return False
+    
+    # Sin st.rerun(): la app reemplaza al login en esta misma ejecución,
+    # así el componente de la cookie se monta sin tener que esperar
+    formulario.empty()
+    # Guarda la sesion
+    st.session_state["usuario_logueado"] = user
+    st.session_state["rol_usuario"] = USUARIOS[user]["rol"]
+    fecha_exp = datetime.now() + timedelta(days=30)
+    cookie_manager.set("koriel_user_secure", user, expires_at=fecha_exp)
+    st.toast(f"¡Bienvenido {user}!")
+    return True
 
 def logout():
     # Borrar cookie y limpiar sesión
@@ -307,9 +1755,39 @@ def logout():
 # ==========================================
 # 6. APLICACIÓN PRINCIPAL 
 # ==========================================
+
+# --- AVISOS ENTRE RERUNS ---
+# Un st.success justo antes de st.rerun() no llega a verse. En vez de esperar con time.sleep,
+# el aviso se guarda en la sesión y se muestra como toast al comienzo de la siguiente ejecución.
+def avisar(mensaje, icono="✅"):
+    st.session_state.setdefault("_avisos", []).append((mensaje, icono))
+
+def mostrar_avisos():
+    for mensaje, icono in st.session_state.pop("_avisos", []):
+        st.toast(mensaje, icon=icono)
+
+class DatosPantalla:
+    # Tablas de la ejecución actual: cada una se descarga la primera vez que se usa
+    def __init__(self):
+        self._tablas = {}
+
+    def __getattr__(self, tabla):
+        if tabla.startswith("_"):
+            raise AttributeError(tabla)
+        if tabla not in self._tablas:
+            self._tablas[tabla] = cargar_tabla(tabla)
+        return self._tablas[tabla]
+
+    def precargar(self, *tablas):
+        # Trae en paralelo las tablas que la pantalla va a usar y aún no están cargadas
+        faltantes = [t for t in tablas if t not in self._tablas]
+        if faltantes:
+            self._tablas.update(cargar_tablas(faltantes))
+
 def main_app():
     usuario_actual = st.session_state["usuario_logueado"]
     rol_actual = st.session_state["rol_usuario"]
+    mostrar_avisos()
     
     # --- MENÚ LATERAL DINÁMICO POR ROL ---
     with st.sidebar:
@@ -337,14 +1815,17 @@ def main_app():
             ]
             
         menu = st.radio("Navegación del Sistema", opciones_menu)
+        if st.session_state.get("_medicion") is not None:
+            st.session_state["_medicion"]["menu"] = menu
         
         st.divider()
         if st.button("Cerrar Sesión"):
             logout()
+        # Se llena al final del rerun, cuando ya se conocen todas las llamadas
+        panel_medicion = st.container() if rol_actual == "admin" and MEDICION_ACTIVA else None
 
-    # Carga de datos maestros
-    df_cli = cargar_tabla("clientes")
-    df_prod = cargar_tabla("productos")
+    # Datos maestros: se descargan solo si la pantalla los usa
+    tablas = DatosPantalla()
 
     # ==========================================
     # MÓDULO: NUEVO PRÉSTAMO (VISIBLE PARA TODOS)
@@ -352,19 +1833,13 @@ def main_app():
     if menu == "Nuevo Préstamo":
         st.title("Registrar Salida de Mercadería")
         
-        df_deudas = cargar_tabla("prestamos")
-        
-        # Listas Inteligentes
-        lista_c = ["➕ CREAR NUEVO..."] + sorted(df_cli["nombre"].unique().tolist()) if not df_cli.empty else ["➕ CREAR NUEVO..."]
-        lista_p = ["➕ CREAR NUEVO..."] + sorted(df_prod["nombre"].unique().tolist()) if not df_prod.empty else ["➕ CREAR NUEVO..."]
-
         with st.container(border=True):
             c1, c2 = st.columns(2)
             
             # --- SECCIÓN CLIENTE ---
             with c1:
                 st.subheader("1. Cliente")
-                cli_sel = st.selectbox("Buscar Cliente", lista_c)
+                cli_sel = selector_maestro("Buscar Cliente", "clientes", "np_cliente", ["➕ CREAR NUEVO..."])
                 
                 cli_final = None
                 new_cli_n = None
@@ -377,17 +1852,16 @@ def main_app():
                 else: 
                     cli_final = cli_sel
                     # SEMÁFORO DE RIESGO
-                    if not df_deudas.empty:
-                        deuda = df_deudas[(df_deudas["cliente"] == cli_final)]["total_pendiente"].sum()
-                        if deuda > 0:
-                            st.error(f"⚠️ RIESGO: Este cliente tiene deuda de **${deuda:,.2f}**")
-                        else:
-                            st.success("✅ Cliente al día.")
+                    deuda = deuda_cliente(cli_final)
+                    if deuda > 0:
+                        st.error(f"⚠️ RIESGO: Este cliente tiene deuda de **${deuda:,.2f}**")
+                    else:
+                        st.success("✅ Cliente al día.")
             
             # --- SECCIÓN PRODUCTO ---
             with c2:
                 st.subheader("2. Producto")
-                prod_sel = st.selectbox("Buscar Producto", lista_p)
+                prod_sel = selector_maestro("Buscar Producto", "productos", "np_producto", ["➕ CREAR NUEVO..."])
                 
                 prod_final = None
                 pre_sug = 0.0
@@ -396,8 +1870,8 @@ def main_app():
                     prod_final = st.text_input("Descripción Producto")
                 else:
                     prod_final = prod_sel
-                    if not df_prod.empty:
-                        row = df_prod[df_prod["nombre"]==prod_sel]
+                    if not tablas.productos.empty:
+                        row = tablas.productos[tablas.productos["nombre"]==prod_sel]
                         if not row.empty: pre_sug = float(row.iloc[0]["precio_base"])
 
                 cc1, cc2 = st.columns(2)
@@ -410,24 +1884,35 @@ def main_app():
             # --- BOTÓN DE GUARDADO ---
             if st.button("GUARDAR PRÉSTAMO", type="primary", use_container_width=True):
                 if cli_final and prod_final:
-                    # Crear Maestros si son nuevos
+                    # Crear Maestros si son nuevos (el préstamo guarda sus ids)
                     if cli_sel == "➕ CREAR NUEVO...": 
-                        insertar_registro("clientes", {"nombre": new_cli_n, "tienda": new_cli_t})
+                        nuevo = insertar_registro("clientes", {"nombre": new_cli_n, "tienda": new_cli_t})
+                        cli_id = nuevo.data[0]["id"] if nuevo and nuevo.data else None
+                    else:
+                        cli_id = id_maestro("clientes", cli_final)
                     if prod_sel == "➕ CREAR NUEVO...": 
-                        insertar_registro("productos", {"nombre": prod_final, "categoria": "Otros", "precio_base": precio})
+                        nuevo = insertar_registro("productos", {"nombre": prod_final, "categoria": "Otros", "precio_base": precio})
+                        prod_id = nuevo.data[0]["id"] if nuevo and nuevo.data else None
+                    else:
+                        prod_id = id_maestro("productos", prod_final)
                     
                     # Guardar Transacción
-                    insertar_registro("prestamos", {
-                        "fecha_registro": datetime.now().strftime("%Y-%m-%d"),
-                        "usuario": usuario_actual,
-                        "cliente": cli_final,
-                        "producto": prod_final,
-                        "cantidad_pendiente": cant,
-                        "precio_unitario": precio,
-                        "total_pendiente": cant*precio,
-                        "observaciones": obs
-                    })
-                    st.success(f"Producto asignado a {cli_final}"); time.sleep(1.5); st.rerun()
+                    if not cli_id or not prod_id:
+                        faltan = []
+                        if not cli_id: faltan.append(f"cliente '{cli_final}'")
+                        if not prod_id: faltan.append(f"producto '{prod_final}'")
+                        st.error(f"Préstamo NO guardado: no se pudo crear ni encontrar el {' ni el '.join(faltan)}.")
+                    elif insertar_registro("prestamos", {
+                            "fecha_registro": datetime.now().strftime("%Y-%m-%d"),
+                            "usuario": usuario_actual,
+                            "cliente_id": cli_id,
+                            "producto_id": prod_id,
+                            "cantidad_pendiente": cant,
+                            "precio_unitario": precio,
+                            "total_pendiente": cant*precio,
+                            "observaciones": obs
+                        }):
+                        avisar(f"Producto asignado a {cli_final}"); st.rerun()
                 else: 
                     st.error("Faltan datos obligatorios.")
 
@@ -438,39 +1923,46 @@ def main_app():
         st.title(f"Historial de {usuario_actual.capitalize()}")
         st.info("Aquí puedes ver los préstamos que has registrado hoy.")
         
-        df_p = cargar_tabla("prestamos")
+        df_p = cargar_tabla(
+            "prestamos",
+            ["fecha_registro", "cliente", "producto", "cantidad_pendiente", "total_pendiente", "observaciones"],
+            [("usuario", "eq", usuario_actual)],
+            ("fecha_registro", True)
+        )
         if not df_p.empty:
-            mis_prestamos = df_p[df_p["usuario"] == usuario_actual].sort_values("fecha_registro", ascending=False)
-            
-            if not mis_prestamos.empty:
-                st.dataframe(mis_prestamos[["fecha_registro", "cliente", "producto", "cantidad_pendiente", "total_pendiente", "observaciones"]], use_container_width=True)
-            else:
-                st.warning("No has registrado préstamos aún.")
+            st.dataframe(df_p, use_container_width=True)
         else:
-            st.warning("No hay registros en el sistema.")
+            st.warning("No has registrado préstamos aún.")
 
     # ==========================================
     # MÓDULO: RUTAS Y COBRO (SOLO ADMIN)
     # ==========================================
     elif menu == "Rutas y Cobro":
         st.title("Gestión de Cobranza")
+        panel_cola()
         
-        df_pend = cargar_tabla("prestamos")
-        if not df_pend.empty: df_pend = df_pend[df_pend["cantidad_pendiente"] > 0]
+        clientes_ruta = clientes_con_deuda()
         
-        if df_pend.empty:
+        if not clientes_ruta:
             st.success("✅ No hay cobranza pendiente.")
         else:
-            cli_visita = st.selectbox("Seleccionar Cliente en Ruta:", sorted(df_pend["cliente"].unique()))
-            datos = df_pend[df_pend["cliente"] == cli_visita].copy()
-            deuda_total = datos["total_pendiente"].sum()
+            cli_visita = st.selectbox("Seleccionar Cliente en Ruta:", clientes_ruta)
+            datos = cargar_tabla(
+                "prestamos",
+                COLUMNAS_PRESTAMO + ["producto"],
+                [("cantidad_pendiente", "gt", 0), ("cliente", "eq", cli_visita)]
+            )
+            # Los cobros que siguen en la cola ya no deben aparecer como pendientes
+            datos = superponer_cola(datos)
+            datos = datos[datos["cantidad_pendiente"] > 0]
+            deuda_total = deuda_cliente(cli_visita)
             
             # Tarjeta de Información con RUC
             with st.container(border=True):
                 c_info, c_total = st.columns([3, 1])
                 with c_info:
-                    if not df_cli.empty:
-                        info = df_cli[df_cli["nombre"] == cli_visita]
+                    if not tablas.clientes.empty:
+                        info = tablas.clientes[tablas.clientes["nombre"] == cli_visita]
                         if not info.empty:
                             r = info.iloc[0]
                             st.markdown(f"🏠 **{r.get('tienda','-')}** | 📍 {r.get('direccion','-')} | 📞 {r.get('telefono','-')}")
@@ -487,20 +1979,24 @@ def main_app():
             with c1:
                 if st.button("COBRAR TODO (Pagó 100%)", type="primary", use_container_width=True):
                     hoy = datetime.now().isoformat()
+                    eventos, saldos = [], []
                     for i, r in datos.iterrows():
                         cant = int(r["cantidad_pendiente"])
                         monto = float(cant * r["precio_unitario"])
-                        insertar_registro("historial", {"fecha_evento": hoy, "usuario_responsable": usuario_actual, "tipo": "COBRO", "cliente": cli_visita, "producto": r["producto"], "cantidad": cant, "monto_operacion": monto})
-                        actualizar_prestamo(r["id"], 0, 0)
-                    st.toast("¡Cobro registrado!"); time.sleep(1); st.rerun()
+                        eventos.append({"fecha_evento": hoy, "usuario_responsable": usuario_actual, "tipo": "COBRO", "cliente_id": int(r["cliente_id"]), "producto_id": int(r["producto_id"]), "cantidad": cant, "monto_operacion": monto})
+                        saldos.append(fila_prestamo(r, 0))
+                    if liquidar_prestamos(eventos, saldos):
+                        avisar("¡Cobro registrado!"); st.rerun()
             with c2:
                 if st.button("DEVOLVER TODO (No vendió)", use_container_width=True):
                     hoy = datetime.now().isoformat()
+                    eventos, saldos = [], []
                     for i, r in datos.iterrows():
                         cant = int(r["cantidad_pendiente"])
-                        insertar_registro("historial", {"fecha_evento": hoy, "usuario_responsable": usuario_actual, "tipo": "DEVOLUCION", "cliente": cli_visita, "producto": r["producto"], "cantidad": cant, "monto_operacion": 0})
-                        actualizar_prestamo(r["id"], 0, 0)
-                    st.toast("¡Devolución registrada!"); time.sleep(1); st.rerun()
+                        eventos.append({"fecha_evento": hoy, "usuario_responsable": usuario_actual, "tipo": "DEVOLUCION", "cliente_id": int(r["cliente_id"]), "producto_id": int(r["producto_id"]), "cantidad": cant, "monto_operacion": 0})
+                        saldos.append(fila_prestamo(r, 0))
+                    if liquidar_prestamos(eventos, saldos):
+                        avisar("¡Devolución registrada!"); st.rerun()
 
             st.markdown("---")
             st.write("##### Gestión Manual / Parcial")
@@ -524,18 +2020,23 @@ def main_app():
                 if pay_now > 0: st.success(f"💵 CLIENTE PAGA AHORA: **${pay_now:,.2f}**")
             with cp2:
                 if st.button("Procesar Manual", use_container_width=True):
+                    # Supabase rechaza descontar más de lo pendiente: se avisa antes de encolar
+                    exceso = (edited["Cobrar"] + edited["Devolver"] > edited["cantidad_pendiente"]).any()
+                    if exceso: st.error("No se puede cobrar/devolver más de lo pendiente.")
                     hoy = datetime.now().isoformat()
-                    p = False
+                    eventos, saldos = [], []
                     for i, r in edited.iterrows():
                         v, d = r["Cobrar"], r["Devolver"]
                         if v > 0 or d > 0:
-                            p = True
-                            if v > 0: insertar_registro("historial", {"fecha_evento": hoy, "usuario_responsable": usuario_actual, "tipo": "COBRO", "cliente": cli_visita, "producto": r["producto"], "cantidad": int(v), "monto_operacion": float(v*r["precio_unitario"])})
-                            if d > 0: insertar_registro("historial", {"fecha_evento": hoy, "usuario_responsable": usuario_actual, "tipo": "DEVOLUCION", "cliente": cli_visita, "producto": r["producto"], "cantidad": int(d), "monto_operacion": 0})
+                            # El editor solo muestra algunas columnas: los ids salen de la fila original
+                            p = datos.loc[i]
+                            if v > 0: eventos.append({"fecha_evento": hoy, "usuario_responsable": usuario_actual, "tipo": "COBRO", "cliente_id": int(p["cliente_id"]), "producto_id": int(p["producto_id"]), "cantidad": int(v), "monto_operacion": float(v*r["precio_unitario"])})
+                            if d > 0: eventos.append({"fecha_evento": hoy, "usuario_responsable": usuario_actual, "tipo": "DEVOLUCION", "cliente_id": int(p["cliente_id"]), "producto_id": int(p["producto_id"]), "cantidad": int(d), "monto_operacion": 0})
                             
                             new_c = int(r["cantidad_pendiente"]-v-d)
-                            actualizar_prestamo(r["id"], new_c, float(new_c*r["precio_unitario"]))
-                    if p: st.toast("Procesado"); time.sleep(1); st.rerun()
+                            saldos.append(fila_prestamo(p, new_c))
+                    if saldos and not exceso and liquidar_prestamos(eventos, saldos):
+                        avisar("Procesado"); st.rerun()
 
     # ==========================================
     # MÓDULO: IMPORTACIONES Y COMPRAS (OCULTO PERO CÓDIGO PRESENTE)
@@ -550,141 +2051,170 @@ def main_app():
     elif menu == "Inventario y Almacenes":
         st.title("Gestión de Almacenes")
         
-        df_alm = cargar_tabla("almacenes")
-        df_stock = cargar_tabla("stock_real")
-        
-        t1, t2, t3 = st.tabs(["Registrar Movimiento", "Stock Actual", "Crear Almacén"])
+        t1, t2, t3 = st.tabs(["Registrar Movimiento", "Stock Actual", "Crear Almacén"], key="tabs_inv", on_change="rerun")
         
         with t1:
-            st.subheader("Entrada / Salida")
-            if df_alm.empty:
-                st.warning("Crea un almacén primero.")
-            else:
-                c1, c2 = st.columns(2)
-                with c1:
-                    tipo_mov = st.selectbox("Tipo Movimiento", ["ENTRADA ", "SALIDA (Tienda/Venta)"])
-                    alm_mov = st.selectbox("Almacén", sorted(df_alm["nombre"].unique()))
-                    prod_mov = st.selectbox("Producto", sorted(df_prod["nombre"].unique()) if not df_prod.empty else [])
-                with c2:
-                    cant_mov = st.number_input("Cantidad", min_value=1, value=1)
-                    motivo_mov = st.text_input("Motivo / Detalle")
-                
-                if st.button("Registrar Movimiento", type="primary"):
-                    if prod_mov:
-                        ok, msg = mover_inventario(alm_mov, prod_mov, cant_mov, "ENTRADA" if "ENTRADA" in tipo_mov else "SALIDA", usuario_actual, motivo_mov)
-                        if ok: st.success(msg); time.sleep(1); st.rerun()
-                        else: st.error(msg)
-                    else: st.error("Selecciona un producto.")
+            if t1.open:
+                st.subheader("Entrada / Salida")
+                if tablas.almacenes.empty:
+                    st.warning("Crea un almacén primero.")
+                else:
+                    c1, c2 = st.columns(2)
+                    with c1:
+                        tipo_mov = st.selectbox("Tipo Movimiento", ["ENTRADA ", "SALIDA (Tienda/Venta)"])
+                        alm_mov = st.selectbox("Almacén", sorted(tablas.almacenes["nombre"].unique()))
+                        prod_mov = selector_maestro("Producto", "productos", "inv_producto")
+                    with c2:
+                        cant_mov = st.number_input("Cantidad", min_value=1, value=1)
+                        motivo_mov = st.text_input("Motivo / Detalle")
+                    
+                    if st.button("Registrar Movimiento", type="primary"):
+                        if prod_mov:
+                            ok, msg = mover_inventario(alm_mov, prod_mov, cant_mov, "ENTRADA" if "ENTRADA" in tipo_mov else "SALIDA", usuario_actual, motivo_mov)
+                            if ok: avisar(msg); st.rerun()
+                            else: st.error(msg)
+                        else: st.error("Selecciona un producto.")
 
         with t2:
-            st.subheader("Inventario Físico")
-            if not df_stock.empty:
-                filtro_alm = st.multiselect("Filtrar Almacén", sorted(df_stock["almacen"].unique()))
-                df_view = df_stock.copy()
-                if filtro_alm: df_view = df_view[df_view["almacen"].isin(filtro_alm)]
-                
-                st.dataframe(df_view[["almacen", "producto", "cantidad"]].sort_values("almacen"), use_container_width=True)
-                
-                st.divider()
-                st.write("**Total Consolidado:**")
-                st.dataframe(df_view.groupby("producto")["cantidad"].sum().sort_values(ascending=False))
-            else: st.info("Sin stock registrado.")
+            if t2.open:
+                st.subheader("Inventario Físico")
+                if not tablas.stock_real.empty:
+                    c1, c2 = st.columns(2)
+                    filtro_alm = c1.multiselect("Filtrar Almacén", sorted(tablas.stock_real["almacen"].unique()))
+                    f_stock = c2.date_input("Stock al", date.today(), max_value=date.today())
+                    
+                    versiones = versiones_tablas()
+                    try:
+                        df_view, df_total = stock_almacenes(
+                            tuple(filtro_alm),
+                            f_stock.isoformat() if f_stock < date.today() else None,
+                            versiones.get("stock_real", 0), versiones.get("movimientos_stock", 0),
+                            versiones.get("cortes_stock", 0), versiones.get("productos", 0),
+                            int(time.time() // TTL_TABLAS["stock_real"])
+                        )
+                    except Exception as e:
+                        st.error(f"Error calculando el stock: {e}")
+                        df_view, df_total = pd.DataFrame(), pd.Series(dtype="float64")
+                    
+                    st.dataframe(df_view, use_container_width=True)
+                    
+                    st.divider()
+                    st.write("**Total Consolidado:**")
+                    st.dataframe(df_total)
+                    
+                    if st.button("🔁 Reconstruir cortes de stock"):
+                        ok, msg = reconstruir_cortes_stock()
+                        if ok: avisar(msg); st.rerun()
+                        else: st.error(msg)
+                else: st.info("Sin stock registrado.")
 
         with t3:
-            with st.form("new_alm"):
-                n_alm = st.text_input("Nombre Almacén")
-                if st.form_submit_button("Crear"):
-                    insertar_registro("almacenes", {"nombre": n_alm})
-                    st.success("Creado"); st.rerun()
-            if not df_alm.empty: st.dataframe(df_alm["nombre"], use_container_width=True)
+            if t3.open:
+                with st.form("new_alm"):
+                    n_alm = st.text_input("Nombre Almacén")
+                    if st.form_submit_button("Crear"):
+                        insertar_registro("almacenes", {"nombre": n_alm})
+                        avisar("Creado"); st.rerun()
+                if not tablas.almacenes.empty: st.dataframe(tablas.almacenes["nombre"], use_container_width=True)
 
     # ==========================================
     # MÓDULO 3: CONSULTAS Y RECIBOS
     # ==========================================
     elif menu == "Consultas y Recibos":
         st.title("Consultas")
-        t1, t2 = st.tabs(["Deudas", "Historial"])
+        t1, t2 = st.tabs(["Deudas", "Historial"], key="tabs_cons", on_change="rerun")
         
         # --- DEUDAS ---
         with t1:
-            df_p = cargar_tabla("prestamos")
-            if not df_p.empty:
-                df_p = df_p[df_p["cantidad_pendiente"] > 0]
+            if t1.open:
                 c1, c2 = st.columns(2)
                 ft = c1.selectbox("Filtro Fecha", ["Todos", "Hoy", "Esta Semana", "Este Mes"])
-                fc = c2.multiselect("Filtro Cliente", sorted(df_p["cliente"].unique()))
-                
-                df_s = df_p.copy()
                 hoy = date.today()
                 
-                # Filtros de Fecha
+                # Filtros de Fecha (se aplican en Supabase)
+                filtros = [("cantidad_pendiente", "gt", 0)]
                 if ft == "Hoy": 
-                    df_s = df_s[df_s["fecha_registro"].dt.date == hoy] if not df_s["fecha_registro"].empty else df_s
+                    filtros.append(("fecha_registro", "gte", hoy.isoformat()))
                 elif ft == "Esta Semana": 
-                    df_s = df_s[df_s["fecha_registro"].dt.date >= hoy - timedelta(days=hoy.weekday())] if not df_s["fecha_registro"].empty else df_s
+                    filtros.append(("fecha_registro", "gte", (hoy - timedelta(days=hoy.weekday())).isoformat()))
                 elif ft == "Este Mes": 
-                     df_s = df_s[df_s["fecha_registro"].dt.date >= hoy.replace(day=1)] if not df_s["fecha_registro"].empty else df_s 
-                
-                # Filtro Cliente
-                if fc: df_s = df_s[df_s["cliente"].isin(fc)]
-                
-                # ---  ORDEN NUEVO PRIMERO ---
-                df_s = df_s.sort_values("fecha_registro", ascending=False)
+                    filtros.append(("fecha_registro", "gte", hoy.replace(day=1).isoformat()))
                 
-                st.dataframe(
-                    df_s, 
-                    use_container_width=True,
-                    column_config={
-                        "id": None, # Oculta el ID
-                        "fecha_registro": st.column_config.DateColumn("Fecha", format="YYYY-MM-DD"), 
-                        "total_pendiente": st.column_config.NumberColumn("Total Deuda", format="$%.2f"), 
-                        "precio_unitario": st.column_config.NumberColumn("Precio", format="$%.2f"),
-                        "usuario": st.column_config.TextColumn("Vendedor"),
-                        "observaciones": st.column_config.TextColumn("Notas")
-                    }
+                df_p = cargar_tabla(
+                    "prestamos",
+                    ["id", "fecha_registro", "usuario", "cliente", "producto", "cantidad_pendiente", "precio_unitario", "total_pendiente", "observaciones"],
+                    filtros,
+                    ("fecha_registro", True)
                 )
-                
-                st.metric("Total Mostrado", f"${df_s['total_pendiente'].sum():,.2f}")
-                
-                if st.button("🖨️ Generar Recibo WhatsApp"):
-                    txt = f"*ESTADO DE CUENTA*\n📅 {datetime.now().strftime('%d/%m/%Y')}\n----------------\n"
-                    for c in df_s["cliente"].unique():
-                        txt += f"👤 {c}:\n"
-                        for i, r in df_s[df_s["cliente"]==c].iterrows():
-                           
-                            fecha_txt = r['fecha_registro'].strftime('%d/%m') if pd.notnull(r['fecha_registro']) else ""
-                            txt += f" - {fecha_txt} | {r['producto']} (x{r['cantidad_pendiente']}): ${r['total_pendiente']:,.2f}\n"
-                    txt += f"----------------\n*TOTAL: ${df_s['total_pendiente'].sum():,.2f}*"
-                    st.code(txt, language="text")
+                if not df_p.empty:
+                    fc = c2.multiselect("Filtro Cliente", sorted(df_p["cliente"].unique()))
+                    
+                    df_s = df_p
+                    
+                    # Filtro Cliente
+                    if fc: df_s = df_s[df_s["cliente"].isin(fc)]
+                    
+                    st.dataframe(
+                        df_s, 
+                        use_container_width=True,
+                        column_config={
+                            "id": None, # Oculta el ID
+                            "fecha_registro": st.column_config.DateColumn("Fecha", format="YYYY-MM-DD"), 
+                            "total_pendiente": st.column_config.NumberColumn("Total Deuda", format="$%.2f"), 
+                            "precio_unitario": st.column_config.NumberColumn("Precio", format="$%.2f"),
+                            "usuario": st.column_config.TextColumn("Vendedor"),
+                            "observaciones": st.column_config.TextColumn("Notas")
+                        }
+                    )
+                    
+                    st.metric("Total Mostrado", f"${df_s['total_pendiente'].sum():,.2f}")
+                    
+                    b1, b2 = st.columns(2)
+                    if b1.button("🖨️ Generar Recibo WhatsApp"):
+                        st.code(estado_de_cuenta(df_s), language="text")
+                    # Un recibo por cliente mostrado, en un solo ZIP (se arma al descargar)
+                    b2.download_button(
+                        "📦 Recibos por Cliente (ZIP)",
+                        lambda: zip_estados(estados_por_cliente(df_s)),
+                        file_name=f"Estados_{date.today()}.zip",
+                        mime="application/zip"
+                    )
 
         # --- PESTAÑA 2: HISTORIAL ---
         with t2:
-            df_h = cargar_tabla("historial")
-            if not df_h.empty:
+            if t2.open:
                 c1, c2, c3 = st.columns(3)
-                fc = c1.multiselect("Cliente", sorted(df_h["cliente"].unique()))
+                with c1: fc = selector_maestro("Cliente", "clientes", "hist_clientes", multiple=True)
                 ft = c2.multiselect("Tipo", ["COBRO", "DEVOLUCION"])
                 fd = c3.date_input("Rango Fecha", [date.today()-timedelta(days=30), date.today()])
                 
-                df_hs = df_h.copy()
-                if fc: df_hs = df_hs[df_hs["cliente"].isin(fc)]
-                if ft: df_hs = df_hs[df_hs["tipo"].isin(ft)]
+                filtros = []
+                if fc: filtros.append(("cliente", "in", fc))
+                if ft: filtros.append(("tipo", "in", ft))
                 if len(fd)==2: 
-                    df_hs = df_hs[(df_hs["fecha_evento"].dt.date >= fd[0]) & (df_hs["fecha_evento"].dt.date <= fd[1])]
+                    filtros.append(("fecha_evento", "gte", fd[0].isoformat()))
+                    filtros.append(("fecha_evento", "lt", (fd[1] + timedelta(days=1)).isoformat()))
                 
-                # Ordenar historial también (lo último primero)
-                df_hs = df_hs.sort_values("fecha_evento", ascending=False)
-
-                # Visualización limpia del historial
-                st.dataframe(
-                    df_hs, 
-                    use_container_width=True,
-                    column_config={
-                        "id": None,
-                        "fecha_evento": st.column_config.DatetimeColumn("Fecha/Hora", format="DD/MM/YYYY HH:mm"),
-                        "monto_operacion": st.column_config.NumberColumn("Monto", format="$%.2f")
-                    }
+                # Lo último primero, de a 100 filas por página (consulta por cursor en Supabase)
+                df_hs, hay_mas = lista_paginada(
+                    "pag_historial",
+                    "historial",
+                    ["id", "fecha_evento", "usuario_responsable", "tipo", "cliente", "producto", "cantidad", "monto_operacion"],
+                    filtros,
+                    limite=100
                 )
+                if not df_hs.empty:
+                    # Visualización limpia del historial
+                    st.dataframe(
+                        df_hs, 
+                        use_container_width=True,
+                        column_config={
+                            "id": None,
+                            "fecha_evento": st.column_config.DatetimeColumn("Fecha/Hora", format="DD/MM/YYYY HH:mm"),
+                            "monto_operacion": st.column_config.NumberColumn("Monto", format="$%.2f")
+                        }
+                    )
+                    if hay_mas: boton_cargar_mas("pag_historial")
 
     # ==========================================
     # MÓDULO: ANULAR / CORREGIR (SOLO ADMIN)
@@ -692,15 +2222,18 @@ def main_app():
     elif menu == "Anular/Corregir":
         st.title("Corrección de Errores")
         
-        tab_edit, tab_cor, tab_log = st.tabs(["✏️ Editar Dato", "↩️ Deshacer Movimiento", "📜 Auditoría"])
+        tab_edit, tab_cor, tab_log = st.tabs(["✏️ Editar Dato", "↩️ Deshacer Movimiento", "📜 Auditoría"], key="tabs_anul", on_change="rerun")
         
         # --- PESTAÑA 1: EDITAR (FORMATO FECHA ARREGLADO) ---
         with tab_edit:
-            st.info("Corrige errores de registro en préstamos activos.")
-            df_p = cargar_tabla("prestamos")
-            
-            if not df_p.empty:
-                df_p = df_p[df_p["cantidad_pendiente"] > 0] 
+            if tab_edit.open:
+                st.info("Corrige errores de registro en préstamos activos.")
+                df_p = cargar_tabla(
+                    "prestamos",
+                    ["id", "fecha_registro", "cliente", "producto", "cantidad_pendiente", "precio_unitario"],
+                    [("cantidad_pendiente", "gt", 0)]
+                )
+                
                 if not df_p.empty:
                     lista_c = sorted(df_p["cliente"].unique())
                     cli_edit = st.selectbox("Cliente a Corregir", lista_c, key="sel_edit_cli")
@@ -724,71 +2257,87 @@ def main_app():
                                 if st.form_submit_button("💾 Guardar Corrección"):
                                     if reason:
                                         if corregir_dato_prestamo(r["id"], new_prod, new_cant, new_prec, usuario_actual, reason):
-                                            st.success("Corregido"); time.sleep(1); st.rerun()
+                                            avisar("Corregido"); st.rerun()
                                     else: st.error("Falta motivo.")
-                else: st.warning("Este cliente no tiene préstamos activos.")
-            else: st.warning("No hay datos.")
+                else: st.warning("No hay datos.")
 
         # --- PESTAÑA 2: ANULAR (SIN CAMBIOS, YA ESTABA BIEN) ---
         with tab_cor:
-            df_hist = cargar_tabla("historial")
-            if not df_hist.empty:
+            if tab_cor.open:
                 c_fil, _ = st.columns(2)
-                filtro_c = c_fil.selectbox("Filtrar Cliente", ["Todos"] + sorted(df_hist["cliente"].unique().tolist()))
-                df_view = df_hist.copy()
-                if filtro_c != "Todos": df_view = df_view[df_view["cliente"] == filtro_c]
-                
-                st.write("Últimos movimientos:")
-                for index, row in df_view.sort_values("fecha_evento", ascending=False).head(20).iterrows():
-                    c1, c2, c3, c4 = st.columns([2, 2, 2, 1])
-                    fecha_clean = row['fecha_evento'].strftime("%d/%m %H:%M") if pd.notnull(row['fecha_evento']) else ""
-                    c1.write(f"📅 {fecha_clean}")
-                    c2.write(f"{row['cliente']} | {row['producto']}")
-                    c3.write(f"{row['tipo']} (${row['monto_operacion']})")
-                    if c4.button("ANULAR", key=f"del_{row['id']}"):
-                        if anular_movimiento(row['id'], usuario_actual):
-                            st.success("Anulado"); time.sleep(1); st.rerun()
-            else: st.info("Sin movimientos.")
+                with c_fil: filtro_c = selector_maestro("Filtrar Cliente", "clientes", "anular_cliente", ["Todos"])
+                df_view, hay_mas = lista_paginada(
+                    "pag_anular",
+                    "historial",
+                    ["id", "fecha_evento", "tipo", "cliente", "producto", "monto_operacion"],
+                    [("cliente", "eq", filtro_c)] if filtro_c != "Todos" else []
+                )
+                if not df_view.empty:
+                    st.write("Últimos movimientos (marca los que quieras anular):")
+                    todos = st.checkbox("Marcar todos los mostrados")
+                    sel = st.data_editor(
+                        df_view.assign(Anular=todos),
+                        column_config={
+                            "id": None,
+                            "fecha_evento": st.column_config.DatetimeColumn("Fecha", format="DD/MM HH:mm"),
+                            "monto_operacion": st.column_config.NumberColumn("Monto", format="$%.2f"),
+                            "Anular": st.column_config.CheckboxColumn("Anular")
+                        },
+                        disabled=["fecha_evento", "tipo", "cliente", "producto", "monto_operacion"],
+                        hide_index=True, use_container_width=True, key=f"anul_{filtro_c}_{todos}"
+                    )
+                    if hay_mas: boton_cargar_mas("pag_anular")
+                    marcados = sel.loc[sel["Anular"], "id"].tolist()
+                    if st.button(f"↩️ ANULAR {len(marcados)} MOVIMIENTO(S)", type="primary", disabled=not marcados):
+                        ok, mensaje = anular_movimientos(marcados, usuario_actual)
+                        if ok:
+                            avisar(mensaje); st.rerun()
+                        else:
+                            st.error(mensaje)
+                else: st.info("Sin movimientos.")
 
         # --- PESTAÑA 3: LOG (COLUMNAS LIMPIAS) ---
         with tab_log:
-            st.write("**Historial de Cambios (Bitácora):**")
-            try:
-                df_bit = pd.DataFrame(supabase.table("bitacora_ediciones").select("*").execute().data)
-                if not df_bit.empty:
-                    # --- MAQUILLAJE DE TABLA (OCULTAR CREATED_AT Y FORMATEAR FECHA) ---
+            if tab_log.open:
+                # Las dos tablas de auditoría se descargan en paralelo y pasan por cargar_tabla
+                tablas.precargar("bitacora_ediciones", "anulaciones")
+                st.write("**Historial de Cambios (Bitácora):**")
+                try:
+                    df_bit = tablas.bitacora_ediciones
+                    if not df_bit.empty:
+                        # --- MAQUILLAJE DE TABLA (OCULTAR CREATED_AT Y FORMATEAR FECHA) ---
+                        st.dataframe(
+                            df_bit.sort_values("fecha_cambio", ascending=False),
+                            use_container_width=True,
+                            column_config={
+                                "id": None,          # Ocultar ID
+                                "created_at": None,  # Ocultar Created_at
+                                "fecha_cambio": st.column_config.DatetimeColumn("Fecha", format="DD/MM/YYYY HH:mm"),
+                                "usuario_responsable": "Usuario",
+                                "cliente_afectado": "Cliente",
+                                "detalle_cambio": "Cambios Realizados",
+                                "motivo": "Motivo"
+                            }
+                        )
+                    else:
+                        st.info("Nadie ha editado nada aún.")
+                except: pass
+                
+                st.divider()
+                st.write("**Historial de Anulaciones:**")
+                df_anul = tablas.anulaciones
+                if not df_anul.empty: 
+                    # Limpieza visual de anulaciones también
                     st.dataframe(
-                        df_bit.sort_values("fecha_cambio", ascending=False),
+                        df_anul.sort_values("id", ascending=False), 
                         use_container_width=True,
                         column_config={
-                            "id": None,          # Ocultar ID
-                            "created_at": None,  # Ocultar Created_at
-                            "fecha_cambio": st.column_config.DatetimeColumn("Fecha", format="DD/MM/YYYY HH:mm"),
-                            "usuario_responsable": "Usuario",
-                            "cliente_afectado": "Cliente",
-                            "detalle_cambio": "Cambios Realizados",
-                            "motivo": "Motivo"
+                            "id": None,
+                            "created_at": None,
+                            "fecha_error": st.column_config.DateColumn("Fecha Original", format="DD/MM/YYYY"),
+                            "monto_anulado": st.column_config.NumberColumn("Monto", format="$%.2f")
                         }
                     )
-                else:
-                    st.info("Nadie ha editado nada aún.")
-            except: pass
-            
-            st.divider()
-            st.write("**Historial de Anulaciones:**")
-            df_anul = cargar_tabla("anulaciones")
-            if not df_anul.empty: 
-                # Limpieza visual de anulaciones también
-                st.dataframe(
-                    df_anul.sort_values("id", ascending=False), 
-                    use_container_width=True,
-                    column_config={
-                        "id": None,
-                        "created_at": None,
-                        "fecha_error": st.column_config.DateColumn("Fecha Original", format="DD/MM/YYYY"),
-                        "monto_anulado": st.column_config.NumberColumn("Monto", format="$%.2f")
-                    }
-                )
                 
     # ==========================================
     # MÓDULO: REPORTES (SOLO ADMIN)
@@ -796,101 +2345,120 @@ def main_app():
     elif menu == "Reportes Financieros":
         st.title("Balance General")
         c1, c2 = st.columns(2)
-        f_cli = c1.multiselect("Filtrar Cliente", sorted(df_cli["nombre"].unique()) if not df_cli.empty else [])
+        with c1: f_cli = selector_maestro("Filtrar Cliente", "clientes", "rep_clientes", multiple=True)
         f_fec = c2.date_input("Periodo", [date.today().replace(day=1), date.today()])
         
-        df_p = cargar_tabla("prestamos")
-        df_h = cargar_tabla("historial")
-        
-        if f_cli: 
-            if not df_p.empty: df_p = df_p[df_p["cliente"].isin(f_cli)]
-            if not df_h.empty: df_h = df_h[df_h["cliente"].isin(f_cli)]
-        if not df_h.empty and len(f_fec)==2:
-            df_h = df_h[(df_h["fecha_evento"].dt.date >= f_fec[0]) & (df_h["fecha_evento"].dt.date <= f_fec[1])]
+        versiones = versiones_tablas()
+        try:
+            df_p, df_h = reporte_financiero(
+                tuple(f_cli),
+                f_fec[0].isoformat() if len(f_fec)==2 else None,
+                f_fec[1].isoformat() if len(f_fec)==2 else None,
+                versiones.get("prestamos", 0), versiones.get("historial", 0), versiones.get("clientes", 0),
+                int(time.time() // TTL_TABLAS["historial"])
+            )
+        except Exception as e:
+            st.error(f"Error generando el reporte: {e}")
+            df_p, df_h = pd.DataFrame(), pd.DataFrame()
         
         col1, col2 = st.columns(2)
         with col1:
             st.subheader("🔴 Deuda Activa")
             if not df_p.empty:
                 st.metric("Total", f"${df_p['total_pendiente'].sum():,.2f}")
-                st.dataframe(df_p.groupby("cliente")["total_pendiente"].sum().sort_values(ascending=False))
+                st.dataframe(df_p["total_pendiente"])
         with col2:
             st.subheader("🟢 Ingresos")
             if not df_h.empty:
-                cob = df_h[df_h["tipo"]=="COBRO"]
-                st.metric("Total", f"${cob['monto_operacion'].sum():,.2f}")
-                st.dataframe(cob.groupby("cliente")["monto_operacion"].sum().sort_values(ascending=False))
+                st.metric("Total", f"${df_h['monto_operacion'].sum():,.2f}")
+                st.dataframe(df_h["monto_operacion"])
 
     # ==========================================
     # MÓDULO: ADMINISTRACIÓN (SOLO ADMIN)
     # ==========================================
     elif menu == "Administración":
         st.title("Administración")
-        t1, t2, t3, t4 = st.tabs(["Directorio", "➕ Crear", "✏️ Editar", "💾 Backup"])
+        t1, t2, t3, t4 = st.tabs(["Directorio", "➕ Crear", "✏️ Editar", "💾 Backup"], key="tabs_admin", on_change="rerun")
         
         with t1:
-            st.subheader("Ficha de Cliente")
-            if not df_cli.empty:
-                vc = st.selectbox("Buscar Cliente", sorted(df_cli["nombre"].unique()))
-                dat = df_cli[df_cli["nombre"] == vc].iloc[0]
-                st.markdown(f"""<div class="client-card"><h3>👤 {dat['nombre']}</h3><p>🏢 {dat.get('tienda', '-')}</p><p>📍 {dat.get('direccion', '-')}</p><p>📞 {dat.get('telefono', '-')}</p><hr><p>🆔 RUC 1: {dat.get('ruc1', '-')}</p><p>🆔 RUC 2: {dat.get('ruc2', '-')}</p></div>""", unsafe_allow_html=True)
+            if t1.open:
+                st.subheader("Ficha de Cliente")
+                vc = selector_maestro("Buscar Cliente", "clientes", "dir_cliente", por_id=True)
+                fila = fila_por_id(tablas.clientes, vc)
+                if fila is not None and fila.empty:
+                    st.error("No se encontró el cliente: puede haberse editado recién. Vuelve a buscarlo.")
+                elif fila is not None:
+                    dat = fila.iloc[0]
+                    st.markdown(f"""<div class="client-card"><h3>👤 {dat['nombre']}</h3><p>🏢 {dat.get('tienda', '-')}</p><p>📍 {dat.get('direccion', '-')}</p><p>📞 {dat.get('telefono', '-')}</p><hr><p>🆔 RUC 1: {dat.get('ruc1', '-')}</p><p>🆔 RUC 2: {dat.get('ruc2', '-')}</p></div>""", unsafe_allow_html=True)
         
         with t2:
-            c1, c2 = st.columns(2)
-            with c1:
-                with st.form("fc"):
-                    n=st.text_input("Nombre"); t=st.text_input("Tienda"); tel=st.text_input("Telefono"); d=st.text_input("Direccion"); r1=st.text_input("RUC1"); r2=st.text_input("RUC2")
-                    if st.form_submit_button("Crear Cliente"):
-                        insertar_registro("clientes", {"nombre":n, "tienda":t, "telefono":tel, "direccion":d, "ruc1":r1, "ruc2":r2}); st.rerun()
-            with c2:
-                with st.form("fp"):
-                    n=st.text_input("Producto"); c=st.selectbox("Categoria", ["Tableros", "Llaves", "Cables", "Interruptores","Otros"]); p=st.number_input("Precio Base")
-                    if st.form_submit_button("Crear Producto"):
-                        insertar_registro("productos", {"nombre":n, "categoria":c, "precio_base":p}); st.rerun()
+            if t2.open:
+                c1, c2 = st.columns(2)
+                with c1:
+                    with st.form("fc"):
+                        n=st.text_input("Nombre"); t=st.text_input("Tienda"); tel=st.text_input("Telefono"); d=st.text_input("Direccion"); r1=st.text_input("RUC1"); r2=st.text_input("RUC2")
+                        if st.form_submit_button("Crear Cliente"):
+                            insertar_registro("clientes", {"nombre":n, "tienda":t, "telefono":tel, "direccion":d, "ruc1":r1, "ruc2":r2}); st.rerun()
+                with c2:
+                    with st.form("fp"):
+                        n=st.text_input("Producto"); c=st.selectbox("Categoria", ["Tableros", "Llaves", "Cables", "Interruptores","Otros"]); p=st.number_input("Precio Base")
+                        if st.form_submit_button("Crear Producto"):
+                            insertar_registro("productos", {"nombre":n, "categoria":c, "precio_base":p}); st.rerun()
 
         with t3:
-            mod = st.radio("Editar:", ["Clientes", "Productos"], horizontal=True)
-            if mod == "Clientes" and not df_cli.empty:
-                s = st.selectbox("Cliente", df_cli["nombre"].unique())
-                d = df_cli[df_cli["nombre"]==s].iloc[0]
-                with st.form("fe"):
-                    nn=st.text_input("Nombre", d["nombre"]); nt=st.text_input("Tienda", d.get("tienda","")); ntel=st.text_input("Telefono", d.get("telefono","")); nd=st.text_input("Direccion", d.get("direccion","")); nr1=st.text_input("RUC1", d.get("ruc1","")); nr2=st.text_input("RUC2", d.get("ruc2",""))
-                    if st.form_submit_button("Actualizar"):
-                        editar_cliente_global(int(d["id"]), {"nombre":nn, "tienda":nt, "telefono":ntel, "direccion":nd, "ruc1":nr1, "ruc2":nr2}, d["nombre"])
-                        st.success("Actualizado"); time.sleep(1); st.rerun()
-            elif mod == "Productos" and not df_prod.empty:
-                s = st.selectbox("Productos", df_prod["nombre"].unique())
-                d = df_prod[df_prod["nombre"]==s].iloc[0]
-                with st.form("fep"):
-                    nn=st.text_input("Nombre", d["nombre"]); np=st.number_input("Precio", float(d["precio_base"])); nc=st.text_input("Categoria", d["categoria"])
-                    if st.form_submit_button("Actualizar"):
-                        editar_producto_global(int(d["id"]), {"nombre":nn, "precio_base":np, "categoria":nc}, d["nombre"])
-                        st.success("Actualizado"); time.sleep(1); st.rerun()
+            if t3.open:
+                mod = st.radio("Editar:", ["Clientes", "Productos"], horizontal=True)
+                s = selector_maestro(mod, mod.lower(), f"editar_{mod.lower()}", por_id=True)
+                fila = fila_por_id(tablas.clientes if mod == "Clientes" else tablas.productos, s)
+                if fila is not None and fila.empty:
+                    st.error(f"No se encontró el registro en {mod}: puede haberse editado recién. Vuelve a buscarlo.")
+                elif mod == "Clientes" and fila is not None:
+                    d = fila.iloc[0]
+                    with st.form("fe"):
+                        nn=st.text_input("Nombre", d["nombre"]); nt=st.text_input("Tienda", d.get("tienda","")); ntel=st.text_input("Telefono", d.get("telefono","")); nd=st.text_input("Direccion", d.get("direccion","")); nr1=st.text_input("RUC1", d.get("ruc1","")); nr2=st.text_input("RUC2", d.get("ruc2",""))
+                        if st.form_submit_button("Actualizar"):
+                            editar_cliente_global(int(d["id"]), {"nombre":nn, "tienda":nt, "telefono":ntel, "direccion":nd, "ruc1":nr1, "ruc2":nr2}, d["nombre"])
+                            avisar("Actualizado"); st.rerun()
+                elif mod == "Productos" and fila is not None:
+                    d = fila.iloc[0]
+                    with st.form("fep"):
+                        nn=st.text_input("Nombre", d["nombre"]); np=st.number_input("Precio", float(d["precio_base"])); nc=st.text_input("Categoria", d["categoria"])
+                        if st.form_submit_button("Actualizar"):
+                            editar_producto_global(int(d["id"]), {"nombre":nn, "precio_base":np, "categoria":nc}, d["nombre"])
+                            avisar("Actualizado"); st.rerun()
 
         with t4:
-            st.info("Descarga Excel limpia.")
-            def clean_csv(df, map_cols): return df.rename(columns=map_cols).to_csv(index=False).encode('utf-8')
-            c1, c2 = st.columns(2)
-            
-            # Cargar Datos para Backup
-            df_p_full = cargar_tabla("prestamos")
-            df_h_full = cargar_tabla("historial")
-            df_s_full = cargar_tabla("stock_real")
-            df_m_full = cargar_tabla("movimientos_stock")
-            df_imp_full = cargar_tabla("importaciones")
-            
-            if not df_cli.empty: c1.download_button("📥 Clientes", clean_csv(df_cli, {"nombre": "Cliente", "ruc1": "RUC"}), "cli.csv", "text/csv")
-            if not df_p_full.empty: c1.download_button("📥 Préstamos", clean_csv(df_p_full, {"cliente": "Cliente", "total_pendiente": "Deuda"}), "prest.csv", "text/csv")
-            if not df_h_full.empty: c2.download_button("📥 Historial", clean_csv(df_h_full, {"fecha_evento": "Fecha", "monto_operacion": "Monto"}), "hist.csv", "text/csv")
-            if not df_prod.empty: c2.download_button("📥 Productos", clean_csv(df_prod, {"nombre": "Producto"}), "prod.csv", "text/csv")
-            
-            st.write("---")
-            st.write("Backups Inventario / Importaciones:")
-            c3, c4 = st.columns(2)
-            if not df_s_full.empty: c3.download_button("📥 Stock", clean_csv(df_s_full, {"cantidad": "Stock"}), "stock.csv", "text/csv")
-            if not df_m_full.empty: c4.download_button("📥 Movimientos Almacén", clean_csv(df_m_full, {"tipo": "Tipo"}), "movs.csv", "text/csv")
-            if not df_imp_full.empty: c3.download_button("📥 Importaciones", clean_csv(df_imp_full, {"codigo_pedido": "PO"}), "imports.csv", "text/csv")
+            if t4.open:
+                st.info("Respaldo completo de todas las tablas en un solo ZIP (incluye manifiesto con filas y checksums).")
+                formato = st.radio("Formato", ["CSV (Excel)", "Parquet"], horizontal=True)
+                ext = "csv" if formato.startswith("CSV") else "parquet"
+                
+                # El ZIP se genera recién al hacer clic, descargando tabla por tabla
+                st.download_button(
+                    "📥 Descargar Respaldo",
+                    lambda: generar_respaldo(ext),
+                    f"respaldo_koriel_{date.today().isoformat()}_{ext}.zip",
+                    "application/zip",
+                    type="primary"
+                )
+                
+                st.markdown("---")
+                st.caption("Los reportes de cobros leen el resumen diario. Reconstruirlo solo si no cuadra con el historial.")
+                if st.button("🔁 Reconstruir resumen diario"):
+                    ok, msg = reconstruir_resumen_diario()
+                    if ok: st.success(msg)
+                    else: st.error(msg)
+
+    if panel_medicion is not None:
+        mostrar_medicion(panel_medicion)
 
 # --- INICIO ---
-if check_login():
-    main_app()
+iniciar_medicion()
+iniciar_lecturas_rerun()
+refrescar_versiones()
+try:
+    if check_login():
+        main_app()
+finally:
+    cerrar_lecturas_rerun()
+    cerrar_medicion()
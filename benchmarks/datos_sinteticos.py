@@ -0,0 +1,104 @@
+# ==========================================
+# DATOS SINTÉTICOS PARA BENCHMARKS
+# ==========================================
+# Genera clientes/productos/prestamos/historial (y el resto de tablas de la app)
+# con el esquema por ids de sql/03. Los tamaños se eligen por número de filas
+# de prestamos/historial (1k a 1M); los maestros crecen en proporción.
+
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+USUARIOS = ["admin", "werlin", "rossel"]
+CATEGORIAS = ["Cables", "Llaves", "Tornillos", "Herramientas", "Otros"]
+ALMACENES = ["Central", "Tienda", "Camión"]
+
+
+def _registros(df):
+    # NaN -> None para que se comporte como el JSON de Supabase
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+
+def generar_datos(n_prestamos=1000, n_historial=None, n_clientes=None, n_productos=None, dias=365, semilla=0):
+    rng = np.random.default_rng(semilla)
+    n_historial = n_prestamos * 2 if n_historial is None else n_historial
+    n_clientes = n_clientes or max(10, n_prestamos // 50)
+    n_productos = n_productos or max(5, n_prestamos // 200)
+    hoy = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    siguiente = [1]
+
+    def tomar(n):
+        # ids únicos entre todas las tablas, como una secuencia global
+        bloque = np.arange(siguiente[0], siguiente[0] + n, dtype=np.int64)
+        siguiente[0] += n
+        return bloque
+
+    clientes = pd.DataFrame({
+        "id": tomar(n_clientes),
+        "nombre": [f"Cliente {i:06d}" for i in range(n_clientes)],
+        "tienda": [f"Tienda {i % 97}" for i in range(n_clientes)],
+        "telefono": [f"9{i:08d}" for i in range(n_clientes)],
+        "direccion": "",
+        "ruc1": [f"20{i:09d}" for i in range(n_clientes)],
+        "ruc2": "",
+    })
+    productos = pd.DataFrame({
+        "id": tomar(n_productos),
+        "nombre": [f"Producto {i:05d}" for i in range(n_productos)],
+        "categoria": rng.choice(CATEGORIAS, n_productos),
+        "precio_base": rng.integers(1, 200, n_productos).astype(float),
+    })
+    almacenes = pd.DataFrame({"id": tomar(len(ALMACENES)), "nombre": ALMACENES})
+
+    # Préstamos: ~30 % ya liquidados (cantidad_pendiente = 0)
+    precio = rng.integers(1, 200, n_prestamos).astype(float)
+    cantidad = rng.integers(1, 50, n_prestamos) * (rng.random(n_prestamos) > 0.3)
+    fecha_p = hoy - pd.to_timedelta(rng.integers(0, dias, n_prestamos), unit="D")
+    prestamos = pd.DataFrame({
+        "id": tomar(n_prestamos),
+        "fecha_registro": fecha_p.strftime("%Y-%m-%d"),
+        "usuario": rng.choice(USUARIOS, n_prestamos),
+        "cliente_id": rng.choice(clientes["id"].to_numpy(), n_prestamos),
+        "producto_id": rng.choice(productos["id"].to_numpy(), n_prestamos),
+        "cantidad_pendiente": cantidad,
+        "precio_unitario": precio,
+        "total_pendiente": cantidad * precio,
+        "observaciones": "",
+        "updated_at": fecha_p.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+    })
+
+    # Cada movimiento sale de un préstamo existente (mismo cliente/producto)
+    origen = prestamos.iloc[rng.integers(0, n_prestamos, n_historial)]
+    tipo = rng.choice(["COBRO", "DEVOLUCION"], n_historial, p=[0.7, 0.3])
+    cant_h = rng.integers(1, 20, n_historial)
+    fecha_h = hoy - pd.to_timedelta(rng.integers(0, dias * 24 * 3600, n_historial), unit="s")
+    historial = pd.DataFrame({
+        "id": tomar(n_historial),
+        "fecha_evento": fecha_h.strftime("%Y-%m-%dT%H:%M:%S"),
+        "usuario_responsable": rng.choice(USUARIOS, n_historial),
+        "tipo": tipo,
+        "cliente_id": origen["cliente_id"].to_numpy(),
+        "producto_id": origen["producto_id"].to_numpy(),
+        "cantidad": cant_h,
+        "monto_operacion": np.where(tipo == "COBRO", cant_h * rng.integers(1, 200, n_historial), 0).astype(float),
+        "updated_at": fecha_h.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+    })
+
+    # Un registro de stock por almacén y producto
+    pares = pd.MultiIndex.from_product([ALMACENES, productos["id"]], names=["almacen", "producto_id"]).to_frame(index=False)
+    stock_real = pares.assign(id=tomar(len(pares)), cantidad=rng.integers(0, 500, len(pares)))
+
+    return {
+        "clientes": _registros(clientes),
+        "productos": _registros(productos),
+        "almacenes": _registros(almacenes),
+        "prestamos": _registros(prestamos),
+        "historial": _registros(historial),
+        "stock_real": _registros(stock_real),
+        "movimientos_stock": [],
+        "importaciones": [],
+        "anulaciones": [],
+        "bitacora_ediciones": [],
+        "eliminaciones": [],
+    }
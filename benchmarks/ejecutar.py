@@ -0,0 +1,295 @@
+# ==========================================
+# BENCHMARKS DE KORIEL (SIN SUPABASE REAL)
+# ==========================================
+# Mide cargar_tabla, cada módulo del menú (vía AppTest) y las funciones de escritura
+# contra el cliente falso en memoria, para varios tamaños de datos.
+#
+# Uso (desde la raíz del repo):
+#   python -m benchmarks.ejecutar --tamanos 1000 10000 100000 --salida reporte_benchmark.json
+#
+# El reporte JSON tiene una fila por (grupo, caso, tamaño, modo) para poder
+# compararlo entre commits y detectar regresiones.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import streamlit as st
+import streamlit.config as st_config
+from streamlit.testing.v1 import AppTest
+
+from benchmarks.datos_sinteticos import generar_datos
+from benchmarks.supabase_falso import ClienteFalso, instalar
+
+RUTA_APP = Path(__file__).resolve().parent.parent / "app.py"
+# El motor (CRUD, cachés, réplica) es todo lo que está antes del login
+MARCA_FIN_MOTOR = "# ==========================================\n# 5. SISTEMA DE ACCESO"
+
+MENUS_ADMIN = [
+    "Nuevo Préstamo", "Rutas y Cobro", "Consultas y Recibos",
+    "Anular/Corregir", "Reportes Financieros", "Administración",
+]
+# Menú -> (llave del st.tabs, pestañas). Las pestañas se abren una por una
+PESTANAS = {
+    "Consultas y Recibos": ("tabs_cons", ["Deudas", "Historial"]),
+    "Anular/Corregir": ("tabs_anul", ["✏️ Editar Dato", "↩️ Deshacer Movimiento", "📜 Auditoría"]),
+    "Administración": ("tabs_admin", ["Directorio", "➕ Crear", "✏️ Editar", "💾 Backup"]),
+}
+
+
+# --- Entorno ---
+def preparar_secretos(directorio):
+    # st.secrets apunta a un archivo temporal: nunca se leen credenciales reales
+    secretos = {
+        "SUPABASE_URL": "http://supabase.falso",
+        "SUPABASE_KEY": "falsa",
+        "RUTA_REPLICA": str(Path(directorio) / "replica_benchmark.db"),
+        "RUTA_COLA": str(Path(directorio) / "cola_benchmark.db"),
+        "RUTA_SNAPSHOTS": str(Path(directorio) / "snapshots_benchmark"),
+    }
+    ruta = Path(directorio) / "secrets.toml"
+    ruta.write_text("".join(f'{k} = "{v}"\n' for k, v in secretos.items()), encoding="utf-8")
+    st_config.set_option("secrets.files", [str(ruta)])
+    return secretos
+
+
+def limpiar_proceso():
+    # Como un proceso recién iniciado: sin cachés propias, con el almacén compartido tal cual
+    st.cache_data.clear()
+    st.cache_resource.clear()
+
+
+def limpiar_caches():
+    limpiar_proceso()
+    shutil.rmtree(st.secrets["RUTA_SNAPSHOTS"], ignore_errors=True)
+
+
+def cargar_motor(db):
+    # Ejecuta la parte del motor de app.py con el cliente falso instalado
+    instalar(db)
+    limpiar_caches()
+    fuente = RUTA_APP.read_text(encoding="utf-8")
+    espacio = {"__name__": "app_motor"}
+    exec(compile(fuente[:fuente.index(MARCA_FIN_MOTOR)], str(RUTA_APP), "exec"), espacio)
+    return espacio
+
+
+# --- Medición ---
+def medir(db, funcion, repeticiones=1, antes=None):
+    tiempos, llamadas, resultado = [], 0, None
+    for _ in range(repeticiones):
+        if antes: antes()
+        inicio_llamadas = len(db.llamadas)
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+        llamadas = len(db.llamadas) - inicio_llamadas
+    filas = len(resultado) if isinstance(resultado, pd.DataFrame) else None
+    # Las funciones de escritura devuelven False (o (False, mensaje)) cuando fallan
+    if resultado is False or (isinstance(resultado, tuple) and resultado[0] is False):
+        raise RuntimeError(f"La operación devolvió {resultado!r}")
+    return {
+        "segundos": statistics.median(tiempos), "min": min(tiempos),
+        "repeticiones": repeticiones, "llamadas": llamadas, "filas": filas,
+    }
+
+
+def _fila(grupo, caso, tamano, modo, medida=None, error=None):
+    fila = {"grupo": grupo, "caso": caso, "tamano": tamano, "modo": modo}
+    fila.update(medida or {"segundos": None})
+    fila["error"] = error
+    return fila
+
+
+def _ejecutar_caso(resultados, grupo, caso, tamano, modo, db, funcion, **kwargs):
+    try:
+        resultados.append(_fila(grupo, caso, tamano, modo, medir(db, funcion, **kwargs)))
+    except Exception as e:
+        resultados.append(_fila(grupo, caso, tamano, modo, error=f"{type(e).__name__}: {e}"))
+
+
+# --- Grupos ---
+def bench_cargar_tabla(m, db, tamano, repeticiones):
+    resultados = []
+    cliente = db.tablas["clientes"][0]["nombre"]
+    hace_30 = (pd.Timestamp.now() - pd.Timedelta(days=30)).date().isoformat()
+    casos = {
+        "clientes": lambda: m["cargar_tabla"]("clientes"),
+        "prestamos_pendientes": lambda: m["cargar_tabla"](
+            "prestamos", m["COLUMNAS_PRESTAMO"] + ["cliente", "producto"], [("cantidad_pendiente", "gt", 0)]
+        ),
+        "prestamos_de_un_cliente": lambda: m["cargar_tabla"](
+            "prestamos", m["COLUMNAS_PRESTAMO"], [("cantidad_pendiente", "gt", 0), ("cliente", "eq", cliente)]
+        ),
+        "historial_30_dias": lambda: m["cargar_tabla"](
+            "historial", None, [("fecha_evento", "gte", hace_30)], ("fecha_evento", True)
+        ),
+    }
+    for caso, funcion in casos.items():
+        _ejecutar_caso(resultados, "cargar_tabla", caso, tamano, "frio", db, funcion, repeticiones=repeticiones, antes=limpiar_caches)
+        # Otro proceso detrás del balanceador: usa la foto que publicó el primero
+        _ejecutar_caso(resultados, "cargar_tabla", caso, tamano, "otro_proceso", db, funcion, repeticiones=repeticiones, antes=limpiar_proceso)
+        _ejecutar_caso(resultados, "cargar_tabla", caso, tamano, "caliente", db, funcion, repeticiones=repeticiones)
+    return resultados
+
+
+def _app_test(secretos, timeout):
+    at = AppTest.from_file(str(RUTA_APP), default_timeout=timeout)
+    for k, v in secretos.items():
+        at.secrets[k] = v
+    at.session_state["usuario_logueado"] = "admin"
+    at.session_state["rol_usuario"] = "admin"
+    return at
+
+
+def bench_menus(db, tamano, secretos, timeout):
+    resultados = []
+    instalar(db)
+
+    def correr(at):
+        at.run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        return None
+
+    for menu in MENUS_ADMIN:
+        limpiar_caches()
+        at = _app_test(secretos, timeout)
+        at.run()
+        at.sidebar.radio[0].set_value(menu)
+        pestanas = PESTANAS.get(menu, (None, [None]))
+        for pestana in pestanas[1]:
+            caso = f"{menu} / {pestana}" if pestana else menu
+            if pestana:
+                at.session_state[pestanas[0]] = pestana
+            _ejecutar_caso(resultados, "menu", caso, tamano, "frio", db, lambda: correr(at), antes=limpiar_caches)
+            _ejecutar_caso(resultados, "menu", caso, tamano, "caliente", db, lambda: correr(at))
+    return resultados
+
+
+def bench_escrituras(m, db, tamano):
+    resultados = []
+    pendientes = [p for p in db.tablas["prestamos"] if p["cantidad_pendiente"] > 0]
+    prestamo = pendientes[0]
+    cliente = db.tablas["clientes"][0]
+    producto = db.tablas["productos"][0]
+    almacen = db.tablas["almacenes"][0]["nombre"]
+    hoy = datetime.now().isoformat()
+
+    def liquidar(n):
+        # Cobro total de los primeros n préstamos abiertos, como "COBRAR TODO" en Rutas
+        # Con los saldos que ve Rutas: lo que sigue en la cola ya está descontado
+        en_cola = m["saldos_en_cola"]()
+        abiertos = (
+            dict(p, cantidad_pendiente=en_cola[p["id"]][0], total_pendiente=en_cola[p["id"]][1]) if p["id"] in en_cola else p
+            for p in db.tablas["prestamos"]
+        )
+        lote = [p for p in abiertos if p["cantidad_pendiente"] > 0][:n]
+        eventos = [{
+            "fecha_evento": hoy, "usuario_responsable": "admin", "tipo": "COBRO",
+            "cliente_id": p["cliente_id"], "producto_id": p["producto_id"],
+            "cantidad": p["cantidad_pendiente"], "monto_operacion": p["total_pendiente"],
+        } for p in lote]
+        saldos = [m["fila_prestamo"](p, 0) for p in lote]
+        return m["liquidar_prestamos"](eventos, saldos)
+
+    def liquidar_y_sincronizar(n):
+        # Hasta que Supabase tiene la liquidación (el hilo de la cola puede adelantarse: el envío es idempotente)
+        cola = m["cola_liquidaciones"]()
+        resultado = liquidar(n)
+        while m["estado_cola"]()["pendiente"]:
+            m["vaciar_cola"](cola)
+        return resultado
+
+    def anular(n):
+        # Los n movimientos más recientes, como al deshacer una liquidación en lote
+        ids = [h["id"] for h in db.tablas["historial"][-n:]]
+        return m["anular_movimientos"](ids, "admin")
+
+    casos = {
+        "insertar_registro_prestamo": lambda: m["insertar_registro"]("prestamos", {
+            "fecha_registro": hoy[:10], "usuario": "admin", "cliente_id": cliente["id"], "producto_id": producto["id"],
+            "cantidad_pendiente": 1, "precio_unitario": 1.0, "total_pendiente": 1.0, "observaciones": "",
+        }),
+        "liquidar_prestamos_50": lambda: liquidar(50),
+        "liquidar_y_sincronizar_50": lambda: liquidar_y_sincronizar(50),
+        "anular_movimientos_1": lambda: anular(1),
+        "anular_movimientos_20": lambda: anular(20),
+        "corregir_dato_prestamo": lambda: m["corregir_dato_prestamo"](
+            prestamo["id"], producto["nombre"], 2, 3.0, "admin", "benchmark"
+        ),
+        "editar_cliente_global": lambda: m["editar_cliente_global"](
+            cliente["id"], {"nombre": cliente["nombre"] + " (B)"}, cliente["nombre"]
+        ),
+        "editar_producto_global": lambda: m["editar_producto_global"](
+            producto["id"], {"nombre": producto["nombre"] + " (B)"}, producto["nombre"]
+        ),
+        "mover_inventario": lambda: m["mover_inventario"](
+            almacen, db.tablas["productos"][1]["nombre"], 1, "ENTRADA", "admin", "benchmark"
+        ),
+    }
+    # Con cachés calientes, como dentro de una sesión real
+    m["indice_deudas"]()
+    for caso, funcion in casos.items():
+        _ejecutar_caso(resultados, "escritura", caso, tamano, "caliente", db, funcion)
+    return resultados
+
+
+# --- Programa ---
+def ejecutar(tamanos, grupos, repeticiones=3, timeout=600):
+    resultados = []
+    with tempfile.TemporaryDirectory() as directorio:
+        secretos = preparar_secretos(directorio)
+        for tamano in tamanos:
+            print(f"[benchmark] {tamano} filas", flush=True)
+            # Cada grupo parte de datos nuevos: las escrituras modifican la base falsa
+            nueva_base = lambda: ClienteFalso(generar_datos(n_prestamos=tamano, n_historial=tamano))
+            if "cargar_tabla" in grupos:
+                db = nueva_base()
+                resultados += bench_cargar_tabla(cargar_motor(db), db, tamano, repeticiones)
+            if "menus" in grupos:
+                resultados += bench_menus(nueva_base(), tamano, secretos, timeout)
+            if "escrituras" in grupos:
+                db = nueva_base()
+                resultados += bench_escrituras(cargar_motor(db), db, tamano)
+            for ruta in [*Path(directorio).glob("replica_benchmark.db*"), *Path(directorio).glob("cola_benchmark.db*")]:
+                ruta.unlink()
+            shutil.rmtree(Path(directorio) / "snapshots_benchmark", ignore_errors=True)
+    return {
+        "generado": datetime.now().isoformat(),
+        "entorno": {
+            "python": platform.python_version(), "plataforma": platform.platform(),
+            "streamlit": st.__version__, "pandas": pd.__version__, "cpus": os.cpu_count(),
+        },
+        "resultados": resultados,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de app.py contra un Supabase falso en memoria")
+    parser.add_argument("--tamanos", type=int, nargs="+", default=[1000, 10000], help="Filas de prestamos/historial")
+    parser.add_argument("--grupos", nargs="+", default=["cargar_tabla", "menus", "escrituras"],
+                        choices=["cargar_tabla", "menus", "escrituras"])
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=600, help="Segundos máximos por ejecución de AppTest")
+    parser.add_argument("--salida", default="reporte_benchmark.json")
+    args = parser.parse_args()
+
+    reporte = ejecutar(args.tamanos, args.grupos, args.repeticiones, args.timeout)
+    Path(args.salida).write_text(json.dumps(reporte, indent=2, ensure_ascii=False), encoding="utf-8")
+    for r in reporte["resultados"]:
+        tiempo = "ERROR" if r["error"] else f"{r['segundos']:.3f}s"
+        print(f"{r['grupo']:<13} {r['caso']:<45} {r['tamano']:>8} {r['modo']:<9} {tiempo}")
+    print(f"[benchmark] reporte en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
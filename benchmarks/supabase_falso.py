@@ -0,0 +1,478 @@
+# ==========================================
+# CLIENTE SUPABASE FALSO (EN MEMORIA)
+# ==========================================
+# Reemplazo de supabase.create_client para medir app.py sin tocar producción.
+# Cubre la cadena que usa la app: table().select/insert/upsert/update/delete,
+# los filtros eq/in_/gte/lte/gt/lt/or_, order/range/limit y las funciones RPC de sql/.
+# Emula los triggers de sql/02 (updated_at + eliminaciones), el resumen diario de sql/07,
+# los cortes de stock de sql/08
+# y el tope de filas de PostgREST.
+
+import copy
+import itertools
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import supabase
+from postgrest.exceptions import APIError
+
+# sql/02_sincronizacion_incremental.sql
+TABLAS_CON_TRIGGERS = ("prestamos", "historial")
+
+COMPARADORES = {
+    "eq": lambda a, b: a == b,
+    "neq": lambda a, b: a != b,
+    "gt": lambda a, b: a is not None and a > b,
+    "gte": lambda a, b: a is not None and a >= b,
+    "lt": lambda a, b: a is not None and a < b,
+    "lte": lambda a, b: a is not None and a <= b,
+    "in": lambda a, b: a in b,
+    "is": lambda a, b: a is None if b == "null" else a is b,
+    "not.is": lambda a, b: a is not None if b == "null" else a is not b,
+}
+
+
+def _partes(texto):
+    # Separa por comas de primer nivel (fuera de comillas y paréntesis)
+    partes, actual, nivel, comillas = [], "", 0, False
+    for ch in texto:
+        if ch == '"': comillas = not comillas
+        elif not comillas and ch == "(": nivel += 1
+        elif not comillas and ch == ")": nivel -= 1
+        if ch == "," and nivel == 0 and not comillas:
+            partes.append(actual)
+            actual = ""
+        else:
+            actual += ch
+    return partes + [actual]
+
+
+def _valor(texto):
+    if texto.startswith('"'): return texto[1:-1]
+    try: return int(texto)
+    except ValueError: return texto
+
+
+def parsear_logico(texto):
+    # Sintaxis de or=(...) de PostgREST: 'a.lt."v",and(a.eq."v",id.lt.5)'
+    condiciones = []
+    for parte in _partes(texto):
+        if parte.startswith(("and(", "or(")):
+            tipo, resto = parte.split("(", 1)
+            condiciones.append((tipo, parsear_logico(resto[:-1])))
+        else:
+            col, op, valor = parte.split(".", 2)
+            if op == "not":
+                # col.not.is.null
+                negado, valor = valor.split(".", 1)
+                op = f"not.{negado}"
+            condiciones.append((col, op, _valor(valor)))
+    return tuple(condiciones)
+
+
+def cumple(fila, condicion):
+    if condicion[0] in ("and", "or"):
+        resultados = (cumple(fila, c) for c in condicion[1])
+        return all(resultados) if condicion[0] == "and" else any(resultados)
+    col, op, valor = condicion
+    return COMPARADORES[op](fila.get(col), valor)
+
+
+class Respuesta:
+    def __init__(self, data):
+        self.data = data
+
+
+class Consulta:
+    def __init__(self, db, tabla):
+        self.db = db
+        self.tabla = tabla
+        self.operacion = "select"
+        self.columnas = "*"
+        self.filtros = []
+        self.orden = []
+        self.rango = None
+        self.limite = None
+        self.datos = None
+
+    # --- Operaciones ---
+    def select(self, columnas="*", count=None):
+        self.operacion, self.columnas = "select", columnas
+        return self
+
+    def insert(self, datos):
+        self.operacion, self.datos = "insert", datos
+        return self
+
+    def upsert(self, datos, on_conflict="id", **_):
+        self.operacion, self.datos = "upsert", datos
+        return self
+
+    def update(self, datos):
+        self.operacion, self.datos = "update", datos
+        return self
+
+    def delete(self):
+        self.operacion = "delete"
+        return self
+
+    # --- Filtros y orden ---
+    def _filtro(self, col, op, valor):
+        self.filtros.append((col, op, valor))
+        return self
+
+    def eq(self, col, valor): return self._filtro(col, "eq", valor)
+    def neq(self, col, valor): return self._filtro(col, "neq", valor)
+    def gt(self, col, valor): return self._filtro(col, "gt", valor)
+    def gte(self, col, valor): return self._filtro(col, "gte", valor)
+    def lt(self, col, valor): return self._filtro(col, "lt", valor)
+    def lte(self, col, valor): return self._filtro(col, "lte", valor)
+    def in_(self, col, valores): return self._filtro(col, "in", frozenset(valores))
+    def or_(self, texto): return self._filtro(None, "or", parsear_logico(texto))
+
+    def order(self, col, desc=False):
+        self.orden.append((col, desc))
+        return self
+
+    def range(self, desde, hasta):
+        self.rango = (desde, hasta)
+        return self
+
+    def limit(self, n):
+        self.limite = n
+        return self
+
+    # --- Ejecución ---
+    def _coincidencias(self):
+        filas = self.db.tablas.setdefault(self.tabla, [])
+        return [f for f in filas if all(cumple(f, (op, v) if op == "or" else (col, op, v)) for col, op, v in self.filtros)]
+
+    def _seleccionar(self):
+        # Filtrar y ordenar es lo caro: se reutiliza entre páginas de la misma consulta
+        llave = (self.tabla, self.db.version(self.tabla), tuple(self.filtros), tuple(self.orden))
+        filas = self.db.memo_consultas.get(llave)
+        if filas is None:
+            filas = self._coincidencias()
+            for col, desc in reversed(self.orden):
+                filas.sort(key=lambda f: (f.get(col) is None, f.get(col)), reverse=desc)
+            self.db.memo_consultas = {llave: filas}
+        if self.rango:
+            filas = filas[self.rango[0]:self.rango[1] + 1]
+        filas = filas[:min(self.limite or self.db.max_filas, self.db.max_filas)]
+        if self.columnas == "*":
+            return [dict(f) for f in filas]
+        cols = [c.strip() for c in self.columnas.split(",")]
+        return [{c: f.get(c) for c in cols} for f in filas]
+
+    def _resumir(self, filas, signo):
+        if self.tabla == "historial":
+            self.db.resumir(filas, signo)
+
+    def _marcar(self, filas):
+        if self.tabla in TABLAS_CON_TRIGGERS:
+            for f in filas:
+                f["updated_at"] = self.db.ahora()
+
+    def execute(self):
+        inicio = time.perf_counter()
+        filas = self.db.tablas.setdefault(self.tabla, [])
+        if self.operacion == "select":
+            salida = self._seleccionar()
+        elif self.operacion in ("insert", "upsert"):
+            datos = self.datos if isinstance(self.datos, list) else [self.datos]
+            por_id = {f["id"]: f for f in filas} if self.operacion == "upsert" else {}
+            salida = []
+            for d in datos:
+                if d.get("id") in por_id:
+                    self._resumir([por_id[d["id"]]], -1)
+                    por_id[d["id"]].update(d)
+                    salida.append(por_id[d["id"]])
+                else:
+                    nueva = dict(d)
+                    nueva.setdefault("id", next(self.db.ids))
+                    filas.append(nueva)
+                    salida.append(nueva)
+            self._marcar(salida)
+            self._resumir(salida, 1)
+            self.db.tocar(self.tabla)
+            salida = copy.deepcopy(salida)
+        elif self.operacion == "update":
+            salida = self._coincidencias()
+            self._resumir(salida, -1)
+            for f in salida:
+                f.update(self.datos)
+            self._marcar(salida)
+            self._resumir(salida, 1)
+            self.db.tocar(self.tabla)
+            salida = copy.deepcopy(salida)
+        else:
+            salida = self._coincidencias()
+            borrar = {id(f) for f in salida}
+            self.db.tablas[self.tabla] = [f for f in filas if id(f) not in borrar]
+            self._resumir(salida, -1)
+            if self.tabla in TABLAS_CON_TRIGGERS:
+                self.db.tablas.setdefault("eliminaciones", []).extend(
+                    {"id": next(self.db.ids), "tabla": self.tabla, "fila_id": f["id"], "eliminado_en": self.db.ahora()}
+                    for f in salida
+                )
+                self.db.tocar("eliminaciones")
+            self.db.tocar(self.tabla)
+        self.db.registrar(self.tabla, self.operacion, len(salida), time.perf_counter() - inicio)
+        return Respuesta(salida)
+
+
+class LlamadaRpc:
+    def __init__(self, db, nombre, parametros):
+        self.db, self.nombre, self.parametros = db, nombre, parametros or {}
+
+    def execute(self):
+        inicio = time.perf_counter()
+        data = RPCS[self.nombre](self.db, self.parametros)
+        self.db.registrar(self.nombre, "rpc", 1, time.perf_counter() - inicio)
+        return Respuesta(data)
+
+
+class ClienteFalso:
+    def __init__(self, tablas=None, max_filas=1000):
+        self.tablas = tablas if tablas is not None else {}
+        self.max_filas = max_filas
+        self.llamadas = []
+        self.memo_consultas = {}
+        self.versiones = {}
+        inicio = max((f.get("id", 0) for filas in self.tablas.values() for f in filas), default=0)
+        self.ids = itertools.count(inicio + 1)
+        # El reloj arranca después de las filas cargadas: si no, la sincronización por updated_at no ve las escrituras
+        self._reloj = max(
+            (datetime.fromisoformat(f["updated_at"]) for filas in self.tablas.values() for f in filas if f.get("updated_at")),
+            default=datetime(2026, 1, 1, tzinfo=timezone.utc)
+        )
+        self._resumen = {}
+        if "historial" in self.tablas:
+            # La migración de sql/07 termina con una reconstrucción
+            _reconstruir_resumen_diario(self, {})
+
+    def table(self, tabla):
+        return Consulta(self, tabla)
+
+    def rpc(self, nombre, parametros=None):
+        return LlamadaRpc(self, nombre, parametros)
+
+    # --- Utilidades ---
+    def ahora(self):
+        # Reloj monótono: cada escritura tiene un updated_at distinto
+        self._reloj += timedelta(milliseconds=1)
+        return self._reloj.isoformat()
+
+    def version(self, tabla):
+        return self.versiones.get(tabla, 0)
+
+    def tocar(self, tabla):
+        self.versiones[tabla] = self.version(tabla) + 1
+
+    def resumir(self, filas, signo):
+        # sql/07: suma/resta cada movimiento en su fila (cliente, día, tipo) de resumen_diario
+        resumen = self.tablas.setdefault("resumen_diario", [])
+        vacias = False
+        for h in filas:
+            llave = (h["cliente_id"], str(h["fecha_evento"])[:10], h["tipo"])
+            fila = self._resumen.get(llave)
+            if fila is None:
+                fila = {"cliente_id": llave[0], "dia": llave[1], "tipo": llave[2], "movimientos": 0, "cantidad": 0, "monto": 0}
+                self._resumen[llave] = fila
+                resumen.append(fila)
+            fila["movimientos"] += signo
+            fila["cantidad"] += signo * (h.get("cantidad") or 0)
+            fila["monto"] += signo * (h.get("monto_operacion") or 0)
+            vacias = vacias or fila["movimientos"] <= 0
+        if vacias:
+            self._resumen = {k: f for k, f in self._resumen.items() if f["movimientos"] > 0}
+            self.tablas["resumen_diario"] = [f for f in resumen if f["movimientos"] > 0]
+        if filas:
+            self.tocar("resumen_diario")
+
+    def registrar(self, tabla, operacion, filas, segundos):
+        self.llamadas.append({"tabla": tabla, "operacion": operacion, "filas": filas, "segundos": segundos})
+
+
+def _mover_inventario(db, p):
+    # Misma lógica que sql/01 + sql/03: resuelve producto_id y mueve stock atómicamente
+    producto = next((f for f in db.tablas.get("productos", []) if f["nombre"] == p["p_producto"]), None)
+    if producto is None:
+        return {"ok": False, "mensaje": f"Producto inexistente: {p['p_producto']}"}
+    stock = db.tablas.setdefault("stock_real", [])
+    fila = next((f for f in stock if f["almacen"] == p["p_almacen"] and f["producto_id"] == producto["id"]), None)
+    if p["p_tipo"] == "SALIDA":
+        if fila is None or fila["cantidad"] < p["p_cantidad"]:
+            return {"ok": False, "mensaje": "Stock insuficiente"}
+        fila["cantidad"] -= p["p_cantidad"]
+    elif fila is None:
+        stock.append({"id": next(db.ids), "almacen": p["p_almacen"], "producto_id": producto["id"], "cantidad": p["p_cantidad"]})
+    else:
+        fila["cantidad"] += p["p_cantidad"]
+    db.tablas.setdefault("movimientos_stock", []).append({
+        "id": next(db.ids), "fecha": p.get("p_fecha") or db.ahora(), "usuario": p["p_usuario"],
+        "almacen": p["p_almacen"], "producto_id": producto["id"], "cantidad": p["p_cantidad"],
+        "tipo": p["p_tipo"], "motivo": p["p_motivo"],
+    })
+    db.tocar("stock_real")
+    db.tocar("movimientos_stock")
+    return {"ok": True, "mensaje": "Movimiento registrado"}
+
+
+def _anular_movimientos(db, p):
+    # Misma lógica que sql/04: todo o nada, un préstamo restaurado por cliente/producto
+    ids = set(p["p_ids"])
+    movimientos = [h for h in db.tablas.get("historial", []) if h["id"] in ids]
+    if not movimientos:
+        return {"ok": False, "mensaje": "Los movimientos seleccionados ya no existen."}
+    prestamos = {}
+    for f in sorted(db.tablas.get("prestamos", []), key=lambda f: f["id"]):
+        prestamos.setdefault((f["cliente_id"], f["producto_id"]), f)
+    origen = [prestamos.get((h["cliente_id"], h["producto_id"])) for h in movimientos]
+    if any(o is None for o in origen):
+        return {"ok": False, "mensaje": "No se encontró el préstamo original. No se anuló ninguno."}
+    nombres = {t: {f["id"]: f["nombre"] for f in db.tablas.get(t, [])} for t in ("clientes", "productos")}
+    restaurados = {}
+    for h, prestamo in zip(movimientos, origen):
+        prestamo["cantidad_pendiente"] += h["cantidad"]
+        prestamo["total_pendiente"] = prestamo["cantidad_pendiente"] * prestamo["precio_unitario"]
+        prestamo["updated_at"] = db.ahora()
+        restaurados[prestamo["id"]] = prestamo
+        db.tablas.setdefault("anulaciones", []).append({
+            "id": next(db.ids), "fecha_error": datetime.now().strftime("%Y-%m-%d"),
+            "usuario_responsable": p["p_usuario"], "accion_original": h["tipo"],
+            "cliente": nombres["clientes"].get(h["cliente_id"]), "producto": nombres["productos"].get(h["producto_id"]),
+            "cantidad_restaurada": h["cantidad"], "monto_anulado": h["monto_operacion"],
+        })
+    db.tablas["historial"] = [h for h in db.tablas["historial"] if h["id"] not in ids]
+    db.resumir(movimientos, -1)
+    db.tablas.setdefault("eliminaciones", []).extend(
+        {"id": next(db.ids), "tabla": "historial", "fila_id": h["id"], "eliminado_en": db.ahora()} for h in movimientos
+    )
+    for tabla in ("prestamos", "historial", "anulaciones", "eliminaciones"):
+        db.tocar(tabla)
+    return {
+        "ok": True, "mensaje": f"{len(movimientos)} movimiento(s) anulado(s).",
+        "prestamos": [
+            {k: f[k] for k in ("id", "cliente_id", "cantidad_pendiente", "total_pendiente")} for f in restaurados.values()
+        ],
+    }
+
+
+def _registrar_liquidaciones(db, p):
+    # Misma lógica que sql/06: un lote ya registrado no se vuelve a aplicar y lo liquidado se descuenta
+    registrados = {f["lote"] for f in db.tablas.setdefault("lotes_liquidacion", [])}
+    prestamos = {f["id"]: f for f in db.tablas.get("prestamos", [])}
+    # Primero se comprueba todo el envío: el raise de sql/06 deshace la transacción entera
+    pendientes, vistos = {}, set(registrados)
+    for lote in p["p_lotes"]:
+        if lote["lote"] in vistos: continue
+        vistos.add(lote["lote"])
+        for saldo in lote["saldos"]:
+            actual = pendientes.get(saldo["id"], prestamos[saldo["id"]]["cantidad_pendiente"] if saldo["id"] in prestamos else None)
+            if actual is None or actual < saldo["liquidado"]:
+                raise APIError({
+                    "message": f"Liquidación {lote['lote']} rechazada: algún préstamo ya no tiene ese saldo pendiente",
+                    "code": "P0001",
+                })
+            pendientes[saldo["id"]] = actual - saldo["liquidado"]
+    aplicados, repetidos = [], []
+    for lote in p["p_lotes"]:
+        if lote["lote"] in registrados:
+            repetidos.append(lote["lote"])
+            continue
+        registrados.add(lote["lote"])
+        db.tablas["lotes_liquidacion"].append({"lote": lote["lote"], "usuario": lote.get("usuario")})
+        nuevos = [dict(evento, id=next(db.ids), updated_at=db.ahora()) for evento in lote["eventos"]]
+        db.tablas.setdefault("historial", []).extend(nuevos)
+        db.resumir(nuevos, 1)
+        for saldo in lote["saldos"]:
+            prestamo = prestamos[saldo["id"]]
+            prestamo["cantidad_pendiente"] -= saldo["liquidado"]
+            prestamo["total_pendiente"] = prestamo["cantidad_pendiente"] * prestamo["precio_unitario"]
+            prestamo["updated_at"] = db.ahora()
+        aplicados.append(lote["lote"])
+    for tabla in ("prestamos", "historial", "lotes_liquidacion"):
+        db.tocar(tabla)
+    return {"ok": True, "aplicados": aplicados, "repetidos": repetidos}
+
+
+def _reconstruir_resumen_diario(db, p):
+    # Misma lógica que sql/07: resumen_diario desde cero a partir de todo el historial
+    db.tablas["resumen_diario"] = []
+    db._resumen = {}
+    db.resumir(db.tablas.get("historial", []), 1)
+    return {"ok": True, "mensaje": f"Resumen diario reconstruido: {len(db.tablas['resumen_diario'])} fila(s)."}
+
+
+def _fin_de_mes(dia):
+    return (dia.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+
+def _sumar_stock(filas, movimientos):
+    # {(almacen, producto_id): cantidad} a partir de un corte y movimientos (SALIDA resta)
+    stock = {}
+    for f in filas:
+        stock[(f["almacen"], f["producto_id"])] = stock.get((f["almacen"], f["producto_id"]), 0) + f["cantidad"]
+    for m in movimientos:
+        signo = -1 if m["tipo"] == "SALIDA" else 1
+        stock[(m["almacen"], m["producto_id"])] = stock.get((m["almacen"], m["producto_id"]), 0) + signo * m["cantidad"]
+    return stock
+
+
+def _completar_cortes_stock(db):
+    # Misma lógica que sql/08: los cortes de meses cerrados que falten, cada uno desde el anterior
+    cortes = db.tablas.setdefault("cortes_stock", [])
+    movimientos = db.tablas.get("movimientos_stock", [])
+    hasta = date.today().replace(day=1) - timedelta(days=1)
+    ultimo = max((c["fecha"] for c in cortes), default=None)
+    if ultimo:
+        corte = _fin_de_mes(date.fromisoformat(ultimo) + timedelta(days=1))
+    elif movimientos:
+        corte = _fin_de_mes(date.fromisoformat(min(m["fecha"][:10] for m in movimientos)))
+    else:
+        return 0
+    creados = 0
+    while corte <= hasta:
+        previo = [c for c in cortes if c["fecha"] == ultimo]
+        nuevos = [m for m in movimientos if (ultimo is None or m["fecha"][:10] > ultimo) and m["fecha"][:10] <= corte.isoformat()]
+        for (almacen, producto_id), cantidad in _sumar_stock(previo, nuevos).items():
+            cortes.append({"fecha": corte.isoformat(), "almacen": almacen, "producto_id": producto_id, "cantidad": cantidad})
+        ultimo, corte = corte.isoformat(), _fin_de_mes(corte + timedelta(days=1))
+        creados += 1
+    if creados:
+        db.tocar("cortes_stock")
+    return creados
+
+
+def _stock_a_fecha(db, p):
+    _completar_cortes_stock(db)
+    fecha = p["p_fecha"][:10]
+    cortes = db.tablas["cortes_stock"]
+    corte = max((c["fecha"] for c in cortes if c["fecha"] <= fecha), default=None)
+    stock = _sumar_stock(
+        [c for c in cortes if c["fecha"] == corte],
+        [m for m in db.tablas.get("movimientos_stock", []) if (corte is None or m["fecha"][:10] > corte) and m["fecha"][:10] <= fecha],
+    )
+    return [
+        {"almacen": almacen, "producto_id": producto_id, "cantidad": cantidad}
+        for (almacen, producto_id), cantidad in sorted(stock.items()) if cantidad != 0
+    ]
+
+
+def _reconstruir_cortes_stock(db, p):
+    db.tablas["cortes_stock"] = []
+    return {"ok": True, "mensaje": f"Cortes de stock reconstruidos: {_completar_cortes_stock(db)} mes(es)."}
+
+
+RPCS = {
+    "mover_inventario": _mover_inventario, "anular_movimientos": _anular_movimientos,
+    "registrar_liquidaciones": _registrar_liquidaciones, "reconstruir_resumen_diario": _reconstruir_resumen_diario,
+    "stock_a_fecha": _stock_a_fecha, "reconstruir_cortes_stock": _reconstruir_cortes_stock,
+}
+
+
+def instalar(db):
+    # Todo create_client posterior (incluido el de app.py) devuelve este cliente
+    supabase.create_client = lambda url, key, *args, **kwargs: db
+    return db
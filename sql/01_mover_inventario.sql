@@ -0,0 +1,56 @@
+-- ==========================================
+-- MOVIMIENTO DE INVENTARIO ATÓMICO
+-- Ejecutar en el SQL Editor de Supabase (o con psql contra un Postgres local).
+-- La app lo llama con supabase.rpc("mover_inventario", {...}).
+-- ==========================================
+
+-- Una sola fila de stock por almacén/producto (necesario para el ON CONFLICT)
+create unique index if not exists stock_real_almacen_producto_key
+    on stock_real (almacen, producto);
+
+create or replace function mover_inventario(
+    p_almacen text,
+    p_producto text,
+    p_cantidad integer,
+    p_tipo text,
+    p_usuario text,
+    p_motivo text,
+    p_fecha timestamp default now()
+) returns json
+language plpgsql
+as $$
+declare
+    v_stock integer;
+begin
+    if p_tipo = 'ENTRADA' then
+        insert into stock_real (almacen, producto, cantidad)
+        values (p_almacen, p_producto, p_cantidad)
+        on conflict (almacen, producto)
+        do update set cantidad = stock_real.cantidad + excluded.cantidad;
+
+    elsif p_tipo = 'SALIDA' then
+        -- El WHERE sobre la cantidad bloquea la fila y evita vender stock que no existe
+        update stock_real
+           set cantidad = cantidad - p_cantidad
+         where almacen = p_almacen
+           and producto = p_producto
+           and cantidad >= p_cantidad
+        returning cantidad into v_stock;
+
+        if not found then
+            if exists (select 1 from stock_real where almacen = p_almacen and producto = p_producto) then
+                return json_build_object('ok', false, 'mensaje', '⛔ Stock insuficiente en este almacén.');
+            end if;
+            return json_build_object('ok', false, 'mensaje', '⛔ El producto no existe en este almacén.');
+        end if;
+
+    else
+        return json_build_object('ok', false, 'mensaje', 'Tipo de movimiento no válido.');
+    end if;
+
+    insert into movimientos_stock (fecha, usuario, tipo, almacen, producto, cantidad, motivo)
+    values (p_fecha, p_usuario, p_tipo, p_almacen, p_producto, p_cantidad, p_motivo);
+
+    return json_build_object('ok', true, 'mensaje', 'Movimiento registrado correctamente.');
+end;
+$$;
@@ -0,0 +1,60 @@
+-- ==========================================
+-- SINCRONIZACIÓN INCREMENTAL (DELTAS)
+-- updated_at en las tablas que se modifican y registro de bajas (tombstones)
+-- para que la app descargue solo lo que cambió desde la última sincronización.
+-- ==========================================
+
+-- 1. Marca de modificación
+alter table prestamos add column if not exists updated_at timestamptz not null default now();
+alter table historial add column if not exists updated_at timestamptz not null default now();
+
+create index if not exists prestamos_updated_at_idx on prestamos (updated_at);
+create index if not exists historial_updated_at_idx on historial (updated_at);
+
+create or replace function marcar_updated_at() returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists prestamos_updated_at on prestamos;
+create trigger prestamos_updated_at
+    before update on prestamos
+    for each row execute function marcar_updated_at();
+
+drop trigger if exists historial_updated_at on historial;
+create trigger historial_updated_at
+    before update on historial
+    for each row execute function marcar_updated_at();
+
+-- 2. Bajas: cada DELETE (p. ej. anular_movimiento) deja una fila aquí
+create table if not exists eliminaciones (
+    id bigint generated by default as identity primary key,
+    tabla text not null,
+    fila_id bigint not null,
+    eliminado_en timestamptz not null default now()
+);
+
+create index if not exists eliminaciones_tabla_id_idx on eliminaciones (tabla, id);
+
+create or replace function registrar_eliminacion() returns trigger
+language plpgsql
+as $$
+begin
+    insert into eliminaciones (tabla, fila_id) values (tg_table_name, old.id);
+    return old;
+end;
+$$;
+
+drop trigger if exists prestamos_eliminacion on prestamos;
+create trigger prestamos_eliminacion
+    after delete on prestamos
+    for each row execute function registrar_eliminacion();
+
+drop trigger if exists historial_eliminacion on historial;
+create trigger historial_eliminacion
+    after delete on historial
+    for each row execute function registrar_eliminacion();
@@ -0,0 +1,132 @@
+-- ==========================================
+-- CLAVES POR ID EN VEZ DE NOMBRE
+-- prestamos / historial / stock_real / movimientos_stock pasan a referenciar
+-- clientes y productos por id. El nombre se resuelve al leer, así que renombrar
+-- un cliente o producto es un UPDATE de una sola fila en su maestro.
+-- Ejecutar una vez, antes de desplegar la versión de la app que escribe ids.
+-- ==========================================
+
+-- 1. Maestros que faltan: nombres usados en movimientos que no existen en clientes/productos
+insert into clientes (nombre)
+select distinct t.cliente
+  from (select cliente from prestamos union select cliente from historial) t
+ where t.cliente is not null
+   and not exists (select 1 from clientes c where c.nombre = t.cliente);
+
+insert into productos (nombre, categoria, precio_base)
+select distinct t.producto, 'Otros', 0
+  from (
+        select producto from prestamos
+        union select producto from historial
+        union select producto from stock_real
+        union select producto from movimientos_stock
+       ) t
+ where t.producto is not null
+   and not exists (select 1 from productos p where p.nombre = t.producto);
+
+-- 2. Columnas de referencia
+alter table prestamos
+    add column if not exists cliente_id bigint references clientes (id),
+    add column if not exists producto_id bigint references productos (id);
+alter table historial
+    add column if not exists cliente_id bigint references clientes (id),
+    add column if not exists producto_id bigint references productos (id);
+alter table stock_real
+    add column if not exists producto_id bigint references productos (id);
+alter table movimientos_stock
+    add column if not exists producto_id bigint references productos (id);
+
+-- 3. Relleno de filas existentes (si hay nombres repetidos en un maestro, gana el id menor)
+update prestamos t set cliente_id = m.id
+  from (select nombre, min(id) as id from clientes group by nombre) m
+ where m.nombre = t.cliente and t.cliente_id is null;
+update historial t set cliente_id = m.id
+  from (select nombre, min(id) as id from clientes group by nombre) m
+ where m.nombre = t.cliente and t.cliente_id is null;
+
+update prestamos t set producto_id = m.id
+  from (select nombre, min(id) as id from productos group by nombre) m
+ where m.nombre = t.producto and t.producto_id is null;
+update historial t set producto_id = m.id
+  from (select nombre, min(id) as id from productos group by nombre) m
+ where m.nombre = t.producto and t.producto_id is null;
+update stock_real t set producto_id = m.id
+  from (select nombre, min(id) as id from productos group by nombre) m
+ where m.nombre = t.producto and t.producto_id is null;
+update movimientos_stock t set producto_id = m.id
+  from (select nombre, min(id) as id from productos group by nombre) m
+ where m.nombre = t.producto and t.producto_id is null;
+
+alter table prestamos alter column cliente_id set not null, alter column producto_id set not null;
+alter table historial alter column cliente_id set not null, alter column producto_id set not null;
+alter table stock_real alter column producto_id set not null;
+
+-- 4. Índices sobre las claves enteras
+create index if not exists prestamos_cliente_id_idx on prestamos (cliente_id) where cantidad_pendiente > 0;
+create index if not exists prestamos_producto_id_idx on prestamos (producto_id);
+create index if not exists historial_cliente_id_idx on historial (cliente_id, fecha_evento);
+create index if not exists historial_producto_id_idx on historial (producto_id);
+create index if not exists movimientos_stock_producto_id_idx on movimientos_stock (producto_id);
+
+drop index if exists stock_real_almacen_producto_key;
+create unique index if not exists stock_real_almacen_producto_id_key on stock_real (almacen, producto_id);
+
+-- 5. Las columnas de nombre quedan como histórico: la app deja de escribirlas
+alter table prestamos alter column cliente drop not null, alter column producto drop not null;
+alter table historial alter column cliente drop not null, alter column producto drop not null;
+alter table stock_real alter column producto drop not null;
+alter table movimientos_stock alter column producto drop not null;
+
+-- 6. mover_inventario por producto_id (misma firma que sql/01; el nombre se resuelve aquí)
+create or replace function mover_inventario(
+    p_almacen text,
+    p_producto text,
+    p_cantidad integer,
+    p_tipo text,
+    p_usuario text,
+    p_motivo text,
+    p_fecha timestamp default now()
+) returns json
+language plpgsql
+as $$
+declare
+    v_producto_id bigint;
+    v_stock integer;
+begin
+    select min(id) into v_producto_id from productos where nombre = p_producto;
+    if v_producto_id is null then
+        return json_build_object('ok', false, 'mensaje', '⛔ El producto no existe.');
+    end if;
+
+    if p_tipo = 'ENTRADA' then
+        insert into stock_real (almacen, producto_id, cantidad)
+        values (p_almacen, v_producto_id, p_cantidad)
+        on conflict (almacen, producto_id)
+        do update set cantidad = stock_real.cantidad + excluded.cantidad;
+
+    elsif p_tipo = 'SALIDA' then
+        -- El WHERE sobre la cantidad bloquea la fila y evita vender stock que no existe
+        update stock_real
+           set cantidad = cantidad - p_cantidad
+         where almacen = p_almacen
+           and producto_id = v_producto_id
+           and cantidad >= p_cantidad
+        returning cantidad into v_stock;
+
+        if not found then
+            if exists (select 1 from stock_real where almacen = p_almacen and producto_id = v_producto_id) then
+                return json_build_object('ok', false, 'mensaje', '⛔ Stock insuficiente en este almacén.');
+            end if;
+            return json_build_object('ok', false, 'mensaje', '⛔ El producto no existe en este almacén.');
+        end if;
+
+    else
+        return json_build_object('ok', false, 'mensaje', 'Tipo de movimiento no válido.');
+    end if;
+
+    insert into movimientos_stock (fecha, usuario, tipo, almacen, producto_id, cantidad, motivo)
+    values (p_fecha, p_usuario, p_tipo, p_almacen, v_producto_id, p_cantidad, p_motivo);
+
+    return json_build_object('ok', true, 'mensaje', 'Movimiento registrado correctamente.');
+end;
+$$;
@@ -0,0 +1,85 @@
+-- ==========================================
+-- ANULACIÓN DE MOVIMIENTOS EN LOTE
+-- Anula varios registros de historial en una sola transacción: restaura el saldo
+-- de cada préstamo, deja la constancia en "anulaciones" y borra el historial.
+-- Si algún movimiento no tiene préstamo de origen no se anula ninguno.
+-- La app lo llama con supabase.rpc("anular_movimientos", {"p_ids": [...], "p_usuario": ...}).
+-- Requiere sql/03_claves_id.sql.
+-- ==========================================
+
+create or replace function anular_movimientos(
+    p_ids bigint[],
+    p_usuario text
+) returns json
+language plpgsql
+as $$
+declare
+    v_sin_prestamo integer;
+    v_anulados integer;
+    v_prestamos json;
+begin
+    -- Bloquear los movimientos: dos anulaciones simultáneas no restauran dos veces
+    perform 1 from historial where id = any(p_ids) for update;
+
+    -- Movimientos a anular con el préstamo que restauran
+    -- (el de menor id para ese cliente/producto)
+    drop table if exists _anulacion;
+    create temp table _anulacion on commit drop as
+    select h.id, h.tipo, h.cliente_id, h.producto_id, h.cantidad, h.monto_operacion,
+           (select p.id
+              from prestamos p
+             where p.cliente_id = h.cliente_id
+               and p.producto_id = h.producto_id
+             order by p.id
+             limit 1) as prestamo_id
+      from historial h
+     where h.id = any(p_ids);
+
+    if not exists (select 1 from _anulacion) then
+        return json_build_object('ok', false, 'mensaje', 'Los movimientos seleccionados ya no existen.');
+    end if;
+
+    select count(*) into v_sin_prestamo from _anulacion where prestamo_id is null;
+    if v_sin_prestamo > 0 then
+        return json_build_object(
+            'ok', false,
+            'mensaje', 'No se encontró el préstamo original de ' || v_sin_prestamo
+                       || ' movimiento(s). No se anuló ninguno.'
+        );
+    end if;
+
+    -- 1. Restaurar saldos (varios movimientos del mismo préstamo se suman)
+    with suma as (
+        select prestamo_id, sum(cantidad) as cantidad
+          from _anulacion
+         group by prestamo_id
+    ), restaurados as (
+        update prestamos p
+           set cantidad_pendiente = p.cantidad_pendiente + s.cantidad,
+               total_pendiente = (p.cantidad_pendiente + s.cantidad) * p.precio_unitario
+          from suma s
+         where p.id = s.prestamo_id
+        returning p.id, p.cliente_id, p.cantidad_pendiente, p.total_pendiente
+    )
+    select coalesce(json_agg(restaurados), '[]'::json) into v_prestamos from restaurados;
+
+    -- 2. Constancia de auditoría (con los nombres vigentes)
+    insert into anulaciones (fecha_error, usuario_responsable, accion_original, cliente, producto,
+                             cantidad_restaurada, monto_anulado)
+    select current_date, p_usuario, a.tipo, c.nombre, pr.nombre, a.cantidad, a.monto_operacion
+      from _anulacion a
+      join clientes c on c.id = a.cliente_id
+      join productos pr on pr.id = a.producto_id
+     order by a.id;
+
+    -- 3. Borrar el historial (el trigger de sql/02 deja las bajas en "eliminaciones")
+    delete from historial where id in (select id from _anulacion);
+    get diagnostics v_anulados = row_count;
+
+    return json_build_object(
+        'ok', true,
+        'mensaje', v_anulados || ' movimiento(s) anulado(s).',
+        'prestamos', v_prestamos
+    );
+end;
+$$;
@@ -0,0 +1,15 @@
+-- ==========================================
+-- ÍNDICES PARA LAS LISTAS PAGINADAS POR CURSOR
+-- La app pide el historial como:
+--   order by fecha_evento desc, id desc limit N
+--   where (fecha_evento, id) < (cursor_fecha, cursor_id)
+-- Con estos índices cada página lee N filas sin importar el tamaño de la tabla.
+-- ==========================================
+
+create index if not exists historial_fecha_id_idx
+    on historial (fecha_evento desc, id desc);
+
+-- Filtro por cliente (pestaña "Deshacer Movimiento" y Consultas > Historial)
+drop index if exists historial_cliente_id_idx;
+create index if not exists historial_cliente_fecha_id_idx
+    on historial (cliente_id, fecha_evento desc, id desc);
@@ -0,0 +1,73 @@
+-- ==========================================
+-- LIQUIDACIONES DESDE LA COLA LOCAL
+-- La app guarda los cobros/devoluciones de Rutas en una cola SQLite y los envía
+-- por lotes. Cada liquidación trae un uuid ("lote"): si un envío se repite
+-- (timeout, reintento) la liquidación ya registrada no se vuelve a aplicar.
+-- La app lo llama con supabase.rpc("registrar_liquidaciones", {"p_lotes": [...]}),
+-- donde cada elemento es {"lote": uuid, "eventos": [filas de historial], "saldos": [préstamos]}
+-- y cada préstamo trae {"id", "liquidado"}: las unidades cobradas o devueltas que se descuentan.
+-- Requiere sql/03_claves_id.sql.
+-- ==========================================
+
+-- 1. Liquidaciones ya aplicadas
+create table if not exists lotes_liquidacion (
+    lote uuid primary key,
+    usuario text,
+    registrado_en timestamptz not null default now()
+);
+
+-- 2. Registro idempotente (todo el envío en una transacción)
+create or replace function registrar_liquidaciones(
+    p_lotes json
+) returns json
+language plpgsql
+as $$
+declare
+    v_lote json;
+    v_nuevo uuid;
+    v_aplicados uuid[] := '{}';
+    v_repetidos uuid[] := '{}';
+    v_filas integer;
+begin
+    for v_lote in select * from json_array_elements(p_lotes) loop
+        v_nuevo := null;
+        -- Reclamar el uuid: si ya existe, otro envío lo aplicó antes
+        insert into lotes_liquidacion (lote, usuario)
+        values ((v_lote->>'lote')::uuid, v_lote->>'usuario')
+        on conflict (lote) do nothing
+        returning lote into v_nuevo;
+
+        if v_nuevo is null then
+            v_repetidos := v_repetidos || (v_lote->>'lote')::uuid;
+            continue;
+        end if;
+
+        insert into historial (fecha_evento, usuario_responsable, tipo, cliente_id, producto_id,
+                               cantidad, monto_operacion)
+        select e.fecha_evento, e.usuario_responsable, e.tipo, e.cliente_id, e.producto_id,
+               e.cantidad, e.monto_operacion
+          from json_populate_recordset(null::historial, v_lote->'eventos') e;
+
+        -- Se descuenta lo liquidado del saldo actual (no se escribe un saldo leído antes en la app):
+        -- así no se pisa una corrección hecha mientras la liquidación esperaba en la cola.
+        -- Solo se tocan las dos columnas de saldo
+        update prestamos p
+           set cantidad_pendiente = p.cantidad_pendiente - s.liquidado,
+               total_pendiente = (p.cantidad_pendiente - s.liquidado) * p.precio_unitario
+          from json_to_recordset(v_lote->'saldos') as s(id bigint, liquidado integer)
+         where p.id = s.id
+           and p.cantidad_pendiente >= s.liquidado;
+
+        -- Préstamo borrado o con menos pendiente que lo liquidado: se rechaza el envío entero
+        -- (la app lo reintenta de a una y deja la liquidación en error)
+        get diagnostics v_filas = row_count;
+        if v_filas < json_array_length(v_lote->'saldos') then
+            raise exception 'Liquidación % rechazada: algún préstamo ya no tiene ese saldo pendiente', v_lote->>'lote';
+        end if;
+
+        v_aplicados := v_aplicados || v_nuevo;
+    end loop;
+
+    return json_build_object('ok', true, 'aplicados', v_aplicados, 'repetidos', v_repetidos);
+end;
+$$;
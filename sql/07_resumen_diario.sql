@@ -0,0 +1,107 @@
+-- ==========================================
+-- RESUMEN DIARIO DE MOVIMIENTOS
+-- Una fila por cliente, día y tipo (COBRO / DEVOLUCION) con la cantidad de
+-- movimientos, unidades y monto. Los reportes leen de aquí en vez de sumar
+-- todo el historial: el costo crece con días × clientes, no con eventos.
+-- Lo mantienen triggers sobre historial, así que cubre las liquidaciones
+-- (sql/06), las anulaciones (sql/04) y cualquier otra escritura.
+-- Reconstruir desde cero: select reconstruir_resumen_diario();
+-- (también desde la app: Administración > Backup). Requiere sql/03_claves_id.sql.
+-- ==========================================
+
+-- 1. Tabla
+create table if not exists resumen_diario (
+    cliente_id bigint not null references clientes (id),
+    dia date not null,
+    tipo text not null,
+    movimientos integer not null default 0,
+    cantidad bigint not null default 0,
+    monto numeric not null default 0,
+    primary key (cliente_id, dia, tipo)
+);
+
+create index if not exists resumen_diario_tipo_dia_idx on resumen_diario (tipo, dia);
+
+-- 2. Mantenimiento: una suma/resta por (cliente, día, tipo) por sentencia, no por fila
+create or replace function mantener_resumen_diario() returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op in ('INSERT', 'UPDATE') then
+        insert into resumen_diario as r (cliente_id, dia, tipo, movimientos, cantidad, monto)
+        select cliente_id, fecha_evento::date, tipo, count(*),
+               coalesce(sum(cantidad), 0), coalesce(sum(monto_operacion), 0)
+          from nuevas
+         group by 1, 2, 3
+        on conflict (cliente_id, dia, tipo) do update
+           set movimientos = r.movimientos + excluded.movimientos,
+               cantidad = r.cantidad + excluded.cantidad,
+               monto = r.monto + excluded.monto;
+    end if;
+
+    if tg_op in ('DELETE', 'UPDATE') then
+        insert into resumen_diario as r (cliente_id, dia, tipo, movimientos, cantidad, monto)
+        select cliente_id, fecha_evento::date, tipo, -count(*),
+               -coalesce(sum(cantidad), 0), -coalesce(sum(monto_operacion), 0)
+          from viejas
+         group by 1, 2, 3
+        on conflict (cliente_id, dia, tipo) do update
+           set movimientos = r.movimientos + excluded.movimientos,
+               cantidad = r.cantidad + excluded.cantidad,
+               monto = r.monto + excluded.monto;
+
+        -- Días que quedaron sin movimientos
+        delete from resumen_diario r
+         using (select distinct cliente_id, fecha_evento::date as dia, tipo from viejas) v
+         where r.cliente_id = v.cliente_id and r.dia = v.dia and r.tipo = v.tipo
+           and r.movimientos <= 0;
+    end if;
+
+    return null;
+end;
+$$;
+
+drop trigger if exists historial_resumen_insert on historial;
+create trigger historial_resumen_insert
+    after insert on historial
+    referencing new table as nuevas
+    for each statement execute function mantener_resumen_diario();
+
+drop trigger if exists historial_resumen_update on historial;
+create trigger historial_resumen_update
+    after update on historial
+    referencing old table as viejas new table as nuevas
+    for each statement execute function mantener_resumen_diario();
+
+drop trigger if exists historial_resumen_delete on historial;
+create trigger historial_resumen_delete
+    after delete on historial
+    referencing old table as viejas
+    for each statement execute function mantener_resumen_diario();
+
+-- 3. Reconstrucción (y carga inicial)
+create or replace function reconstruir_resumen_diario() returns json
+language plpgsql
+as $$
+declare
+    v_filas integer;
+begin
+    -- Sin escrituras en historial mientras se recalcula
+    lock table historial in share mode;
+
+    delete from resumen_diario where true;
+    insert into resumen_diario (cliente_id, dia, tipo, movimientos, cantidad, monto)
+    select cliente_id, fecha_evento::date, tipo, count(*),
+           coalesce(sum(cantidad), 0), coalesce(sum(monto_operacion), 0)
+      from historial
+     group by 1, 2, 3;
+    get diagnostics v_filas = row_count;
+
+    return json_build_object(
+        'ok', true,
+        'mensaje', 'Resumen diario reconstruido: ' || v_filas || ' fila(s).'
+    );
+end;
+$$;
+
+select reconstruir_resumen_diario();
@@ -0,0 +1,117 @@
+-- ==========================================
+-- CORTES DE STOCK (STOCK A UNA FECHA)
+-- Una foto del stock por almacén y producto al cierre de cada mes, calculada
+-- desde movimientos_stock. El stock a cualquier fecha es el corte más cercano
+-- anterior más los movimientos posteriores: se reproducen días, no todo el libro.
+-- Los cortes de meses cerrados se crean solos la primera vez que se consulta
+-- stock_a_fecha() en el mes. Si se corrigen movimientos viejos, reconstruir:
+-- select reconstruir_cortes_stock(); (también desde la app: Inventario > Stock Actual).
+-- Requiere sql/03_claves_id.sql.
+-- ==========================================
+
+-- 1. Tabla
+create table if not exists cortes_stock (
+    fecha date not null,            -- stock al cierre de este día (último del mes)
+    almacen text not null,
+    producto_id bigint not null references productos (id),
+    cantidad integer not null,
+    primary key (fecha, almacen, producto_id)
+);
+
+create index if not exists movimientos_stock_fecha_idx on movimientos_stock (fecha);
+
+-- 2. Cortes de los meses cerrados que falten, cada uno desde el anterior
+create or replace function completar_cortes_stock() returns integer
+language plpgsql
+as $$
+declare
+    v_ultimo date;
+    v_corte date;
+    v_hasta date := (date_trunc('month', current_date) - interval '1 day')::date;
+    v_creados integer := 0;
+begin
+    -- Un solo proceso completa cortes a la vez
+    perform pg_advisory_xact_lock(hashtext('cortes_stock'));
+
+    select max(fecha) into v_ultimo from cortes_stock;
+    if v_ultimo is null then
+        select (date_trunc('month', min(fecha)) + interval '1 month' - interval '1 day')::date
+          into v_corte from movimientos_stock;
+    else
+        v_corte := (date_trunc('month', v_ultimo) + interval '2 month' - interval '1 day')::date;
+    end if;
+
+    while v_corte is not null and v_corte <= v_hasta loop
+        -- Se guardan también los ceros: un par que tuvo stock sigue en todos los cortes
+        insert into cortes_stock (fecha, almacen, producto_id, cantidad)
+        select v_corte, almacen, producto_id, sum(cantidad)
+          from (
+            select almacen, producto_id, cantidad from cortes_stock where fecha = v_ultimo
+            union all
+            select almacen, producto_id, case when tipo = 'SALIDA' then -cantidad else cantidad end
+              from movimientos_stock
+             where (v_ultimo is null or fecha >= v_ultimo + 1) and fecha < v_corte + 1
+          ) t
+         group by almacen, producto_id;
+
+        v_ultimo := v_corte;
+        v_corte := (date_trunc('month', v_corte) + interval '2 month' - interval '1 day')::date;
+        v_creados := v_creados + 1;
+    end loop;
+
+    return v_creados;
+end;
+$$;
+
+-- 3. Stock al cierre de p_fecha: corte más cercano + movimientos desde ese corte
+create or replace function stock_a_fecha(
+    p_fecha date
+) returns json
+language plpgsql
+as $$
+declare
+    v_corte date;
+begin
+    perform completar_cortes_stock();
+    select max(fecha) into v_corte from cortes_stock where fecha <= p_fecha;
+
+    return coalesce((
+        select json_agg(json_build_object('almacen', almacen, 'producto_id', producto_id, 'cantidad', cantidad)
+                        order by almacen, producto_id)
+          from (
+            select almacen, producto_id, sum(cantidad) as cantidad
+              from (
+                select almacen, producto_id, cantidad from cortes_stock where fecha = v_corte
+                union all
+                select almacen, producto_id, case when tipo = 'SALIDA' then -cantidad else cantidad end
+                  from movimientos_stock
+                 where (v_corte is null or fecha >= v_corte + 1) and fecha < p_fecha + 1
+              ) t
+             group by almacen, producto_id
+            having sum(cantidad) <> 0
+          ) s
+    ), '[]'::json);
+end;
+$$;
+
+-- 4. Reconstrucción (y carga inicial)
+create or replace function reconstruir_cortes_stock() returns json
+language plpgsql
+as $$
+declare
+    v_cortes integer;
+begin
+    -- Sin movimientos nuevos mientras se recalcula
+    lock table movimientos_stock in share mode;
+
+    delete from cortes_stock where true;
+    v_cortes := completar_cortes_stock();
+
+    return json_build_object(
+        'ok', true,
+        'mensaje', 'Cortes de stock reconstruidos: ' || v_cortes || ' mes(es).'
+    );
+end;
+$$;
+
+select reconstruir_cortes_stock();